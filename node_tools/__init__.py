@@ -12,6 +12,7 @@ from node_tools.cache_funcs import get_net_status as get_net_status
 from node_tools.cache_funcs import get_node_status as get_node_status
 from node_tools.cache_funcs import get_peer_status as get_peer_status
 from node_tools.cache_funcs import get_state as get_state
+from node_tools.cache_funcs import iter_endpoint_data as iter_endpoint_data
 from node_tools.cache_funcs import load_cache_by_type as load_cache_by_type
 from node_tools.helper_funcs import find_ipv4_iface as find_ipv4_iface
 from node_tools.helper_funcs import get_cachedir as get_cachedir
@@ -24,6 +25,7 @@ from node_tools.helper_funcs import run_event_handlers as run_event_handlers
 from node_tools.helper_funcs import set_initial_role as set_initial_role
 from node_tools.helper_funcs import update_state as update_state
 from node_tools.helper_funcs import AttrDict as AttrDict
+from node_tools.helper_funcs import AttrView as AttrView
 from node_tools.helper_funcs import ENODATA as ENODATA
 from node_tools.helper_funcs import NODE_SETTINGS as NODE_SETTINGS
 from node_tools.msg_queues import handle_announce_msg as handle_announce_msg
@@ -43,14 +45,17 @@ from node_tools.node_funcs import run_ztcli_cmd as run_ztcli_cmd
 from node_tools.node_funcs import wait_for_moon as wait_for_moon
 from node_tools.exceptions import MemberNodeError as MemberNodeError
 from node_tools.exceptions import MemberNodeNoDataError as MemberNodeNoDataError
+from node_tools.exceptions import ServiceUnavailableError as ServiceUnavailableError
 
 
 __all__ = [
     'AttrDict',
+    'AttrView',
     'ENODATA',
     'MemberNodeError',
     'MemberNodeNoDataError',
     'NODE_SETTINGS',
+    'ServiceUnavailableError',
     'check_daemon',
     'drain_msg_queue',
     'find_keys',
@@ -70,6 +75,7 @@ __all__ = [
     'handle_announce_msg',
     'handle_moon_data',
     'handle_node_queues',
+    'iter_endpoint_data',
     'json_dump_file',
     'json_load_file',
     'load_cache_by_type',
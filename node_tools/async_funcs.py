@@ -11,89 +11,163 @@ import time
 logger = logging.getLogger(__name__)
 
 
-async def bootstrap_mbr_node(client, ctlr_id, node_id, deque, ex=False):
+async def bootstrap_mbr_node(client, ctlr_id, node_id, pool, ex=False):
     """
     Wrapper for bootstrapping a new member node; adds one network for
     each node and adds each node to its (new) network.  Updates net/id
     tries with new data.
     :notes: Since we *always* provide a new (ZT) network, we do *not*
-            handle existing nodes here.  The `deque` parameter is
-            required for handle_net_cfg().
+            handle existing nodes here.  The `pool` parameter is
+            required for handle_net_cfg().  This is the single node
+            version of `bootstrap_mbr_nodes`.
     :param client: ztcli_api client object
     :param ctlr_id: node ID of controller node
     :param node_id: node ID
-    :param deque: netobj queue
+    :param pool: subnet pool
     :param ex: True if node is an exit node
+    :return: True if the node was bootstrapped
     """
+    ex_nodes = [node_id] if ex else []
+    res = await bootstrap_mbr_nodes(client, ctlr_id, [node_id], pool, ex_nodes=ex_nodes)
+    return res[node_id]
+
+
+async def bootstrap_mbr_nodes(client, ctlr_id, node_list, pool, ex_nodes=None):
+    """
+    Wrapper for bootstrapping a batch of new member nodes.  Plans the new
+    network (netcfg) and chain link for each node first, then runs the
+    ctlr calls for all the nodes concurrently (one step at a time) and
+    updates the net/id tries in one step (in chain order).
+    :notes: Exit nodes go first; each other node links to the dangling
+            net, ie, the network of the previous node in the batch (or
+            the current dangling net in the ID trie).  If a node fails,
+            any nodes linked after it also fail; the ctlr objects of the
+            failed nodes are deleted and their subnets released, so they
+            can be bootstrapped again on the next cycle.
+    :param client: ztcli_api client object
+    :param ctlr_id: node ID of controller node
+    :param node_list: list of (new) node IDs
+    :param pool: subnet pool
+    :param ex_nodes: list of exit node IDs (default is to check each
+                     node with is_exit_node)
+    :return: dict of node IDs and results (True if bootstrapped)
+    """
+    import copy
+
     from node_tools import ctlr_data as ct
 
     from node_tools.ctlr_funcs import get_network_id
+    from node_tools.ctlr_funcs import get_route_netbase
     from node_tools.ctlr_funcs import handle_net_cfg
+    from node_tools.ctlr_funcs import is_exit_node
     from node_tools.ctlr_funcs import set_network_cfg
+    from node_tools.helper_funcs import AttrDict
     from node_tools.trie_funcs import find_dangling_nets
     from node_tools.trie_funcs import get_dangling_net_data
+    from node_tools.trie_funcs import get_id_draft
+    from node_tools.trie_funcs import slim_trie_payload
     from node_tools.trie_funcs import update_id_trie
 
-    await add_network_object(client, ctlr_id=ctlr_id)
-    net_id = get_network_id(client.data)
-    logger.debug('BOOTSTRAP: added network id {}'.format(net_id))
-    net_rules = ct.rules
-    await config_network_object(client, net_rules, net_id)
-    logger.debug('BOOTSTRAP: added network rules {}'.format(net_rules))
-    await get_network_object_ids(client)
-    logger.debug('BOOTSTRAP: got network list {}'.format(client.data))
-
-    net_list = client.data
-    if net_id in net_list:
-        # Get details about each network
-        await get_network_object_data(client, net_id)
-        logger.debug('BOOTSTRAP: got network data {}'.format(client.data))
-        trie_nets = [net_id]
-
-        await add_network_object(client, net_id, node_id)
-        logger.debug('BOOTSTRAP: added node id {} to gw net'.format(node_id))
-        await get_network_object_ids(client, net_id)
-        member_dict = client.data
-        logger.debug('BOOTSTRAP: got node dict {}'.format(member_dict))
-        await get_network_object_data(client, net_id, node_id)
-        logger.debug('BOOTSTRAP: got node data {}'.format(client.data))
-
-        ipnet, _, gw = handle_net_cfg(deque)
-        await config_network_object(client, ipnet, net_id)
-
-        # A dedicated exit node is a special case, otherwise, each new node
-        # gets a src_net here, and still *needs* a exit_net.  We also need to
-        # update the src net needs after linking the next mbr node.
-        if not ex:
-            data_list = find_dangling_nets(ct.id_trie)
-            logger.debug('BOOTSTRAP: got exit net {}'.format(data_list))
-            if len(data_list) == 2:
-                exit_net = data_list[0]
-                exit_node = data_list[1]
-                await add_network_object(client, exit_net, node_id)
-                logger.debug('BOOTSTRAP: added node id {} to exit net {}'.format(node_id, exit_net))
-                netcfg = get_dangling_net_data(ct.net_trie, exit_net)
-                gw_cfg = set_network_cfg(netcfg.host)
-                logger.debug('BOOTSTRAP: got node addr {} for exit net'.format(gw_cfg))
-                await config_network_object(client, gw_cfg, exit_net, node_id)
-                trie_nets = [net_id, exit_net]
-            else:
-                logger.error('BOOTSTRAP: malformed exit net data {}'.format(data_list))
-
-        await config_network_object(client, gw, net_id, node_id)
-        logger.debug('BOOTSTRAP: set gw addr {} for src net {}'.format(gw, net_id))
-
-        await update_mbr_data(client, ct.net_trie, net_id, node_id)
-        logger.debug('BOOTSTRAP: loaded net trie with {} and {} data'.format(node_id, net_id))
-
-        node_needs = [False, False]
-        net_needs = [False, True]
-        if not ex:
-            update_id_trie(ct.id_trie, [exit_net], [node_id, exit_node], needs=[False, False], nw=True)
-
-        update_id_trie(ct.id_trie, trie_nets, [node_id], needs=node_needs)
-        update_id_trie(ct.id_trie, [net_id], [node_id], needs=net_needs, nw=True)
-        # logger.debug('TRIE: id_trie has items: {}'.format(ct.id_trie.items()))
+    id_trie = get_id_draft()
+    if ex_nodes is None:
+        ex_nodes = [x for x in node_list if is_exit_node(x)]
+
+    # plan the new network and chain link for each node
+    link = None
+    data_list = find_dangling_nets(id_trie)
+    logger.debug('BOOTSTRAP: got exit net {}'.format(data_list))
+    if len(data_list) == 2:
+        netcfg = get_dangling_net_data(ct.net_trie, data_list[0])
+        link = AttrDict(net_id=data_list[0], node_id=data_list[1],
+                        host=set_network_cfg(netcfg.host), error=None)
+
+    plan = []
+    for node_id in sorted(node_list, key=lambda x: x not in ex_nodes):
+        mbr = AttrDict(node_id=node_id, ex=node_id in ex_nodes, link=None,
+                       net_id=None, joined=False, error=None)
+        if not mbr.ex:
+            mbr.link = link
+            if link is None:
+                mbr.error = 'no exit net'
+        if mbr.error is None:
+            try:
+                mbr.net_cfg, mbr.host, mbr.gw = handle_net_cfg(pool)
+                link = mbr
+            except IndexError:
+                mbr.error = 'subnet pool is full'
+        plan.append(mbr)
+
+    async def add_mbr_net(mbr):
+        worker = copy.copy(client)
+        await add_network_object(worker, ctlr_id=ctlr_id)
+        mbr.net_id = get_network_id(worker.data)
+        logger.debug('BOOTSTRAP: added network id {}'.format(mbr.net_id))
+        await config_network_object(worker, ct.rules, mbr.net_id)
+        await config_network_object(worker, mbr.net_cfg, mbr.net_id)
+        await add_network_object(worker, mbr.net_id, mbr.node_id)
+        await config_network_object(worker, mbr.gw, mbr.net_id, mbr.node_id)
+        logger.debug('BOOTSTRAP: set gw addr {} for src net {}'.format(mbr.gw, mbr.net_id))
+
+    async def link_mbr_net(mbr):
+        worker = copy.copy(client)
+        mbr.joined = True
+        await add_network_object(worker, mbr.link.net_id, mbr.node_id)
+        await config_network_object(worker, mbr.link.host, mbr.link.net_id, mbr.node_id)
+        logger.debug('BOOTSTRAP: added node id {} to exit net {}'.format(mbr.node_id,
+                                                                         mbr.link.net_id))
+
+    async def get_mbr_data(mbr):
+        mbr.net_data = await fetch_network_object_data(client, mbr.net_id)
+        mbr.mbr_data = await fetch_network_object_data(client, mbr.net_id, mbr.node_id)
+
+    async def del_mbr_net(mbr):
+        worker = copy.copy(client)
+        try:
+            if mbr.joined and mbr.link.error is None:
+                await delete_network_object(worker, mbr.link.net_id, mbr.node_id)
+            if mbr.net_id:
+                await delete_network_object(worker, mbr.net_id)
+        except Exception as exc:
+            logger.warning('BOOTSTRAP: cleanup for node {} failed: {}'.format(mbr.node_id, exc))
+
+    async def run_step(step, mbr):
+        try:
+            await step(mbr)
+        except Exception as exc:
+            mbr.error = exc
+
+    # the links need the new network IDs
+    await gather_with_limit([run_step(add_mbr_net, x) for x in plan if x.error is None])
+    await gather_with_limit([run_step(link_mbr_net, x) for x in plan
+                             if x.error is None and x.link is not None and x.link.error is None])
+    await gather_with_limit([run_step(get_mbr_data, x) for x in plan if x.error is None])
+
+    for mbr in plan:
+        if mbr.error is None and mbr.link is not None and mbr.link.error is not None:
+            mbr.error = 'exit net node {} failed'.format(mbr.link.node_id)
+        if mbr.error is not None:
+            logger.error('BOOTSTRAP: node {} failed: {}'.format(mbr.node_id, mbr.error))
+
+    failed = [x for x in plan if x.error is not None and (x.net_id or x.joined)]
+    await gather_with_limit([del_mbr_net(x) for x in failed])
+    for mbr in [x for x in plan if x.error is not None and 'net_cfg' in x]:
+        pool.release(get_route_netbase(mbr.net_cfg))
+
+    # update the tries in chain order
+    for mbr in [x for x in plan if x.error is None]:
+        ct.net_trie[mbr.net_id] = slim_trie_payload(mbr.net_data)
+        ct.net_trie[mbr.net_id + mbr.node_id] = slim_trie_payload(mbr.mbr_data)
+        logger.debug('BOOTSTRAP: loaded net trie with {} and {} data'.format(mbr.node_id,
+                                                                             mbr.net_id))
+        trie_nets = [mbr.net_id]
+        if not mbr.ex:
+            update_id_trie(id_trie, [mbr.link.net_id], [mbr.node_id, mbr.link.node_id],
+                           needs=[False, False], nw=True)
+            trie_nets.append(mbr.link.net_id)
+        update_id_trie(id_trie, trie_nets, [mbr.node_id], needs=[False, False])
+        update_id_trie(id_trie, [mbr.net_id], [mbr.node_id], needs=[False, True], nw=True)
+
+    return {x.node_id: x.error is None for x in plan}
 
 
 async def close_mbr_net(client, node_lst, boot_lst, min_nodes=5):
@@ -114,14 +188,17 @@ async def close_mbr_net(client, node_lst, boot_lst, min_nodes=5):
     from node_tools.trie_funcs import cleanup_state_tries
     from node_tools.trie_funcs import find_dangling_nets
     from node_tools.trie_funcs import find_exit_net
+    from node_tools.trie_funcs import get_id_draft
     from node_tools.trie_funcs import get_neighbor_ids
     from node_tools.trie_funcs import get_target_node_id
 
+    id_trie = get_id_draft()
+
     head_id = boot_lst[-1]
     tail_id = boot_lst[0]
-    head_exit_net = find_exit_net(ct.id_trie)[0]
+    head_exit_net = find_exit_net(id_trie)[0]
     head_src_net, _, _, _ = get_neighbor_ids(ct.net_trie, head_id)
-    tail_exit_net = find_dangling_nets(ct.id_trie)[0]
+    tail_exit_net = find_dangling_nets(id_trie)[0]
     deauth = unset_network_cfg()
 
     # if true, we only have a boot list
@@ -133,11 +210,11 @@ async def close_mbr_net(client, node_lst, boot_lst, min_nodes=5):
                 st.wait_cache.set(mbr_id, True, 90)
             # detach and connect head to tail
             await config_network_object(client, deauth, head_exit_net, head_id)
-            cleanup_state_tries(ct.net_trie, ct.id_trie, head_exit_net, head_id, mbr_only=True)
+            cleanup_state_tries(ct.net_trie, id_trie, head_exit_net, head_id, mbr_only=True)
             logger.debug('CLOSURE: deauthed head id {} from exit net {}'.format(head_id, head_exit_net))
 
             await connect_mbr_node(client, head_id, head_src_net, tail_exit_net, tail_id)
-            publish_cfg_msg(ct.id_trie, head_id, addr='127.0.0.1')
+            publish_cfg_msg(id_trie, head_id, addr='127.0.0.1')
         else:
             logger.debug('CLOSURE: not enough bootstrap nodes to wrap')
     else:
@@ -150,20 +227,20 @@ async def close_mbr_net(client, node_lst, boot_lst, min_nodes=5):
             st.wait_cache.set(mbr_id, True, 120)
         # detach and connect tgt to tail
         await config_network_object(client, deauth, tgt_exit_net, tgt_id)
-        cleanup_state_tries(ct.net_trie, ct.id_trie, tgt_exit_net, tgt_id, mbr_only=True)
+        cleanup_state_tries(ct.net_trie, id_trie, tgt_exit_net, tgt_id, mbr_only=True)
         logger.debug('CLOSURE: deauthed tgt id {} from tgt exit net {}'.format(tgt_id, tgt_exit_net))
 
         await connect_mbr_node(client, tgt_id, tgt_src_net, tail_exit_net, tail_id)
-        publish_cfg_msg(ct.id_trie, tgt_id, addr='127.0.0.1')
+        publish_cfg_msg(id_trie, tgt_id, addr='127.0.0.1')
 
         # detach and connect head to tgt exit net
         await config_network_object(client, deauth, head_exit_net, head_id)
-        cleanup_state_tries(ct.net_trie, ct.id_trie, head_exit_net, head_id, mbr_only=True)
+        cleanup_state_tries(ct.net_trie, id_trie, head_exit_net, head_id, mbr_only=True)
         logger.debug('CLOSURE: deauthed node id {} from head exit net {}'.format(head_id, head_exit_net))
 
         await connect_mbr_node(client, head_id, head_src_net, tgt_exit_net, tgt_exit_node)
         time.sleep(0.02)
-        publish_cfg_msg(ct.id_trie, head_id, addr='127.0.0.1')
+        publish_cfg_msg(id_trie, head_id, addr='127.0.0.1')
 
 
 async def cleanup_orphans(client):
@@ -177,23 +254,26 @@ async def cleanup_orphans(client):
 
     from node_tools.trie_funcs import cleanup_state_tries
     from node_tools.trie_funcs import find_orphans
+    from node_tools.trie_funcs import get_id_draft
+
+    id_trie = get_id_draft()
 
-    net_list, node_list = find_orphans(ct.net_trie, ct.id_trie)
+    net_list, node_list = find_orphans(ct.net_trie, id_trie)
     logger.debug('got net_list {} and node_list: {}'.format(net_list, node_list))
     if net_list:
         for thing in net_list:
             if isinstance(thing, str):
                 await delete_network_object(client, thing)
-                cleanup_state_tries(ct.net_trie, ct.id_trie, thing, None)
+                cleanup_state_tries(ct.net_trie, id_trie, thing, None)
                 logger.warning('CLEANUP: removed orphan: {}'.format(thing))
             elif isinstance(thing, tuple):
                 if st.wait_cache.get(thing[1]) is None:
                     await delete_network_object(client, thing[0])
-                    cleanup_state_tries(ct.net_trie, ct.id_trie, thing[0], thing[1])
+                    cleanup_state_tries(ct.net_trie, id_trie, thing[0], thing[1])
                     logger.warning('CLEANUP: removed orphan: {}'.format(thing))
     if node_list:
         for thing in node_list:
-            del ct.id_trie[thing]
+            del id_trie[thing]
             logger.warning('CLEANUP: removed orphan: {}'.format(thing))
 
 
@@ -212,8 +292,11 @@ async def connect_mbr_node(client, node_id, src_net, exit_net, gw_node):
 
     from node_tools.ctlr_funcs import set_network_cfg
     from node_tools.trie_funcs import get_dangling_net_data
+    from node_tools.trie_funcs import get_id_draft
     from node_tools.trie_funcs import update_id_trie
 
+    id_trie = get_id_draft()
+
     await add_network_object(client, exit_net, node_id)
     logger.debug('CONNECT: added neighbor {} to exit net {}'.format(node_id, exit_net))
     netcfg = get_dangling_net_data(ct.net_trie, exit_net)
@@ -221,10 +304,10 @@ async def connect_mbr_node(client, node_id, src_net, exit_net, gw_node):
     logger.debug('CONNECT: got cfg {} for exit net'.format(gw_cfg))
     await config_network_object(client, gw_cfg, exit_net, node_id)
     logger.debug('CONNECT: net_trie keys: {}'.format(list(ct.net_trie)))
-    logger.debug('CONNECT: id_trie keys: {}'.format(list(ct.id_trie)))
+    logger.debug('CONNECT: id_trie keys: {}'.format(list(id_trie)))
 
-    update_id_trie(ct.id_trie, [exit_net], [node_id, gw_node], needs=[False, False], nw=True)
-    update_id_trie(ct.id_trie, [src_net, exit_net], [node_id], needs=[False, False])
+    update_id_trie(id_trie, [exit_net], [node_id, gw_node], needs=[False, False], nw=True)
+    update_id_trie(id_trie, [src_net, exit_net], [node_id], needs=[False, False])
 
 
 async def offline_mbr_node(client, node_id):
@@ -242,8 +325,11 @@ async def offline_mbr_node(client, node_id):
     from node_tools.ctlr_funcs import unset_network_cfg
     from node_tools.network_funcs import publish_cfg_msg
     from node_tools.trie_funcs import cleanup_state_tries
+    from node_tools.trie_funcs import get_id_draft
     from node_tools.trie_funcs import get_neighbor_ids
 
+    id_trie = get_id_draft()
+
     try:
         node_net, exit_net, src_node, exit_node = get_neighbor_ids(ct.net_trie, node_id)
         node_nets = [node_net, exit_net]
@@ -263,21 +349,21 @@ async def offline_mbr_node(client, node_id):
         if src_node is None:
             if exit_net is not None:
                 await config_network_object(client, deauth, exit_net, node_id)
-                cleanup_state_tries(ct.net_trie, ct.id_trie, exit_net, node_id, mbr_only=True)
+                cleanup_state_tries(ct.net_trie, id_trie, exit_net, node_id, mbr_only=True)
                 logger.debug('OFFLINE: deauthed node id {} from exit net {}'.format(node_id, exit_net))
             await delete_network_object(client, node_net)
-            cleanup_state_tries(ct.net_trie, ct.id_trie, node_net, node_id)
+            cleanup_state_tries(ct.net_trie, id_trie, node_net, node_id)
             logger.debug('OFFLINE: removed dangling net {}'.format(node_net))
         else:
             await config_network_object(client, deauth, exit_net, node_id)
-            cleanup_state_tries(ct.net_trie, ct.id_trie, exit_net, node_id, mbr_only=True)
+            cleanup_state_tries(ct.net_trie, id_trie, exit_net, node_id, mbr_only=True)
             logger.debug('OFFLINE: deauthed node id {} from exit net {}'.format(node_id, exit_net))
             await delete_network_object(client, node_net)
-            cleanup_state_tries(ct.net_trie, ct.id_trie, node_net, node_id)
+            cleanup_state_tries(ct.net_trie, id_trie, node_net, node_id)
             logger.debug('OFFLINE: removed network id {} and node {}'.format(node_net, node_id))
 
             await connect_mbr_node(client, src_node, src_net, exit_net, exit_node)
-            publish_cfg_msg(ct.id_trie, src_node, addr='127.0.0.1')
+            publish_cfg_msg(id_trie, src_node, addr='127.0.0.1')
     else:
         logger.warning('OFFLINE: node {} has missing net list {}'.format(node_id, node_nets))
 
@@ -291,50 +377,123 @@ async def update_mbr_data(client, net_trie, net_id, mbr_id):
     :param net_id: network ID
     :param mbr_id: node ID
     """
+    from node_tools.trie_funcs import slim_trie_payload
 
     # get network data and load net trie
     await get_network_object_data(client, net_id)
     logger.debug('loading network: {}'.format(net_id))
-    net_trie[net_id] = client.data
+    net_trie[net_id] = slim_trie_payload(client.data)
 
     # get mbr data and load net trie
     await get_network_object_data(client, net_id, mbr_id)
     logger.debug('loading member: {}'.format(mbr_id))
-    net_trie[net_id + mbr_id] = client.data
+    net_trie[net_id + mbr_id] = slim_trie_payload(client.data)
 
 
 async def update_state_tries(client, net_trie, id_trie):
     """
     Wrapper to update ctlr state tries from ZT client API.  Loads net/id
-    tries with new data (does not remove any stale trie data).
+    tries with new data and prunes keys for networks/members that no
+    longer exist (or are no longer authorized).  Network data is only
+    fetched if the network is not in sync (all networks are refreshed
+    every NODE_SETTINGS['net_sync_cycles'] calls), and member data is
+    only fetched if the member revision has changed (or the member is
+    not in the net trie, eg, after a cold start).
+    :notes: API requests are made concurrently (see gather_with_limit)
+            and the trie updates are applied afterwards in network list
+            order.
     :param client: ztcli_api client object
     :param net_trie: zt network/member data
     :param id_trie: network/node state
     """
-    from node_tools.trie_funcs import load_id_trie
+    from node_tools import ctlr_data as ct
 
-    await get_network_object_ids(client)
-    logger.debug('{} networks found'.format(len(client.data)))
-    net_list = client.data
+    from node_tools.ctlr_funcs import release_net_subnet
+    from node_tools.ctlr_funcs import reserve_net_subnet
+    from node_tools.helper_funcs import NODE_SETTINGS
+    from node_tools.trie_funcs import load_id_trie
+    from node_tools.trie_funcs import slim_trie_payload
+
+    stale_nodes = set()
+    ct.sync_cycles += 1
+    if NODE_SETTINGS['net_sync_cycles'] and ct.sync_cycles >= NODE_SETTINGS['net_sync_cycles']:
+        logger.debug('refreshing data for all networks')
+        ct.synced_nets.clear()
+        ct.sync_cycles = 0
+
+    net_list = await fetch_network_object_ids(client)
+    logger.debug('{} networks found'.format(len(net_list)))
+    # get details about each changed network and all the member lists
+    new_nets = [x for x in net_list if not (x in ct.synced_nets and x in net_trie)]
+    results = await gather_with_limit([fetch_network_object_data(client, x) for x in new_nets] +
+                                      [fetch_network_object_ids(client, x) for x in net_list])
+    net_data = dict(zip(new_nets, results[:len(new_nets)]))
+    member_dicts = dict(zip(net_list, results[len(new_nets):]))
+
+    # get details about each changed network member
+    new_mbrs = []
+    for net_id in net_list:
+        for mbr_id, revision in member_dicts[net_id].items():
+            mbr_key = net_id + mbr_id
+            if mbr_key in net_trie and net_trie[mbr_key].get('revision') == revision:
+                continue
+            if ct.unauth_mbrs.get(mbr_key) == revision:
+                continue
+            new_mbrs.append(mbr_key)
+    results = await gather_with_limit([fetch_network_object_data(client, x[0:16], x[16:])
+                                       for x in new_mbrs])
+    mbr_data = {key: slim_trie_payload(data) for key, data in zip(new_mbrs, results)}
+
+    # update trie data
     for net_id in net_list:
         mbr_list = []
-        # get details about each network and update trie data
-        await get_network_object_data(client, net_id)
-        net_trie[net_id] = client.data
-        await get_network_object_ids(client, net_id)
-        logger.debug('network {} has {} possible member(s)'.format(net_id, len(client.data)))
-        member_dict = client.data
-        for mbr_id in member_dict.keys():
-            # get details about each network member and update trie data
-            await get_network_object_data(client, net_id, mbr_id)
-            if client.data['authorized']:
+        if net_id in net_data:
+            net_trie[net_id] = slim_trie_payload(net_data[net_id])
+            reserve_net_subnet(net_trie[net_id])
+            ct.synced_nets.add(net_id)
+        else:
+            logger.debug('network {} is unchanged'.format(net_id))
+        member_dict = member_dicts[net_id]
+        logger.debug('network {} has {} possible member(s)'.format(net_id, len(member_dict)))
+        for mbr_id, revision in member_dict.items():
+            mbr_key = net_id + mbr_id
+            if mbr_key in mbr_data:
+                data = mbr_data[mbr_key]
+            elif mbr_key in net_trie:
+                data = net_trie[mbr_key]
+            else:
+                continue
+            if data['authorized']:
                 logger.debug('adding member: {}'.format(mbr_id))
-                net_trie[net_id + mbr_id] = client.data
+                ct.unauth_mbrs.pop(mbr_key, None)
+                net_trie[mbr_key] = data
                 load_id_trie(net_trie, id_trie, [], [mbr_id])
                 mbr_list.append(mbr_id)
+            else:
+                ct.unauth_mbrs[mbr_key] = revision
+        for mbr_key in [x for x in net_trie.keys(net_id) if len(x) == 26]:
+            if mbr_key[16:] not in mbr_list:
+                logger.debug('pruning member key: {}'.format(mbr_key))
+                del net_trie[mbr_key]
+                stale_nodes.add(mbr_key[16:])
         load_id_trie(net_trie, id_trie, [net_id], mbr_list, nw=True)
         logger.debug('member key suffixes: {}'.format(net_trie.suffixes(net_id)))
 
+    net_set = set(net_list)
+    for net_id in [x for x in net_trie.keys() if len(x) == 16 and x not in net_set]:
+        logger.debug('pruning network: {}'.format(net_id))
+        release_net_subnet(net_trie[net_id])
+        for key in net_trie.keys(net_id):
+            del net_trie[key]
+            stale_nodes.add(key[16:])
+        if net_id in id_trie:
+            del id_trie[net_id]
+        ct.synced_nets.discard(net_id)
+    for mbr_key in [x for x in ct.unauth_mbrs if x[16:] not in member_dicts.get(x[0:16], {})]:
+        del ct.unauth_mbrs[mbr_key]
+    for node_id in [x for x in stale_nodes if x in id_trie]:
+        load_id_trie(net_trie, id_trie, [], [node_id])
+
 
 async def unwrap_mbr_net(client, node_lst, boot_lst, min_nodes=5):
     """
@@ -352,26 +511,29 @@ async def unwrap_mbr_net(client, node_lst, boot_lst, min_nodes=5):
     from node_tools.network_funcs import publish_cfg_msg
     from node_tools.trie_funcs import cleanup_state_tries
     from node_tools.trie_funcs import find_dangling_nets
+    from node_tools.trie_funcs import get_id_draft
     from node_tools.trie_funcs import get_neighbor_ids
     from node_tools.trie_funcs import get_target_node_id
 
+    id_trie = get_id_draft()
+
     if len(node_lst) < min_nodes and len(boot_lst) == 0:
         logger.debug('UNWRAP: creating bootstrap list from network {}'.format(node_lst))
         tgt_id = get_target_node_id(node_lst, boot_lst)
         tgt_net, tgt_exit_net, _, _ = get_neighbor_ids(ct.net_trie, tgt_id)
         # tgt_src_net, _, _, _ = get_neighbor_ids(ct.net_trie, tgt_src_node)
-        data_list = find_dangling_nets(ct.id_trie)
+        data_list = find_dangling_nets(id_trie)
         exit_net = data_list[0]
         exit_node = data_list[1]
         deauth = unset_network_cfg()
 
         # detach and connect tgt node back to exit node
         await config_network_object(client, deauth, tgt_exit_net, tgt_id)
-        cleanup_state_tries(ct.net_trie, ct.id_trie, tgt_exit_net, tgt_id, mbr_only=True)
+        cleanup_state_tries(ct.net_trie, id_trie, tgt_exit_net, tgt_id, mbr_only=True)
         logger.debug('UNWRAP: deauthed node id {} from tgt exit net {}'.format(tgt_id, tgt_exit_net))
 
         await connect_mbr_node(client, tgt_id, tgt_net, exit_net, exit_node)
-        publish_cfg_msg(ct.id_trie, tgt_id, addr='127.0.0.1')
+        publish_cfg_msg(id_trie, tgt_id, addr='127.0.0.1')
     else:
         logger.debug('UNWRAP: num nodes at least {} so not unwrapping'.format(min_nodes))
 
@@ -400,7 +562,85 @@ async def add_network_object(client, net_id=None, mbr_id=None, ctlr_id=None):
         logger.error('One or more required arguments not found!')
         return
 
-    await client.set_value(cfg_dict, endpoint)
+    await call_api(client, 'set_value', cfg_dict, endpoint)
+
+
+async def call_api(client, method, *args):
+    """
+    Make a ZT service API call with a deadline (NODE_SETTINGS['api_timeout'])
+    through the API circuit breaker; idempotent GETs are retried (up to
+    NODE_SETTINGS['api_retries'] times) with jittered exponential backoff
+    if they time out or cannot connect.  Calls and failures are counted
+    in `api_metrics`.
+    :param client: ztcli_api client object
+    :param method: client method, one of get_data|set_value|delete_thing
+    :param args: method args (the endpoint path is the last one)
+    :raises: ServiceUnavailableError if the breaker is open
+    """
+    import random
+
+    from node_tools.exceptions import ServiceUnavailableError
+    from node_tools.helper_funcs import NODE_SETTINGS
+
+    endpoint = args[-1]
+    retries = NODE_SETTINGS['api_retries'] if method == 'get_data' else 0
+    attempt = 0
+
+    while True:
+        if not api_breaker.allow():
+            api_metrics.count_call(method, 'rejected')
+            raise ServiceUnavailableError('API circuit is open, skipped {} {}'.format(method, endpoint))
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(getattr(client, method)(*args), NODE_SETTINGS['api_timeout'])
+        except Exception as exc:
+            transient = is_transient_error(exc)
+            if isinstance(exc, asyncio.TimeoutError):
+                api_metrics.count_call(method, 'timeout', time.perf_counter() - start)
+            else:
+                api_metrics.count_call(method, 'error', time.perf_counter() - start)
+            if not transient:
+                # not a timeout or connection error, so the service is up
+                api_breaker.record_success()
+                raise
+            api_breaker.record_failure()
+            if attempt >= retries:
+                raise
+            attempt += 1
+            delay = random.uniform(0, NODE_SETTINGS['api_backoff'] * 2 ** attempt)
+            api_metrics.count_retry(method)
+            logger.warning('API {} {} failed ({}), retry {} in {:.2f} sec'.format(
+                method, endpoint, type(exc).__name__, attempt, delay))
+            await asyncio.sleep(delay)
+        else:
+            api_metrics.count_call(method, 'ok', time.perf_counter() - start)
+            api_breaker.record_success()
+            return
+
+
+def close_api_pool():
+    """
+    Close the shared API session at exit (from sync code, eg, the fpnd
+    cleanup); the session is closed on its own loop if that loop is not
+    closed (or running), otherwise it is just dropped.
+    """
+    loop = api_pool.loop
+    if api_pool.session is not None and loop is not None:
+        if not (loop.is_closed() or loop.is_running()):
+            loop.run_until_complete(close_api_session())
+    api_pool.session = None
+    api_pool.loop = None
+
+
+async def close_api_session():
+    """
+    Close the shared API session (if it belongs to the running loop).
+    """
+    session = api_pool.session
+    if session is not None and not session.closed and api_pool.loop is asyncio.get_event_loop():
+        await session.close()
+    api_pool.session = None
+    api_pool.loop = None
 
 
 async def config_network_object(client, cfg_dict, net_id, mbr_id=None):
@@ -415,6 +655,8 @@ async def config_network_object(client, cfg_dict, net_id, mbr_id=None):
     :param net_id: network ID endpoint path
     :param mbr_id: member ID endpoint path
     """
+    from node_tools import ctlr_data as ct
+
     if mbr_id and net_id:
         endpoint = 'controller/network/{}/member/{}'.format(net_id, mbr_id)
     elif net_id:
@@ -423,7 +665,9 @@ async def config_network_object(client, cfg_dict, net_id, mbr_id=None):
         logger.error('One or more required arguments not found!')
         return
 
-    await client.set_value(cfg_dict, endpoint)
+    await call_api(client, 'set_value', cfg_dict, endpoint)
+    if not mbr_id:
+        ct.synced_nets.discard(net_id)
 
 
 async def delete_network_object(client, net_id, mbr_id=None):
@@ -437,6 +681,8 @@ async def delete_network_object(client, net_id, mbr_id=None):
     :param net_id: network ID endpoint path
     :param mbr_id: member ID endpoint path
     """
+    from node_tools import ctlr_data as ct
+
     if mbr_id and net_id:
         endpoint = 'controller/network/{}/member/{}'.format(net_id, mbr_id)
     elif net_id:
@@ -445,7 +691,133 @@ async def delete_network_object(client, net_id, mbr_id=None):
         logger.error('One or more required arguments not found!')
         return
 
-    await client.delete_thing(endpoint)
+    await call_api(client, 'delete_thing', endpoint)
+    if not mbr_id:
+        ct.synced_nets.discard(net_id)
+
+
+async def fetch_endpoint_data(client, endpoint):
+    """
+    Return-value version of `client.get_data`; the request is made with
+    a shallow copy of the client (sharing its session) so concurrent
+    requests do not overwrite each other's `client.data`.
+    :param client: ztcli_api client object
+    :param endpoint: API endpoint path
+    :return: endpoint data
+    """
+    import copy
+
+    worker = copy.copy(client)
+    await call_api(worker, 'get_data', endpoint)
+    return worker.data
+
+
+async def fetch_network_object_data(client, net_id, mbr_id=None):
+    """
+    Return-value version of `get_network_object_data`.
+    :param client: ztcli_api client object
+    :param net_id: network ID endpoint path
+    :param mbr_id: member ID endpoint path
+    :return: network or member data
+    """
+    if mbr_id and net_id:
+        endpoint = 'controller/network/{}/member/{}'.format(net_id, mbr_id)
+    elif net_id:
+        endpoint = 'controller/network/{}'.format(net_id)
+    else:
+        logger.error('One or more required arguments not found!')
+        return
+
+    return await fetch_endpoint_data(client, endpoint)
+
+
+async def fetch_network_object_ids(client, net_id=None):
+    """
+    Return-value version of `get_network_object_ids`.
+    :param client: ztcli_api client object
+    :param net_id: network ID endpoint path
+    :return: list of network IDs or dict of member IDs and revisions
+    """
+    if net_id:
+        endpoint = 'controller/network/{}/member'.format(net_id)
+    else:
+        endpoint = 'controller/network'
+
+    return await fetch_endpoint_data(client, endpoint)
+
+
+async def gather_with_limit(aws, limit=None):
+    """
+    Run awaitables concurrently, with at most `limit` running at once.
+    :param aws: list of awaitables (eg, fetch_* coroutines)
+    :param limit: max concurrency (default is NODE_SETTINGS['max_api_conns'])
+    :return: list of results (in the same order as `aws`)
+    """
+    from node_tools.helper_funcs import NODE_SETTINGS
+
+    if limit is None:
+        limit = NODE_SETTINGS['max_api_conns']
+    sem = asyncio.Semaphore(limit)
+
+    async def run_limited(aw):
+        async with sem:
+            return await aw
+
+    return await asyncio.gather(*[run_limited(aw) for aw in aws])
+
+
+async def get_api_client(token=None):
+    """
+    Get a ztcli_api client for the local ZT service that uses the shared
+    (keep-alive) API session.
+    :param token: ZT auth token (default is the token from get_token)
+    :return: ztcli_api client object
+    """
+    from ztcli_api import ZeroTier
+
+    from node_tools.helper_funcs import get_token
+
+    session = await get_api_session()
+    return ZeroTier(token or get_token(), asyncio.get_event_loop(), session)
+
+
+def get_api_metrics():
+    """
+    Get a snapshot of the API metrics, ie, the call counters, circuit
+    breaker state and session/connection counters.
+    :return: metrics dictionary (JSON serializable)
+    """
+    metrics = api_metrics.snapshot()
+    metrics['breaker'] = api_breaker.snapshot()
+    metrics['session'] = api_pool.snapshot()
+    return metrics
+
+
+async def get_api_session():
+    """
+    Get the shared API session (connection pool) for the running loop,
+    opening a new one on first use (or if the loop has changed).
+    :return: aiohttp ClientSession
+    """
+    loop = asyncio.get_event_loop()
+    session = api_pool.session
+    if session is None or session.closed or api_pool.loop is not loop:
+        if session is not None and not session.closed:
+            logger.debug('Dropping API session from old event loop')
+        api_pool.open_session(loop)
+    return api_pool.session
+
+
+async def get_full_object_data(client, trie_key):
+    """
+    Get the full ZT network/member object for a net trie key (the net
+    trie only holds the slim payload), eg, for debugging.
+    :param client: ztcli_api client object
+    :param trie_key: net trie key (network ID or network + member ID)
+    :return: ZT network/member object
+    """
+    await get_network_object_data(client, trie_key[0:16], trie_key[16:] or None)
+    return client.data
 
 
 async def get_network_object_data(client, net_id, mbr_id=None):
@@ -467,7 +839,7 @@ async def get_network_object_data(client, net_id, mbr_id=None):
         logger.error('One or more required arguments not found!')
         return
 
-    await client.get_data(endpoint)
+    await call_api(client, 'get_data', endpoint)
 
 
 async def get_network_object_ids(client, net_id=None):
@@ -484,4 +856,190 @@ async def get_network_object_ids(client, net_id=None):
     else:
         endpoint = 'controller/network'
 
-    await client.get_data(endpoint)
+    await call_api(client, 'get_data', endpoint)
+
+
+def is_transient_error(exc):
+    """
+    Check if an API call exception is transient, ie, a timeout or
+    connection error (worth a retry, and counted by the breaker).
+    :param exc: exception
+    """
+    if isinstance(exc, (asyncio.TimeoutError, aiohttp.ClientError, OSError)):
+        return True
+    try:
+        from ztcli_api import ZeroTierConnectionError
+    except ImportError:
+        return False
+    return isinstance(exc, ZeroTierConnectionError)
+
+
+class ApiCallMetrics(object):
+    """
+    API call counters per client method; results (ok, error, timeout or
+    rejected by the breaker), retries and latency.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.methods = {}
+
+    def get_counters(self, method):
+        if method not in self.methods:
+            self.methods[method] = {'ok': 0, 'error': 0, 'timeout': 0, 'rejected': 0,
+                                    'retries': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        return self.methods[method]
+
+    def count_call(self, method, result, secs=0.0):
+        counters = self.get_counters(method)
+        counters[result] += 1
+        counters['latency_total'] += secs
+        counters['latency_max'] = max(counters['latency_max'], secs)
+
+    def count_retry(self, method):
+        self.get_counters(method)['retries'] += 1
+
+    def snapshot(self):
+        calls = {}
+        for method, counters in self.methods.items():
+            timed = counters['ok'] + counters['error'] + counters['timeout']
+            mean = counters['latency_total'] / timed if timed else 0.0
+            calls[method] = {key: counters[key] for key in ['ok', 'error', 'timeout',
+                                                            'rejected', 'retries']}
+            calls[method]['latency_sec'] = {'mean': round(mean, 6),
+                                            'max': round(counters['latency_max'], 6)}
+        return {'calls': calls}
+
+
+class ApiSessionPool(object):
+    """
+    Shared keep-alive client session for the local ZT service API, with
+    request counters (collected via aiohttp request tracing); the
+    connection limit, keep-alive and (per request) timeout come from
+    NODE_SETTINGS.  The session belongs to the loop it was opened on.
+    """
+    def __init__(self):
+        self.session = None
+        self.loop = None
+        self.reset()
+
+    def reset(self):
+        self.sessions = 0
+        self.requests = 0
+        self.errors = 0
+        self.conns_created = 0
+        self.conns_reused = 0
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+        self.latency_total = 0.0
+
+    def count_request(self, secs, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.latency_last = secs
+        self.latency_max = max(self.latency_max, secs)
+        self.latency_total += secs
+
+    def open_session(self, loop):
+        from node_tools.helper_funcs import NODE_SETTINGS
+
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(self.on_request_start)
+        trace.on_request_end.append(self.on_request_end)
+        trace.on_request_exception.append(self.on_request_exception)
+        trace.on_connection_create_end.append(self.on_connection_create_end)
+        trace.on_connection_reuseconn.append(self.on_connection_reuseconn)
+
+        connector = aiohttp.TCPConnector(limit=NODE_SETTINGS['max_api_conns'],
+                                         keepalive_timeout=NODE_SETTINGS['api_keepalive'])
+        timeout = aiohttp.ClientTimeout(total=NODE_SETTINGS['api_timeout'])
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=timeout,
+                                             trace_configs=[trace])
+        self.loop = loop
+        self.sessions += 1
+
+    async def on_request_start(self, session, ctx, params):
+        ctx.start = time.perf_counter()
+
+    async def on_request_end(self, session, ctx, params):
+        self.count_request(time.perf_counter() - ctx.start)
+
+    async def on_request_exception(self, session, ctx, params):
+        self.count_request(time.perf_counter() - ctx.start, error=True)
+
+    async def on_connection_create_end(self, session, ctx, params):
+        self.conns_created += 1
+
+    async def on_connection_reuseconn(self, session, ctx, params):
+        self.conns_reused += 1
+
+    def snapshot(self):
+        mean = self.latency_total / self.requests if self.requests else 0.0
+        return {'sessions': self.sessions,
+                'requests': self.requests,
+                'errors': self.errors,
+                'connections': {'created': self.conns_created,
+                                'reused': self.conns_reused},
+                'latency_sec': {'last': round(self.latency_last, 6),
+                                'mean': round(mean, 6),
+                                'max': round(self.latency_max, 6)}}
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for the local ZT service API.  Opens after
+    NODE_SETTINGS['api_breaker_max'] consecutive (transient) failures;
+    while open, calls are rejected until NODE_SETTINGS['api_breaker_reset']
+    seconds have passed, then one trial call is let through (per reset
+    period).  Any successful call closes it again.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        return 'closed' if self.opened_at is None else 'open'
+
+    def allow(self):
+        from node_tools.helper_funcs import NODE_SETTINGS
+
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= NODE_SETTINGS['api_breaker_reset']:
+            self.opened_at = time.monotonic()
+            logger.debug('API circuit is open, trying one call')
+            return True
+        return False
+
+    def record_failure(self):
+        from node_tools.helper_funcs import NODE_SETTINGS
+
+        self.failures += 1
+        if self.opened_at is None and self.failures >= NODE_SETTINGS['api_breaker_max']:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            logger.error('API circuit opened after {} failures'.format(self.failures))
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info('API circuit closed')
+        self.failures = 0
+        self.opened_at = None
+
+    def snapshot(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips}
+
+
+api_breaker = CircuitBreaker()  # shared API circuit breaker (see call_api)
+api_metrics = ApiCallMetrics()  # shared API call counters (see get_api_metrics)
+api_pool = ApiSessionPool()  # shared API session and counters (see get_api_session)
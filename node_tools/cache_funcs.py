@@ -1,18 +1,137 @@
 # coding: utf-8
 
 """cache-specific helper functions."""
+import heapq
 import logging
-import ipaddress
 
 from collections import namedtuple
+from contextlib import contextmanager
 
-from node_tools.helper_funcs import AttrDict
+from node_tools.helper_funcs import AttrView
 from node_tools.helper_funcs import NODE_SETTINGS
-from node_tools.helper_funcs import find_ipv4_iface
+from node_tools.helper_funcs import get_cachedir
+from node_tools.helper_funcs import get_runtimedir
+from node_tools.helper_funcs import get_addr_cache_info
+from node_tools.helper_funcs import json_dump_file
+from node_tools.helper_funcs import parse_ipv4_iface
+from node_tools.helper_funcs import parse_path_addr
+from node_tools.helper_funcs import state_runners
 
 
 logger = logging.getLogger(__name__)
 
+KEY_TYPES = ('node', 'peer', 'moon', 'net', 'mbr', 'nstate', 'mstate', 'istate')
+
+STATE_TYPES = ('nstate', 'mstate', 'istate')
+
+QUEUE_NAMES = ('cfg_queue', 'clean_queue', 'hold_queue', 'net_queue', 'node_queue',
+               'off_queue', 'pub_queue', 'reg_queue', 'staging_queue', 'tmp_queue',
+               'wait_queue', 'wedge_queue')  # Deque dir names
+
+CACHE_VERSION = 1  # version of the cache record format (0 is AttrDict payloads)
+
+GEN_KEY = 'cache-gen'  # meta cache key for the write generation counter (see save_key_index)
+
+STAMPS_KEY = 'cache-stamps'  # meta cache key for the per-entry write times (see save_key_index)
+
+key_index = {}  # KeyIndex objects by cache directory (see get_key_index)
+
+meta_caches = {}  # meta Cache objects by cache directory (see get_meta_cache)
+
+txn_depth = {}  # open metered_transact() calls by cache directory
+
+cycle_caches = {}  # active WriteBackIndex objects by directory (see begin_cache_cycle)
+
+
+class CacheRecord(object):
+    """
+    Base class for the cache record namedtuples; records are pickled
+    with the CACHE_VERSION they were written with and their fields by
+    name (see load_cache_record), so records in an older format can be
+    detected and migrated on load.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        return (load_cache_record, (type(self).__name__, CACHE_VERSION, dict(zip(self._fields, self))))
+
+
+class NodeRecord(CacheRecord, namedtuple('NodeRecord', ['address', 'online', 'tcpFallbackActive',
+                                                        'planetWorldId'])):
+    """Compact 'status' endpoint record (fields used by get_node_status)."""
+    __slots__ = ()
+
+
+class PathRecord(CacheRecord, namedtuple('PathRecord', ['address', 'active'])):
+    """Compact peer path record (fields used by get_peer_status)."""
+    __slots__ = ()
+
+
+class PeerRecord(CacheRecord, namedtuple('PeerRecord', ['address', 'role', 'paths'])):
+    """Compact 'peer' endpoint record; `paths` is a tuple of PathRecords."""
+    __slots__ = ()
+
+
+class NetRecord(CacheRecord, namedtuple('NetRecord', ['id', 'status', 'mac', 'portDeviceName',
+                                                      'assignedAddresses', 'route_via'])):
+    """
+    Compact 'network' endpoint record (fields used by get_net_status);
+    `route_via` is a tuple of the `via` values from the routes list.
+    """
+    __slots__ = ()
+
+
+class NodeStatus(CacheRecord, namedtuple('NodeStatus', ['identity', 'status', 'tcpFallback', 'worldId'])):
+    """Node state record ('nstate' key type)."""
+    __slots__ = ()
+
+
+class PeerStatus(CacheRecord, namedtuple('PeerStatus', ['identity', 'role', 'active', 'address', 'port'])):
+    """Peer state record ('mstate' key type)."""
+    __slots__ = ()
+
+
+class NetStatus(CacheRecord, namedtuple('NetStatus', ['identity', 'status', 'mac', 'ztdevice',
+                                                      'ztaddress', 'gateway'])):
+    """Network state record ('istate' key type)."""
+    __slots__ = ()
+
+
+RECORD_TYPES = {
+    'node': NodeRecord,
+    'peer': PeerRecord,
+    'net': NetRecord,
+    'nstate': NodeStatus,
+    'mstate': PeerStatus,
+    'istate': NetStatus,
+}
+
+RECORD_NAMES = {record_type.__name__: record_type
+                for record_type in list(RECORD_TYPES.values()) + [PathRecord]}
+
+
+def begin_cache_cycle(cache, mode=None):
+    """
+    Start an update cycle for ``cache``; depending on the cache mode,
+    open an in-process overlay that absorbs cache reads/writes until
+    end_cache_cycle() is called.
+    :param cache: Index <cache> object
+    :param mode: one of ['direct'|'write-back'|'write-through'], default
+                 is NODE_SETTINGS['cache_mode']
+    :return: the cache object to use for this cycle
+    """
+    if mode is None:
+        mode = NODE_SETTINGS['cache_mode']
+    if mode not in ('write-back', 'write-through'):
+        return cache
+
+    overlay = cycle_caches.get(cache.directory)
+    if overlay is None:
+        overlay = WriteBackIndex(cache, write_through=(mode == 'write-through'))
+        cycle_caches[cache.directory] = overlay
+        logger.debug('Opened {} cache overlay for: {}'.format(mode, cache.directory))
+    return overlay
+
 
 def create_cache_entry(cache, data, key_str):
     """
@@ -23,10 +142,13 @@ def create_cache_entry(cache, data, key_str):
                     ['node'|'peer'|'net'|'mbr'|'moon'] or
                     ['nstate'|'mstate'|'istate']
     """
-    new_data = AttrDict.from_nested_dict(data)
+    new_data = pack_cache_entry(data, key_str)
     logger.debug('Pushing entry for: {}'.format(key_str))
-    with cache.transact():
+    with metered_transact(cache):
+        index = get_key_index(cache)
         key = cache.push(new_data, prefix=key_str)
+        index.add(key)
+        cache_metrics.count_writes()
     logger.debug('New key created for: {}'.format(key))
 
 
@@ -42,21 +164,85 @@ def delete_cache_entry(cache, key_str):
     if key_list:
         for key in key_list:
             logger.debug('Deleting entry for: {}'.format(key))
-            with cache.transact():
+            with metered_transact(cache):
+                index = get_key_index(cache)
                 del cache[key]
+                index.discard(key)
+                cache_metrics.count_writes()
         logger.debug('Deleted cache items matching: {}'.format(key_str))
     else:
         logger.warning('No matching keys found for: {}'.format(key_str))
 
 
+def end_cache_cycle(cache):
+    """
+    End the update cycle for ``cache``; flush and close the overlay (if
+    one is open) and save the key index write times.
+    :param cache: Index <cache> object
+    :return: number of flushed changes
+    """
+    overlay = cycle_caches.pop(cache.directory, None)
+    count = 0 if overlay is None else overlay.flush()
+    save_key_stamps(cache)
+    return count
+
+
+def expire_cache_entries(cache, key_types):
+    """
+    Evict stale entries for one or more key types; entries are stale
+    if they were not written (or refreshed) for longer than the cache
+    age for their type.  If NODE_SETTINGS['max_peer_entries'] is set,
+    peer entries are also capped at that size, least recently written
+    first.
+    :param cache: Index <cache> object
+    :param key_types: list of key types
+    :return: list of evicted keys
+    """
+    import time
+
+    now = time.time()
+    max_peers = NODE_SETTINGS['max_peer_entries']
+    evicted = []
+    with metered_transact(cache):
+        index = get_key_index(cache)
+        for key_type in key_types:
+            max_age = get_cache_ttl(key_type)
+            stamps = index.stamps[key_type]
+            stale = []
+            for key, stamp in stamps.items():
+                if now - stamp <= max_age:
+                    break
+                stale.append(key)
+            if key_type == 'peer' and max_peers:
+                extra = len(stamps) - len(stale) - max_peers
+                if extra > 0:
+                    stale = list(stamps)[:len(stale) + extra]
+            for key in stale:
+                if key in cache:
+                    del cache[key]
+                index.discard(key)
+            evicted.extend(stale)
+        cache_metrics.count_writes(len(evicted))
+    if evicted:
+        logger.debug('Evicted {} stale cache entries: {}'.format(len(evicted), evicted))
+    return evicted
+
+
 def find_keys(cache, key_str):
-    """Find API key(s) in cache using key type string, return list of keys."""
-    valid_strings = ['node', 'peer', 'moon', 'net', 'mbr', 'nstate', 'mstate', 'istate']
-    match_list = [key for key in valid_strings if key_str in key]
+    """
+    Find API key(s) in cache using key type string, return list of keys.
+    :notes: Uses the per-type key index, so the cost is proportional to
+            the number of matching entries (not the size of the cache).
+    :param cache: Index <cache> object
+    :param key_str: key type string, or a substring matching several
+                    key types, eg, 'state'
+    :return: list of keys in cache insertion order, or None
+    """
+    match_list = [key for key in KEY_TYPES if key_str in key]
     if not match_list:
         logger.debug('Key type {} not valid'.format(key_str))
         return None
-    key_list = [key for key in list(cache) if key_str in key]
+    key_list = get_key_index(cache).get_keys(match_list)
     if not key_list:
         logger.debug('Key type {} not in cache'.format(key_str))
         return None
@@ -64,9 +250,80 @@ def find_keys(cache, key_str):
         return key_list
 
 
+def get_cache_metrics(cache, queues=QUEUE_NAMES):
+    """
+    Get a snapshot of the cache metrics, ie, the counters in
+    `cache_metrics` plus entry counts and disk usage for the cache and
+    the message queues (and the ZT service API and state runner metrics).
+    :param cache: Index <cache> object
+    :param queues: list of Deque directory names
+    :return: metrics dictionary (JSON serializable)
+    """
+    import os
+    import sqlite3
+    import datetime
+
+    from node_tools.async_funcs import get_api_metrics
+
+    index = get_key_index(cache)
+    disk_cache = getattr(cache, 'index', cache)
+    metrics = cache_metrics.snapshot()
+    metrics['time'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    metrics['cache'] = {'directory': cache.directory,
+                        'entries': len(index),
+                        'bytes': disk_cache.cache.volume(),
+                        'types': {key_type: len(keys) for key_type, keys in index.types.items()}}
+    metrics['addr_cache'] = get_addr_cache_info()
+    metrics['api'] = get_api_metrics()
+    metrics['runners'] = {scr: runner.snapshot() for scr, runner in state_runners.items()}
+    metrics['queues'] = {}
+    for name in queues:
+        directory = get_cachedir(name)
+        if os.path.isdir(directory):
+            try:
+                info = get_queue_info(directory)
+            except sqlite3.Error as exc:
+                logger.debug('No metrics for queue {}: {}'.format(name, exc))
+            else:
+                info.update(cache_metrics.get_queue_reads(name))
+                metrics['queues'][name] = info
+    return metrics
+
+
+def get_cache_ttl(key_type):
+    """
+    Get the maximum cache age for a key type (in seconds).
+    :param key_type: cache key type, eg, 'peer'
+    """
+    return NODE_SETTINGS['cache_ttls'].get(key_type, NODE_SETTINGS['max_cache_age'])
+
+
+def get_content_digest(data):
+    """
+    Get a content hash for a (JSON) payload dictionary or cache record.
+    :param data: payload data in a dictionary (or a record)
+    :return: <str> hex digest
+    """
+    import json
+    import hashlib
+
+    blob = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(blob).hexdigest()
+
+
+def get_cycle_cache(cache):
+    """
+    Get the cache object for the current update cycle, ie, the open
+    overlay for the ``cache`` directory, or ``cache`` itself.
+    :param cache: Index <cache> object
+    """
+    return cycle_caches.get(cache.directory, cache)
+
+
 def get_endpoint_data(cache, key_str):
     """
     Get all data for key type from cache (can be endpoint or state).
+    :notes: Wrapper for iter_endpoint_data() that returns lists.
     :param cache: Index <cache> object
     :param key_str: desired 'key_str', one of
                     ['node'|'peer'|'net'|'mbr'|'moon'] or
@@ -74,20 +331,107 @@ def get_endpoint_data(cache, key_str):
     :return tuple: (list of [keys], list of [values])
     """
     logger.debug('Entering get_endpoint_data with key_str: {}'.format(key_str))
+    key_list = []
     values = []
-    key_list = find_keys(cache, key_str)
-    if key_list:
-        for key in key_list:
-            with cache.transact():
-                data = cache[key]
-            values.append(data)
-            logger.debug('Appending data for key: {}'.format(key))
-    else:
-        key_list = []
+    for key, data in iter_endpoint_data(cache, key_str):
+        key_list.append(key)
+        values.append(data)
     logger.debug('Leaving get_endpoint_data with key_str: {}'.format(key_str))
     return (key_list, values)
 
 
+def get_data_id(data, tgt):
+    """
+    Get the ID field value from payload data or a cache record.
+    :param data: payload data in a dictionary (or a record)
+    :param tgt: ID field name (see get_id_field)
+    :return: ID value or None
+    """
+    if isinstance(data, dict):
+        return data.get(tgt)
+    return getattr(data, tgt, None)
+
+
+def get_id_field(key_str):
+    """
+    Get the name of the ID field in the payload for a given key type.
+    :param key_str: key type string or cache key
+    :return: <str> payload field name
+    """
+    key_type = key_str.rstrip('-0123456789')
+    if 'state' in key_type:
+        return 'identity'
+    elif key_type in ('net', 'moon'):
+        return 'id'
+    return 'address'
+
+
+def get_key_index(cache):
+    """
+    Get the key index for ``cache``, (re)building it with a single scan
+    of the cache keys if it is missing or out of sync.  The sync check
+    is the write generation counter in the meta cache (bumped by
+    save_key_index, so entries replaced or evicted by another process
+    are seen) plus the cache item count (for keys written directly).
+    On rebuild, entries keep their write times from the old index, or
+    get their saved write times (see save_key_stamps), or the cache
+    timestamp if they have neither.
+    :param cache: Index <cache> object
+    :return: <KeyIndex> for the cache directory
+    """
+    index = old = key_index.get(cache.directory)
+    meta = get_meta_cache(cache)
+    gen = meta.get(GEN_KEY, 0)
+    if index is None or index.gen != gen or len(index) != len(cache):
+        logger.debug('Building key index for: {}'.format(cache.directory))
+        index = KeyIndex()
+        index.gen = gen
+        utc_stamp = cache.get('utc-time')
+        stamp = utc_stamp.timestamp() if utc_stamp else None
+        saved = meta.get(STAMPS_KEY) or {}
+        if old is not None:
+            for key_type, stamps in old.stamps.items():
+                saved.setdefault(key_type, {}).update(stamps)
+        for key in list(cache):
+            index.add(key, saved.get(get_key_type(key), {}).get(key, stamp))
+        for key_type, stamps in index.stamps.items():
+            index.stamps[key_type] = dict(sorted(stamps.items(), key=lambda item: item[1]))
+        index.changed = False
+        index.stamps_changed = old is not None and old.stamps_changed
+        key_index[cache.directory] = index
+    return index
+
+
+def get_key_type(key):
+    """
+    Get the key type prefix from a cache key.
+    :param key: cache key, eg, 'peer-500000000000001'
+    :return: key type string or None if not a valid API key
+    """
+    key_type = str(key).rstrip('-0123456789')
+    if key_type in KEY_TYPES:
+        return key_type
+    return None
+
+
+def get_meta_cache(cache):
+    """
+    Get the meta cache for ``cache``, ie, a diskcache Cache in the
+    'meta' subdirectory of the cache directory, for the key index
+    bookkeeping (so it is not stored in the Index itself).
+    :param cache: Index <cache> object
+    :return: <Cache> for the cache directory
+    """
+    import os
+
+    from diskcache import Cache
+
+    meta = meta_caches.get(cache.directory)
+    if meta is None:
+        meta = meta_caches[cache.directory] = Cache(os.path.join(cache.directory, 'meta'))
+    return meta
+
+
 def get_net_status(cache):
     """
     Get user node status data for 'network' endpoint from cache, return
@@ -95,27 +439,26 @@ def get_net_status(cache):
     NOTE: Not valid for networks under the 'controller' endpoint.
     """
     networks = []  # list of network objects
-    key_list, values = get_endpoint_data(cache, 'net')
-    if key_list:
-        for key, data in zip(key_list, values):
-            # we need to check for missing route list here
-            if data.routes:
-                for addr in data.assignedAddresses:
-                    if find_ipv4_iface(addr, False):
-                        zt_addr = find_ipv4_iface(addr)
-                        break
-                netStatus = {'identity': data.id,
-                             'status': data.status,
-                             'mac': data.mac,
-                             'ztdevice': data.portDeviceName,
-                             'ztaddress': zt_addr,
-                             'gateway': data.routes[1]['via']}
-            else:
-                netStatus = {'identity': data.id,
-                             'status': data.status,
-                             'mac': data.mac,
-                             'ztdevice': data.portDeviceName}
-            networks.append(netStatus)
+    for key, data in iter_endpoint_data(cache, 'net'):
+        # we need to check for missing route list here
+        if data.route_via:
+            for addr in data.assignedAddresses:
+                zt_addr = parse_ipv4_iface(addr)
+                if zt_addr is not None:
+                    break
+            netStatus = {'identity': data.id,
+                         'status': data.status,
+                         'mac': data.mac,
+                         'ztdevice': data.portDeviceName,
+                         'ztaddress': zt_addr,
+                         'gateway': data.route_via[1]}
+        else:
+            netStatus = {'identity': data.id,
+                         'status': data.status,
+                         'mac': data.mac,
+                         'ztdevice': data.portDeviceName}
+        networks.append(netStatus)
+    if networks:
         logger.debug('netStatus list: {}'.format(networks))
     return networks
 
@@ -125,15 +468,14 @@ def get_node_status(cache):
     Get data for 'status' endpoint from cache, return a dict.
     """
     nodeStatus = {}
-    key_list, values = get_endpoint_data(cache, 'node')
-    if values:
-        d = values[0]
+    for key, d in iter_endpoint_data(cache, 'node'):
         status = 'ONLINE' if d.online else 'OFFLINE'
         nodeStatus = {'identity': d.address,
                       'status': status,
                       'tcpFallback': d.tcpFallbackActive,
                       'worldId': d.planetWorldId}
         logger.debug('nodeStatus dict: {}'.format(nodeStatus))
+        break
     return nodeStatus
 
 
@@ -143,65 +485,107 @@ def get_peer_status(cache):
     list of dictionaries.
     """
     peers = []  # list of peer objects
-    key_list, values = get_endpoint_data(cache, 'peer')
-    if key_list:
-        for key, data in zip(key_list, values):
-            # fix for bad LEAF nodes with empty paths (see fpnd issue #27)
-            if data.paths != []:
-                for path in data.paths:
-                    addr = path['address'].split('/', maxsplit=1)
-                    try:
-                        addr_obj = ipaddress.ip_address(addr[0])
-                    except ValueError as exc:
-                        logger.error('ipaddress exception: {}'.format(exc))
-                    # filter out IPv6 addresses for now
-                    if addr_obj.version == 4:
-                        peerStatus = {'identity': data.address,
-                                      'role': data.role,
-                                      'active': path['active'],
-                                      'address': addr[0],
-                                      'port': addr[1]}
-                        peers.append(peerStatus)
+    for key, data in iter_endpoint_data(cache, 'peer'):
+        # fix for bad LEAF nodes with empty paths (see fpnd issue #27)
+        if data.paths:
+            for path in data.paths:
+                # filter out IPv6 addresses for now
+                addr = parse_path_addr(path.address)
+                if addr is not None:
+                    peerStatus = {'identity': data.address,
+                                  'role': data.role,
+                                  'active': path.active,
+                                  'address': addr[0],
+                                  'port': addr[1]}
+                    peers.append(peerStatus)
+    if peers:
         logger.debug('peerStatus list: {}'.format(peers))
     return peers
 
 
-def get_state(cache):
+def get_queue_info(directory):
+    """
+    Get the entry count and disk usage for a Deque directory.  The
+    values are read from the Deque settings with a read-only database
+    connection (opening a Deque writes its settings).
+    :param directory: Deque directory
+    :return: dict of entries|bytes
     """
-    Get state data from cache to build node state and update it.
+    import os
+    import sqlite3
 
+    from diskcache.core import DBNAME
+
+    con = sqlite3.connect('file:{}?mode=ro'.format(os.path.join(directory, DBNAME)), uri=True)
+    try:
+        settings = dict(con.execute("SELECT key, value FROM Settings WHERE key IN ('count', 'size')"))
+        ((page_count,),) = con.execute('PRAGMA page_count').fetchall()
+        ((page_size,),) = con.execute('PRAGMA page_size').fetchall()
+    finally:
+        con.close()
+    return {'entries': settings.get('count', 0),
+            'bytes': page_count * page_size + settings.get('size', 0)}
+
+
+def get_state(cache):
+    """
+    Get state data from cache to build node state and update it.  The
+    state records are kept in the key index; only the entries recorded
+    in the index journal (ie, changed since the last call) are read.
+    :param cache: Index <cache> object
     """
     from node_tools import state_data as st
 
-    key_list, values = get_endpoint_data(cache, 'state')
-    if key_list:
-        d = {}
-        for key, data in zip(key_list, values):
-            if 'nstate' in str(key):
-                if 'ONLINE' in data.status:
-                    d['online'] = True
-                d['fpn_id'] = data.identity
-                d['fallback'] = data.tcpFallback
-            if 'mstate' in str(key) and not NODE_SETTINGS['node_role']:
-                d['moon_id0'] = data.identity
-                d['moon_addr'] = data.address
-                if NODE_SETTINGS['use_localhost']:
-                    d['moon_addr'] = '127.0.0.1'
-            if 'istate' in str(key) and 'OK' in data.status:
-                if data.ztaddress == data.gateway:
-                    d['fpn1'] = True
-                    d['fpn_id1'] = data.identity
-                    st.fpn1Data['nwid'] = data.identity
-                    st.fpn1Data['iface'] = data.ztdevice
-                    st.fpn1Data['address'] = data.ztaddress
+    with metered_transact(cache):
+        expire_cache_entries(cache, STATE_TYPES)
+        index = get_key_index(cache)
+        if index.states is None:
+            index.states = dict(iter_endpoint_data(cache, 'state'))
+        else:
+            for key in index.journal:
+                if key in index.types[get_key_type(key)]:
+                    value, migrated = unpack_cache_entry(cache[key], key)
+                    if migrated:
+                        cache[key] = value
+                        index.changed = True
+                        cache_metrics.count_writes()
+                    index.states[key] = value
                 else:
-                    d['fpn0'] = True
-                    d['fpn_id0'] = data.identity
-                    st.fpn0Data['nwid'] = data.identity
-                    st.fpn0Data['iface'] = data.ztdevice
-                    st.fpn0Data['address'] = data.ztaddress
+                    index.states.pop(key, None)
+        index.journal.clear()
+        key_list = index.get_keys(STATE_TYPES)
+
+    d = {}
+    for key in key_list:
+        data = index.states[key]
+        if 'nstate' in str(key):
+            if 'ONLINE' in data.status:
+                d['online'] = True
+            d['fpn_id'] = data.identity
+            d['fallback'] = data.tcpFallback
+        if 'mstate' in str(key) and not NODE_SETTINGS['node_role']:
+            d['moon_id0'] = data.identity
+            d['moon_addr'] = data.address
+            if NODE_SETTINGS['use_localhost']:
+                d['moon_addr'] = '127.0.0.1'
+        # networks without a route (no address/gateway) are not up
+        if 'istate' in str(key) and 'OK' in data.status and data.ztaddress and data.gateway:
+            if data.ztaddress == data.gateway:
+                d['fpn1'] = True
+                d['fpn_id1'] = data.identity
+                st.fpn1Data['nwid'] = data.identity
+                st.fpn1Data['iface'] = data.ztdevice
+                st.fpn1Data['address'] = data.ztaddress
             else:
-                d.update(fpn0=None, fpn1=None, fpn_id0=None, fpn_id1=None)
+                d['fpn0'] = True
+                d['fpn_id0'] = data.identity
+                st.fpn0Data['nwid'] = data.identity
+                st.fpn0Data['iface'] = data.ztdevice
+                st.fpn0Data['address'] = data.ztaddress
+        else:
+            d.update(fpn0=None, fpn1=None, fpn_id0=None, fpn_id1=None)
+
+    if any(st.fpnState.get(k) != v for k, v in d.items()):
         st.fpnState.update(d)
         logger.debug('fpnState: {}'.format(st.fpnState))
         logger.debug('fpn0Data: {}'.format(st.fpn0Data))
@@ -226,9 +610,50 @@ def handle_node_status(data, cache):
     return node_id
 
 
-def load_cache_by_type(cache, data, key_str):
-    """Load or update cache by key type string (uses find_keys)."""
+def iter_endpoint_data(cache, key_str):
+    """
+    Iterate over all data for key type from cache (can be endpoint or
+    state).  Keys and values are read in a single cache transaction.
+    :notes: The transaction is committed before the first item is
+            returned, so the iterator can be closed early.  Entries in
+            an older cache format are migrated (and written back) on
+            load, and stale entries are evicted first.
+    :param cache: Index <cache> object
+    :param key_str: desired 'key_str' (see get_endpoint_data)
+    :return: generator of (key, value) tuples
+    """
+    items = []
+    with metered_transact(cache):
+        expire_cache_entries(cache, [key for key in KEY_TYPES if key_str in key])
+        key_list = find_keys(cache, key_str)
+        cache_metrics.count_read(key_str, bool(key_list))
+        for key in key_list or []:
+            value, migrated = unpack_cache_entry(cache[key], key)
+            if migrated:
+                index = get_key_index(cache)
+                cache[key] = value
+                index.touch(key)
+                cache_metrics.count_writes()
+            items.append((key, value))
+    for item in items:
+        yield item
+
+
+def load_cache_by_type(cache, data, key_str, bulk=False):
+    """
+    Load or update cache by key type string (uses find_keys).
+    :param cache: Index <cache> object
+    :param data: payload data (dict or list of dicts)
+    :param key_str: desired 'key_str' (see create_cache_entry)
+    :param bulk: if True, use upsert_cache_entries() and only write the
+                 entries that changed
+    :return: dict of upsert counts if `bulk` else None
+    """
     from itertools import zip_longest
+
+    if bulk:
+        return upsert_cache_entries(cache, data, key_str)
+
     key_list = find_keys(cache, key_str)
     if not key_list:
         if key_str in ('node', 'nstate'):
@@ -245,13 +670,151 @@ def load_cache_by_type(cache, data, key_str):
                     create_cache_entry(cache, item, key_str)
                 elif not item:
                     logger.debug('Removing cache entry for key: {}'.format(key))
-                    with cache.transact():
+                    with metered_transact(cache):
+                        index = get_key_index(cache)
                         del cache[key]
+                        index.discard(key)
+                        cache_metrics.count_writes()
                 else:
                     update_cache_entry(cache, item, key)
     key_list = find_keys(cache, key_str)
 
 
+def load_cache_record(name, version, fields):
+    """
+    Unpickle a cache record (see CacheRecord).  Records written with
+    another CACHE_VERSION (or with other fields) are returned as a dict
+    of their fields instead, for unpack_cache_entry to migrate.
+    :param name: record class name
+    :param version: record format version
+    :param fields: dict of record fields
+    :return: record or dict
+    """
+    record_type = RECORD_NAMES.get(name)
+    if record_type is None or version != CACHE_VERSION or set(fields) != set(record_type._fields):
+        return fields
+    return record_type(**fields)
+
+
+@contextmanager
+def metered_transact(cache):
+    """
+    Cache transaction context manager that records the transaction time
+    in `cache_metrics`.  When the outermost transaction for the cache
+    directory is committed, the key index changes are saved (see
+    save_key_index).
+    :param cache: Index <cache> object
+    """
+    import time
+
+    depth = txn_depth.get(cache.directory, 0)
+    txn_depth[cache.directory] = depth + 1
+    start = time.perf_counter()
+    try:
+        with cache.transact():
+            yield
+    finally:
+        txn_depth[cache.directory] = depth
+        cache_metrics.count_transaction(time.perf_counter() - start)
+    if not depth:
+        save_key_index(cache)
+
+
+def pack_cache_entry(data, key_str):
+    """
+    Serialize payload data into the current cache record format (see
+    CACHE_VERSION), keeping only the fields the status functions use.
+    :param data: payload data in a dictionary (or a record, or the field
+                 dict of a stale record)
+    :param key_str: key type string or cache key
+    :return: record for the key type, or AttrView for key types without
+             a record type, eg, 'moon'
+    """
+    key_type = key_str.rstrip('-0123456789')
+    record_type = RECORD_TYPES.get(key_type)
+
+    if record_type is None:
+        return AttrView(data)
+    if type(data) is record_type:
+        return data
+    if key_type == 'peer':
+        paths = tuple(PathRecord(get_data_id(path, 'address'), get_data_id(path, 'active'))
+                      for path in data.get('paths') or [])
+        return PeerRecord(data.get('address'), data.get('role'), paths)
+    if key_type == 'net':
+        return NetRecord(data.get('id'),
+                         data.get('status'),
+                         data.get('mac'),
+                         data.get('portDeviceName'),
+                         tuple(data.get('assignedAddresses') or []),
+                         tuple(data.get('route_via') or
+                               [route.get('via') for route in data.get('routes') or []]))
+    return record_type(*[data.get(field) for field in record_type._fields])
+
+
+def reset_key_index(cache):
+    """
+    Drop the key index and the saved write times for ``cache`` (use
+    after clearing the cache).
+    :param cache: Index <cache> object
+    """
+    key_index.pop(cache.directory, None)
+    get_meta_cache(cache).pop(STAMPS_KEY, None)
+
+
+def save_key_index(cache):
+    """
+    Bump the write generation counter in the meta cache (if the cache
+    entries have changed), so the key index of any other process using
+    the cache is rebuilt.  Called by metered_transact() after the
+    outermost cache transaction is committed; changes in a write-back
+    overlay are saved when the overlay is flushed.
+    :param cache: Index <cache> object
+    """
+    index = key_index.get(cache.directory)
+    if index is None or not index.changed or not getattr(cache, 'write_through', True):
+        return
+    gen = get_meta_cache(cache).incr(GEN_KEY)
+    if index.gen is None or gen != index.gen + 1:
+        index.gen = None  # another process wrote in between, rebuild
+    else:
+        index.gen = gen
+    index.changed = False
+
+
+def save_key_stamps(cache):
+    """
+    Save the per-entry write times of the key index in the meta cache
+    (if they have changed), for get_key_index to restore on rebuild.
+    Called once per update cycle by end_cache_cycle(), so the cost of
+    a single cache write does not depend on the cache size.
+    :param cache: Index <cache> object
+    """
+    index = key_index.get(cache.directory)
+    if index is not None and index.stamps_changed:
+        get_meta_cache(cache)[STAMPS_KEY] = index.stamps
+        index.stamps_changed = False
+
+
+def unpack_cache_entry(value, key):
+    """
+    Deserialize a stored cache value, migrating older formats (ie, the
+    AttrDict payloads of cache version 0 and records of older versions)
+    to the current record format.
+    :param value: stored cache value
+    :param key: cache key
+    :return: tuple of (current value, True if value was migrated)
+    """
+    record_type = RECORD_TYPES.get(get_key_type(key))
+
+    if record_type is None:
+        return value, False
+    if isinstance(value, record_type):
+        return value, False
+    logger.debug('Migrating cache entry for key: {}'.format(key))
+    return pack_cache_entry(value, key), True
+
+
 def update_cache_entry(cache, data, key):
     """
     Update single cache entry by key.
@@ -261,15 +824,360 @@ def update_cache_entry(cache, data, key):
                     ['node'|'peer'|'net'|'mbr'|'moon'] or
                     ['nstate'|'mstate'|'istate']
     """
-    new_data = AttrDict.from_nested_dict(data)
-    if 'state' in key.rstrip('-0123456789'):
-        tgt = 'identity'
-    elif key.rstrip('-0123456789') in ('net', 'moon'):
-        tgt = 'id'
-    else:
-        tgt = 'address'
-    data_id = new_data[tgt]
+    new_data = pack_cache_entry(data, key)
+    tgt = get_id_field(key)
+    data_id = get_data_id(new_data, tgt)
     logger.debug('New data has id: {}'.format(data_id))
     logger.debug('Updating cache entry for key: {}'.format(key))
-    with cache.transact():
+    with metered_transact(cache):
+        index = get_key_index(cache)
         cache[key] = new_data
+        index.touch(key)
+        cache_metrics.count_writes()
+
+
+def upsert_cache_entries(cache, data, key_str):
+    """
+    Bulk load/update cache entries for one key type in one transaction.
+    Entries are matched on the payload ID field and compared by content
+    hash (of the packed record), so only new or changed entries are
+    written and only vanished entries are deleted.
+    :param cache: Index <cache> object
+    :param data: payload data (dict or list of dicts)
+    :param key_str: desired 'key_str' (see create_cache_entry)
+    :return: dict of counts for inserted|updated|deleted|unchanged
+    """
+    counts = dict.fromkeys(['inserted', 'updated', 'deleted', 'unchanged'], 0)
+    if isinstance(data, dict):
+        data = [data]
+    tgt = get_id_field(key_str)
+
+    with metered_transact(cache):
+        index = get_key_index(cache)
+        stored = {}
+        stale = []
+        for key in index.get_keys([key_str]):
+            if key not in index.digests:
+                value, _ = unpack_cache_entry(cache[key], key)
+                index.digests[key] = (get_data_id(value, tgt), get_content_digest(value))
+            data_id, digest = index.digests[key]
+            if data_id in stored:
+                stale.append(key)
+            else:
+                stored[data_id] = (key, digest)
+
+        seen = set()
+        for item in data:
+            record = pack_cache_entry(item, key_str)
+            data_id = get_data_id(record, tgt)
+            digest = get_content_digest(record)
+            if data_id in stored and data_id not in seen:
+                key, old_digest = stored[data_id]
+                if digest == old_digest:
+                    index.refresh(key)
+                    counts['unchanged'] += 1
+                else:
+                    cache[key] = record
+                    index.touch(key)
+                    counts['updated'] += 1
+            else:
+                key = cache.push(record, prefix=key_str)
+                index.add(key)
+                counts['inserted'] += 1
+            index.digests[key] = (data_id, digest)
+            seen.add(data_id)
+
+        stale.extend([key for data_id, (key, _) in stored.items() if data_id not in seen])
+        for key in stale:
+            del cache[key]
+            index.discard(key)
+            counts['deleted'] += 1
+        num_writes = counts['inserted'] + counts['updated'] + counts['deleted']
+        cache_metrics.count_writes(num_writes)
+        counts['deleted'] += len(expire_cache_entries(cache, [key_str]))
+
+    logger.debug('Upserted {} entries: {}'.format(key_str, counts))
+    return counts
+
+
+def write_cache_metrics(cache, dirname=None):
+    """
+    Write the cache metrics snapshot to the JSON metrics file (next to
+    the fpnd.state file).
+    :param cache: Index <cache> object
+    :param dirname: output directory (default is the runtime dir)
+    :return: metrics dictionary
+    """
+    if not dirname:
+        dirname = get_runtimedir()
+    metrics = get_cache_metrics(cache)
+    try:
+        json_dump_file('fpnd_metrics', metrics, dirname)
+    except OSError as exc:
+        logger.warning('Cache metrics not written: {}'.format(exc))
+    logger.debug('Cache metrics: {} entries, {} writes this cycle'.format(
+        metrics['cache']['entries'], metrics['writes']['cycle']))
+    return metrics
+
+
+class CacheMetrics(object):
+    """
+    Cache counters; per key type reads (hits/misses), writes (total and
+    for the current update cycle) and transaction times, plus the queue
+    lookups (hits/misses) per Deque directory name.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = {}
+        self.misses = {}
+        self.writes = 0
+        self.cycle_writes = 0
+        self.cycles = 0
+        self.txn_count = 0
+        self.txn_time = 0.0
+        self.txn_max = 0.0
+        self.queue_hits = {}
+        self.queue_misses = {}
+
+    def begin_cycle(self):
+        self.cycles += 1
+        self.cycle_writes = 0
+
+    def count_read(self, key_str, hit):
+        counter = self.hits if hit else self.misses
+        counter[key_str] = counter.get(key_str, 0) + 1
+
+    def count_queue_read(self, queue, hit):
+        import os
+
+        name = os.path.basename(queue.directory)
+        counter = self.queue_hits if hit else self.queue_misses
+        counter[name] = counter.get(name, 0) + 1
+
+    def count_transaction(self, secs):
+        self.txn_count += 1
+        self.txn_time += secs
+        self.txn_max = max(self.txn_max, secs)
+
+    def count_writes(self, num=1):
+        self.writes += num
+        self.cycle_writes += num
+
+    def get_queue_reads(self, name):
+        return {'hits': self.queue_hits.get(name, 0),
+                'misses': self.queue_misses.get(name, 0)}
+
+    def snapshot(self):
+        return {'cycles': self.cycles,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'writes': {'cycle': self.cycle_writes, 'total': self.writes},
+                'transactions': {'count': self.txn_count,
+                                 'total_sec': round(self.txn_time, 6),
+                                 'max_sec': round(self.txn_max, 6)}}
+
+
+class KeyIndex(object):
+    """
+    Secondary index of cache keys by key type prefix.  Keys are kept in
+    cache insertion order; keys without a valid type prefix (eg, the
+    cache timestamp) are only counted.  The `stamps` dicts hold the
+    write time per key (oldest first) used by expire_cache_entries(),
+    and the `digests` dict holds the (ID, content hash) pairs used by
+    upsert_cache_entries(), while the `states` dict (state records) and
+    the `journal` set (state keys changed since the last get_state) are
+    used by get_state().  `gen` is the cache write generation the index
+    is in sync with (see get_key_index), and `changed` is set when keys
+    are added, discarded or touched (see save_key_index), while
+    `stamps_changed` is set when write times change (see
+    save_key_stamps).
+    """
+    def __init__(self):
+        self.types = {key_type: {} for key_type in KEY_TYPES}
+        self.stamps = {key_type: {} for key_type in KEY_TYPES}
+        self.other = set()
+        self.digests = {}
+        self.states = None
+        self.journal = set()
+        self.seq = 0
+        self.gen = 0
+        self.changed = False
+        self.stamps_changed = False
+
+    def __len__(self):
+        return sum(len(keys) for keys in self.types.values()) + len(self.other)
+
+    def add(self, key, stamp=None):
+        key_type = get_key_type(key)
+        if key_type is None:
+            self.other.add(key)
+        elif key not in self.types[key_type]:
+            self.seq += 1
+            self.types[key_type][key] = self.seq
+            self.changed = True
+            self.touch(key)
+            self.refresh(key, stamp)
+
+    def discard(self, key):
+        key_type = get_key_type(key)
+        if key_type is None:
+            self.other.discard(key)
+        else:
+            self.types[key_type].pop(key, None)
+            self.stamps[key_type].pop(key, None)
+            self.changed = True
+            self.stamps_changed = True
+            self.touch(key)
+
+    def refresh(self, key, stamp=None):
+        """Set the write time for ``key`` (default is now)."""
+        import time
+
+        stamps = self.stamps[get_key_type(key)]
+        stamps.pop(key, None)
+        stamps[key] = time.time() if stamp is None else stamp
+        self.stamps_changed = True
+
+    def touch(self, key):
+        """Record a changed value for ``key`` (drops the old digest)."""
+        self.changed = True
+        self.digests.pop(key, None)
+        if get_key_type(key) in STATE_TYPES:
+            self.journal.add(key)
+        if key in self.stamps[get_key_type(key)]:
+            self.refresh(key)
+
+    def get_keys(self, key_types):
+        """Return list of keys for one or more key types (in order)."""
+        if len(key_types) == 1:
+            return list(self.types[key_types[0]])
+        seq_lists = [[(seq, key) for key, seq in self.types[key_type].items()]
+                     for key_type in key_types]
+        return [key for _, key in heapq.merge(*seq_lists)]
+
+
+class WriteBackIndex(object):
+    """
+    In-process overlay for a diskcache Index; provides the subset of
+    the Index API used by the cache functions.  Values are read from
+    the Index once and served from memory after that.  Changes are
+    kept in memory (write-back) and written by flush() in a single
+    transaction, or also written to the Index immediately if
+    `write_through` is True (crash safe).
+    """
+    def __init__(self, index, write_through=False):
+        self.index = index
+        self.directory = index.directory
+        self.write_through = write_through
+        self.values = {}
+        self.dirty = {}
+        self.deleted = set()
+        self.cleared = False
+        self.tails = {}
+        self._keys = None
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._keys = dict.fromkeys(self.index)
+        return self._keys
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __iter__(self):
+        return iter(list(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, key):
+        if key in self.values:
+            return self.values[key]
+        if key not in self.keys:
+            raise KeyError(key)
+        value = self.values[key] = self.index[key]
+        return value
+
+    def __setitem__(self, key, value):
+        self.keys.setdefault(key)
+        self.values[key] = value
+        self.deleted.discard(key)
+        if self.write_through:
+            self.index[key] = value
+        else:
+            self.dirty[key] = None
+
+    def __delitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        del self.keys[key]
+        self.values.pop(key, None)
+        self.dirty.pop(key, None)
+        if self.write_through:
+            del self.index[key]
+        else:
+            self.deleted.add(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._keys = {}
+        self.values.clear()
+        self.dirty.clear()
+        self.deleted.clear()
+        self.tails.clear()
+        if self.write_through:
+            self.index.clear()
+        else:
+            self.cleared = True
+
+    def push(self, value, prefix):
+        """Push `value` with a new "prefix-integer" key (same as Index)."""
+        if prefix not in self.tails:
+            nums = [int(key[len(prefix) + 1:]) for key in self.keys
+                    if isinstance(key, str) and key.startswith(prefix + '-') and
+                    key[len(prefix) + 1:].isdigit()]
+            self.tails[prefix] = max(nums, default=499999999999999)
+        self.tails[prefix] += 1
+        key = '{0}-{1:015d}'.format(prefix, self.tails[prefix])
+        self[key] = value
+        return key
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def transact(self):
+        """Use an Index transaction in write-through mode, else no-op."""
+        import contextlib
+
+        if self.write_through:
+            return self.index.transact()
+        return contextlib.suppress()
+
+    def flush(self):
+        """Write pending changes to the Index in one transaction."""
+        count = len(self.dirty) + len(self.deleted)
+        if self.cleared or count:
+            with metered_transact(self.index):
+                if self.cleared:
+                    self.index.clear()
+                for key in self.deleted:
+                    self.index.pop(key, None)
+                for key in self.dirty:
+                    self.index[key] = self.values[key]
+            logger.debug('Flushed {} cache changes to: {}'.format(count, self.directory))
+        self.dirty.clear()
+        self.deleted.clear()
+        self.cleared = False
+        return count
+
+
+cache_metrics = CacheMetrics()  # shared counters (see get_cache_metrics)
@@ -3,17 +3,35 @@
 """
     Default fpn ctlr state variables.  Trie keys must be in the set
     `string.hexdigits`.
-    :var net_trie: <Trie> of JSON network/member data objects
-    :var id_trie: <Trie> of JSON member node net_id state objects
+    :var net_trie: <NetTrie> of JSON network/member data objects (with
+                   a reverse index of member node IDs)
+    :var id_trie: <Trie> of JSON member node net_id state objects (the
+                  current published snapshot; never mutated in place
+                  while a netstate cycle is open)
+    :var id_draft: <Trie> working copy of `id_trie` for the open netstate
+                   cycle (None if no cycle is open)
+    :var synced_nets: <set> of network IDs with current net trie data
+    :var sync_cycles: <int> state trie updates since the last full network
+                      refresh (see NODE_SETTINGS['net_sync_cycles'])
+    :var unauth_mbrs: <dict> of revisions for unauthorized net/mbr keys
+    :var net_pool: <SubnetPool> for new network configs (opened by
+                   `ctlr_funcs.get_net_pool`)
     :var rules: <cfg_dict> default flow rules for each network link
 """
 import string
 
 import datrie
 
+from node_tools.trie_funcs import NetTrie
 
-net_trie = datrie.Trie(string.hexdigits)
+
+net_trie = NetTrie(string.hexdigits)
 id_trie = datrie.Trie(string.hexdigits)
+id_draft = None
+synced_nets = set()
+sync_cycles = 0
+unauth_mbrs = {}
+net_pool = None
 
 rules = {
     'rules': [
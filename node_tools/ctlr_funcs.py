@@ -12,18 +12,7 @@ from node_tools.helper_funcs import json_load_file
 
 logger = logging.getLogger(__name__)
 
-
-def gen_netobj_queue(deque, ipnet='172.16.0.0/12'):
-    import ipaddress
-
-    if len(deque) > 0:
-        logger.debug('Using existing queue: {}'.format(deque.directory))
-    else:
-        logger.debug('Generating netobj queue, please be patient...')
-        netobjs = list(ipaddress.ip_network(ipnet).subnets(new_prefix=30))
-        for net in netobjs:
-            deque.append(net)
-    logger.debug('{} IPNetwork objects in queue: {}'.format(len(deque), deque.directory))
+POOL_FILE = 'subnet_pool.dat'  # subnet allocator bitmap (in the cache dir)
 
 
 def get_exit_node_id():
@@ -37,6 +26,37 @@ def get_exit_node_id():
     return result
 
 
+def get_net_pool(net_trie=None, ipnet='172.16.0.0/12', dirname=None):
+    """
+    Get the (persistent) subnet pool for network configs, opening it on
+    first use; if `net_trie` is given, rebuild the pool from it, ie,
+    release all subnets and reserve the subnets of the networks it has
+    (so subnets of networks removed while the daemon was down, or lost
+    between allocation and trie update, are not leaked).
+    :notes: the first state trie update reserves the subnets of all the
+            networks on the controller (before any new allocation)
+    :param net_trie: net state trie
+    :param ipnet: address block to allocate /30 subnets from
+    :param dirname: pool file directory (default is the cache dir)
+    :return: <SubnetPool> object
+    """
+    import os
+    from node_tools import ctlr_data as ct
+    from node_tools.helper_funcs import get_cachedir
+
+    if ct.net_pool is None:
+        if not dirname:
+            dirname = os.path.dirname(get_cachedir())
+        ct.net_pool = SubnetPool(os.path.join(dirname, POOL_FILE), ipnet)
+        logger.debug('Opened subnet pool with {} of {} subnets in use'.format(
+            ct.net_pool.used, ct.net_pool.size))
+    if net_trie is not None:
+        ct.net_pool.clear()
+        for net_id in [x for x in net_trie.keys() if len(x) == 16]:
+            reserve_net_subnet(net_trie[net_id])
+    return ct.net_pool
+
+
 def get_network_id(data):
     """
     Get the network ID from the dict-ish client payload (ie, the content
@@ -48,19 +68,28 @@ def get_network_id(data):
     return net_data.id
 
 
-def handle_net_cfg(deque):
+def get_route_netbase(data):
+    """
+    Get the subnet base address from the (non-default) route in the
+    network payload.
+    :param data: net trie network payload
+    :return: <int> network address or None
+    """
+    for route in (data or {}).get('routes') or []:
+        if not route.get('via') and route.get('target', '').endswith('/30'):
+            return netcfg_get_netbase(route['target'].split('/')[0])
+    return None
+
+
+def handle_net_cfg(pool):
     """
     Handle the initial net_cfg for a (new) member node. Required format
     derived from async wrapper funcs.  Context is netstate runner and
     bootstrap_mbr_node.
-    :param deque: netobj queue
+    :param pool: subnet pool
     :return: tuple of formatted cfg fragments
     """
-    with deque.transact():
-        ipnet = deque.popleft()
-        deque.append(ipnet)
-
-    netcfg = ipnet_get_netcfg(ipnet)
+    netcfg = netbase_get_netcfg(pool.allocate(), pool.prefixlen)
     gw_ip = find_ipv4_iface(netcfg.gateway[0])
     src_ip = find_ipv4_iface(netcfg.host[0])
 
@@ -89,6 +118,15 @@ def handle_net_cfg(deque):
     return ip_net, mbr_ip, gw_ip
 
 
+def int_get_ipv4(addr):
+    """
+    Format a 32-bit integer as a dotted-quad IPv4 address string.
+    :param addr: <int> IPv4 address
+    :return: IPv4 address string
+    """
+    return '{}.{}.{}.{}'.format(addr >> 24, (addr >> 16) & 255, (addr >> 8) & 255, addr & 255)
+
+
 def ipnet_get_netcfg(netobj):
     """
     Process a (python) network object into config Attrdict.
@@ -100,23 +138,7 @@ def ipnet_get_netcfg(netobj):
     import ipaddress as ip
 
     if isinstance(netobj, ip.IPv4Network):
-        net_cidr = str(netobj)
-        net_pfx = '/' + str(netobj.prefixlen)
-        gate_iface = ip.IPv4Interface(str(list(netobj.hosts())[0]) + net_pfx)
-        host_iface = ip.IPv4Interface(str(list(netobj.hosts())[1]) + net_pfx)
-        gate_addr = str(gate_iface.ip)
-        host_cidr = [str(host_iface)]
-        gate_cidr = [str(gate_iface)]
-
-        net_routes = [{"target": "{}".format(net_cidr)},
-                      {"target": "0.0.0.0/0", "via": "{}".format(gate_addr)}]
-
-        d = {
-            "net_routes": net_routes,
-            "host": host_cidr,
-            "gateway": gate_cidr
-        }
-        return AttrDict.from_nested_dict(d)
+        return netbase_get_netcfg(int(netobj.network_address), netobj.prefixlen)
     else:
         raise ValueError('{} is not a valid IPv4Network object'.format(netobj))
 
@@ -155,26 +177,104 @@ def name_generator(size=10, char_set=None):
     return str1 + '_' + str2
 
 
+def netbase_get_netcfg(base, prefixlen=30):
+    """
+    Derive the netcfg for a subnet from its 32-bit network base address
+    (same format as ipnet_get_netcfg); the gateway is the first host
+    address and the host is the second.
+    :param base: <int> network address
+    :param prefixlen: network prefix length (max 31)
+    :return: `dict` Attrdict of JSON config fragments
+    :raises: ValueError
+    """
+    if not 0 <= prefixlen <= 31 or base & (0xffffffff >> prefixlen):
+        raise ValueError('{}/{} is not a valid IPv4 subnet'.format(base, prefixlen))
+
+    first = base if prefixlen == 31 else base + 1
+    net_pfx = '/{}'.format(prefixlen)
+    gate_addr = int_get_ipv4(first)
+
+    d = {
+        "net_routes": [{"target": int_get_ipv4(base) + net_pfx},
+                       {"target": "0.0.0.0/0", "via": gate_addr}],
+        "host": [int_get_ipv4(first + 1) + net_pfx],
+        "gateway": [gate_addr + net_pfx]
+    }
+    return AttrDict.from_nested_dict(d)
+
+
+def netbase_get_netcfgs(bases, prefixlen=30):
+    """
+    Batch version of netbase_get_netcfg().
+    :param bases: iterable of <int> network addresses
+    :param prefixlen: network prefix length
+    :return: list of netcfg Attrdicts
+    """
+    return [netbase_get_netcfg(base, prefixlen) for base in bases]
+
+
 def netcfg_get_ipnet(addr, cidr='/30'):
     """
     Process member host or gateway addr string into the (python)
     network object it belongs to.  We also assume/require the CIDR
-    prefix for `addr` == /30 to be compatible with gen_netobj_queue().
+    prefix for `addr` == /30 to be compatible with the subnet pool.
     :param addr: IPv4 address string without mask
     :param cidr: network prefix
     :return: <netobj> network object for host_addr
     :raises: AddressValueError
     """
     import ipaddress as ip
-    from node_tools.helper_funcs import find_ipv4_iface
+    from node_tools.helper_funcs import parse_ipv4_net
 
-    if find_ipv4_iface(addr + cidr, strip=False):
-        netobj = ip.ip_network(addr + cidr, strict=False)
+    netobj = parse_ipv4_net(addr + cidr)
+    if netobj is not None:
         return netobj
     else:
         raise ip.AddressValueError
 
 
+def netcfg_get_netbase(addr, prefixlen=30):
+    """
+    Get the network base address of a member host or gateway addr.
+    :param addr: IPv4 address string without mask
+    :param prefixlen: network prefix length
+    :return: <int> network address
+    :raises: AddressValueError
+    """
+    import ipaddress as ip
+    from node_tools.helper_funcs import parse_ipv4_int
+
+    addr_int = parse_ipv4_int(addr)
+    if addr_int is None:
+        raise ip.AddressValueError(addr)
+    return addr_int & (0xffffffff << (32 - prefixlen)) & 0xffffffff
+
+
+def release_net_subnet(data):
+    """
+    Release the subnet of a (deleted) network back to the subnet pool.
+    :param data: net trie network payload
+    :return: True if the subnet was released
+    """
+    base = get_route_netbase(data)
+    if base is not None and get_net_pool().is_pool_net(base):
+        logger.debug('Releasing subnet {}'.format(int_get_ipv4(base)))
+        return get_net_pool().release(base)
+    return False
+
+
+def reserve_net_subnet(data):
+    """
+    Reserve the subnet of an (existing) network in the subnet pool.
+    :param data: net trie network payload
+    :return: True if the subnet was not already reserved
+    """
+    base = get_route_netbase(data)
+    if base is not None and get_net_pool().is_pool_net(base):
+        return get_net_pool().reserve(base)
+    return False
+
+
 def set_network_cfg(cfg_addr):
     """
     Take the netcfg for mbr and wrap it so it can be applied during mbr
@@ -204,3 +304,109 @@ def unset_network_cfg():
     }
 
     return AttrDict.from_nested_dict(src_addr)
+
+
+class SubnetPool(object):
+    """
+    Persistent bitmap allocator for the subnets of an address block; one
+    bit per subnet (set if in use) in a memory-mapped file, eg, 32 KB
+    for the /30 subnets in a /12.  Allocation starts from a moving
+    cursor, so allocate/release are O(1) (amortised).
+    """
+    def __init__(self, fname, ipnet='172.16.0.0/12', prefixlen=30):
+        import os
+        import mmap
+        import ipaddress
+
+        net = ipaddress.ip_network(ipnet)
+        self.base = int(net.network_address)
+        self.prefixlen = prefixlen
+        self.shift = 32 - prefixlen
+        self.size = 1 << (prefixlen - net.prefixlen)
+        self.cursor = 0
+        nbytes = (self.size + 7) // 8
+
+        fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != nbytes:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, nbytes)
+            self.bits = mmap.mmap(fd, nbytes)
+        finally:
+            os.close(fd)
+        self.used = bin(int.from_bytes(self.bits[:], 'big')).count('1')
+
+    def _locate(self, base):
+        if not self.is_pool_net(base):
+            raise ValueError('{}/{} is not in the subnet pool'.format(int_get_ipv4(base), self.prefixlen))
+        idx = (base - self.base) >> self.shift
+        return idx >> 3, 1 << (idx & 7)
+
+    def allocate(self):
+        """
+        Allocate the next free subnet.
+        :return: <int> network address
+        :raises: IndexError if the pool is full
+        """
+        nbytes = len(self.bits)
+        for n in range(nbytes):
+            pos = (self.cursor + n) % nbytes
+            byte = self.bits[pos]
+            if byte != 0xff:
+                bit = (~byte & (byte + 1)).bit_length() - 1
+                idx = (pos << 3) + bit
+                if idx >= self.size:
+                    continue
+                self.bits[pos] = byte | (1 << bit)
+                self.cursor = pos
+                self.used += 1
+                return self.base + (idx << self.shift)
+        raise IndexError('subnet pool is full')
+
+    def clear(self):
+        """Release all subnets."""
+        self.bits[:] = bytes(len(self.bits))
+        self.cursor = 0
+        self.used = 0
+
+    def close(self):
+        self.bits.flush()
+        self.bits.close()
+
+    def flush(self):
+        self.bits.flush()
+
+    def is_pool_net(self, base):
+        """Return True if ``base`` is a subnet address in the pool."""
+        offset = base - self.base
+        return 0 <= offset < (self.size << self.shift) and not offset & ((1 << self.shift) - 1)
+
+    def is_used(self, base):
+        pos, mask = self._locate(base)
+        return bool(self.bits[pos] & mask)
+
+    def release(self, base):
+        """
+        Return a subnet to the pool.
+        :return: True if the subnet was in use
+        """
+        pos, mask = self._locate(base)
+        byte = self.bits[pos]
+        if not byte & mask:
+            return False
+        self.bits[pos] = byte & ~mask
+        self.used -= 1
+        return True
+
+    def reserve(self, base):
+        """
+        Mark a (known) subnet as in use.
+        :return: True if the subnet was free
+        """
+        pos, mask = self._locate(base)
+        byte = self.bits[pos]
+        if byte & mask:
+            return False
+        self.bits[pos] = byte | mask
+        self.used += 1
+        return True
@@ -11,14 +11,19 @@ from datetime import timezone
 
 from diskcache import Index
 
+from node_tools.cache_funcs import begin_cache_cycle
+from node_tools.cache_funcs import cache_metrics
+from node_tools.cache_funcs import end_cache_cycle
+from node_tools.cache_funcs import get_cycle_cache
 from node_tools.cache_funcs import get_state
+from node_tools.cache_funcs import write_cache_metrics
 from node_tools.helper_funcs import get_cachedir
 from node_tools.helper_funcs import get_runtimedir
 from node_tools.helper_funcs import log_fpn_state
 from node_tools.helper_funcs import put_state_msg
 from node_tools.helper_funcs import run_event_handlers
 from node_tools.helper_funcs import update_state
-from node_tools.helper_funcs import AttrDict
+from node_tools.helper_funcs import AttrView
 from node_tools.helper_funcs import ENODATA
 from node_tools.helper_funcs import NODE_SETTINGS
 
@@ -28,15 +33,6 @@ logger = logging.getLogger(__name__)
 cache = Index(get_cachedir())
 
 
-def do_logstats(msg=None):
-    """Log cache size/key stats with optional ``msg`` string"""
-    size = len(cache)
-    if msg:
-        logger.debug(msg)
-    logger.debug('{} items currently in cache.'.format(size))
-    logger.debug('Cache items: {}'.format(list(cache)))
-
-
 def get_state_values(old, new, pairs=False):
     """
     Get ordered changes for two state item views
@@ -54,14 +50,11 @@ def get_state_values(old, new, pairs=False):
         if old == new:
             logger.debug('State is unchanged')
         else:
+            keys = [k for k, v in new.items() if old.get(k) != v]
             if not pairs:
-                diff = [j for i, j in zip(old.items(), new.items()) if i != j]
+                diff = [(k, new[k]) for k in keys]
             else:
-                diff = []
-                for i, j in zip(old.items(), new.items()):
-                    if i != j:
-                        item = (i, j)
-                        diff.append(item)
+                diff = [((k, old.get(k)), (k, new[k])) for k in keys]
             logger.debug('State changed: {}'.format(diff))
         st.changes = tuple(diff)
 
@@ -70,11 +63,14 @@ def with_cache_aging(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """
-        Diskcache wrapper to manage timestamp age for update_runner (this is
-        necessary because the Index cache has no expire/eviction policy).
-        * get timestamp and clear cache if greater than max_age
+        Diskcache wrapper to manage timestamp age for update_runner (the
+        Index cache has no expire policy, so stale entries are evicted per
+        key type on read, see expire_cache_entries).
+        * get timestamp and log cache age
         * update cache timestamp based on result
         * log some debug info
+        * flush the cache overlay (if any) at the end of the cycle
+        * write the cache metrics snapshot
         :return result: result from update_runner()
         """
         from node_tools import state_data as st
@@ -82,30 +78,35 @@ def with_cache_aging(func):
         stamp = None
         max_age = NODE_SETTINGS['max_cache_age']
         utc_stamp = datetime.datetime.now(utc)
-        do_logstats('Entering cache wrapper')
-        if 'utc-time' in cache:
-            stamp = cache['utc-time']
-            cache_age = utc_stamp - stamp  # this is a timedelta
-            logger.debug('Cache age is: {} sec'.format(cache_age.seconds))
-            logger.debug('Maximum cache age: {} sec'.format(max_age))
-            if cache_age.seconds > max_age:
-                logger.debug('Cache data is too old!!')
-                logger.debug('Stale data will be removed!!')
-                cache.clear()
+        cache_metrics.begin_cycle()
+        cycle_cache = begin_cache_cycle(cache)
+        try:
+            logger.debug('{} items currently in cache.'.format(len(cycle_cache)))
+            if 'utc-time' in cycle_cache:
+                stamp = cycle_cache['utc-time']
+                cache_age = utc_stamp - stamp  # this is a timedelta
+                logger.debug('Cache age is: {} sec'.format(cache_age.seconds))
+                logger.debug('Maximum cache age: {} sec'.format(max_age))
+                if cache_age.seconds > max_age:
+                    logger.debug('Cache data is too old!!')
+                    logger.debug('Stale entries will be evicted by type')
+                else:
+                    logger.info('Cache is {} sec old (still valid)'.format(cache_age.seconds))
             else:
-                logger.info('Cache is {} sec old (still valid)'.format(cache_age.seconds))
-        else:
-            cache.update([('utc-time', utc_stamp)])
+                cycle_cache.update([('utc-time', utc_stamp)])
 
-        result = func(*args, **kwargs)
-        logger.info('Get data result: {}'.format(result))
+            result = func(*args, **kwargs)
+            logger.info('Get data result: {}'.format(result))
 
-        if stamp is not None and result is ENODATA or None:
-            cache.update([('utc-time', stamp)])
-            logger.debug('Old cache time is: {:%Y-%m-%d %H:%M:%S %Z}'.format(stamp))
-        else:
-            cache.update([('utc-time', utc_stamp)])
-            logger.debug('New cache time is: {:%Y-%m-%d %H:%M:%S %Z}'.format(utc_stamp))
+            if stamp is not None and result is ENODATA or None:
+                cycle_cache.update([('utc-time', stamp)])
+                logger.debug('Old cache time is: {:%Y-%m-%d %H:%M:%S %Z}'.format(stamp))
+            else:
+                cycle_cache.update([('utc-time', utc_stamp)])
+                logger.debug('New cache time is: {:%Y-%m-%d %H:%M:%S %Z}'.format(utc_stamp))
+        finally:
+            end_cache_cycle(cache)
+            write_cache_metrics(cache)
         log_fpn_state()
         run_event_handlers()
         return result
@@ -117,12 +118,14 @@ def with_state_check(func):
     def state_check(*args, **kwargs):
         """
         Diskcache wrapper for checking nodeState before and after the
-        update_runner() tries to grab new data.
+        update_runner() tries to grab new data.  The state changes are
+        the fields that differ after get_state(), including any fields
+        set directly by the runner.
         """
         from node_tools import state_data as st
 
-        get_state(cache)
-        prev_state = AttrDict.from_nested_dict(st.fpnState)
+        get_state(get_cycle_cache(cache))
+        prev_state = AttrView(st.fpnState)
 
         if not prev_state.online:
             logger.warning('nodeState not initialized (node not online)')
@@ -131,8 +134,8 @@ def with_state_check(func):
 
         result = func(*args, **kwargs)
 
-        get_state(cache)
-        next_state = AttrDict.from_nested_dict(st.fpnState)
+        get_state(get_cycle_cache(cache))
+        next_state = AttrView(st.fpnState)
 
         if not next_state.online and not prev_state.online:
             logger.warning('nodeState still not initialized (node not online)')
@@ -153,7 +156,7 @@ def with_state_check(func):
 def update_runner():
     try:
         res = update_state()
-        size = len(cache)
+        size = len(get_cycle_cache(cache))
         logger.debug('API result: {}'.format(res))
     except:  # noqa: E722
         logger.warning('No data available, cache was NOT updated')
@@ -162,8 +165,7 @@ def update_runner():
         if size < 1:
             logger.warning('No data available (live or cached)')
         elif size > 0:
-            do_logstats()
+            logger.debug('{} items currently in cache.'.format(size))
         else:
             logger.warning('Cache empty and API returned ENODATA')
-    do_logstats('Leaving update_runner')
     return res
@@ -3,7 +3,8 @@
 
 __all__ = (
     'MemberNodeError',
-    'MemberNodeNoDataError',)
+    'MemberNodeNoDataError',
+    'ServiceUnavailableError',)
 
 
 class MemberNodeError(Exception):
@@ -12,3 +13,7 @@ class MemberNodeError(Exception):
 
 class MemberNodeNoDataError(MemberNodeError):
     """No data error when (external) API data is not available."""
+
+
+class ServiceUnavailableError(MemberNodeError):
+    """Local ZT service API calls are failing (circuit breaker is open)."""
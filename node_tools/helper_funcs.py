@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import sys
 import logging
+import functools
 
 from configparser import ConfigParser as SafeConfigParser
 
@@ -23,6 +24,10 @@ class Constant(tuple):
 
 ENODATA = Constant('ENODATA')  # error return for async state data updates
 
+ADDR_CACHE_SIZE = 4096  # max entries per memoised address parser
+
+state_runners = {}  # StateRunner objects by script name (see get_state_runner)
+
 NODE_SETTINGS = {
     u'private_dns_only': False,  # drop routed port 53 traffic
     u'route_dns': False,  # route insecure dns with web traffic
@@ -31,6 +36,18 @@ NODE_SETTINGS = {
     u'drop_ip6': False,  # set IPv6 in/out/fwd policies to drop while running
     u'max_timeout': 75,  # max wait timeout for network changes in seconds
     u'max_cache_age': 60,  # maximum cache age in seconds
+    u'cache_ttls': {},  # per key type cache age (overrides max_cache_age)
+    u'max_peer_entries': None,  # size cap (LRU eviction) for cached peers (None is no cap)
+    u'net_sync_cycles': 30,  # refresh all ctlr network data every N cycles (0 is never)
+    u'max_api_conns': 8,  # max concurrent ctlr API requests (and pooled connections)
+    u'api_keepalive': 15,  # idle time in seconds to keep pooled API connections
+    u'api_timeout': 10,  # max time in seconds for one API request (call deadline)
+    u'api_retries': 2,  # max retries for idempotent (GET) API calls
+    u'api_backoff': 0.25,  # base delay in seconds for (jittered) API retry backoff
+    u'api_breaker_max': 5,  # consecutive API failures that open the circuit breaker
+    u'api_breaker_reset': 30,  # seconds before an open breaker allows a trial call
+    u'resident_runner': False,  # keep the state runner loaded between cycles
+    u'cache_mode': 'direct',  # cache overlay mode: direct|write-back|write-through
     u'use_localhost': False,  # messaging interface to use
     u'runas_user': False,  # user to run as
     u'node_role': None,  # role this node will run as
@@ -45,6 +62,15 @@ NODE_SETTINGS = {
 }
 
 
+def close_state_runners(keep=None):
+    """
+    Close resident state runners.
+    :param keep: script name of the runner to keep open (if any)
+    """
+    for scr in [x for x in list(state_runners) if x != keep]:
+        state_runners.pop(scr).close()
+
+
 def config_from_ini(file_path=None):
     config = SafeConfigParser(allow_no_value=True)
     candidates = ['/etc/fpnd.ini',
@@ -90,6 +116,14 @@ def do_setup():
         NODE_SETTINGS['route_dns_53'] = my_conf.getboolean('Options', 'route_dns')
         NODE_SETTINGS['private_dns_only'] = my_conf.getboolean('Options', 'private_dns_only')
         NODE_SETTINGS['drop_ipv6'] = my_conf.getboolean('Options', 'drop_ip6')
+        NODE_SETTINGS['cache_mode'] = my_conf.get('Options', 'cache_mode', fallback='direct')
+        ttls = my_conf.get('Options', 'cache_ttls', fallback='')
+        NODE_SETTINGS['cache_ttls'] = {key_type.strip(): int(age) for key_type, age in
+                                       [item.split(':') for item in ttls.split(',') if item.strip()]}
+        NODE_SETTINGS['max_peer_entries'] = my_conf.getint('Options', 'max_peer_entries',
+                                                           fallback=0) or None
+        NODE_SETTINGS['resident_runner'] = my_conf.getboolean('Options', 'resident_runner',
+                                                              fallback=False)
         NODE_SETTINGS['mode'] = mode
         NODE_SETTINGS['debug'] = debug
         NODE_SETTINGS['runas_user'] = user_perms
@@ -136,15 +170,28 @@ def find_ipv4_iface(addr_string, strip=True):
     :return addr: Stripped addr_str if 'strip' return IPv4 addr only, or
     :return boolean: True if not 'strip' or False if addr not valid
     """
-    import ipaddress
-    try:
-        interface = ipaddress.IPv4Interface(addr_string)
-        if not strip:
-            return True
-        else:
-            return str(interface.ip)
-    except ValueError:
+    addr = parse_ipv4_iface(addr_string)
+    if addr is None:
         return False
+    if not strip:
+        return True
+    return addr
+
+
+def get_addr_cache_info():
+    """
+    Get hit/miss counters for the memoised address parsers.
+    :return: dict of counters and hit rate by parser name
+    """
+    info = {}
+    for func in (parse_ipv4_iface, parse_ipv4_int, parse_ipv4_net, parse_path_addr):
+        stats = func.cache_info()
+        lookups = stats.hits + stats.misses
+        info[func.__name__] = {'hits': stats.hits,
+                               'misses': stats.misses,
+                               'size': stats.currsize,
+                               'hit_rate': round(stats.hits / lookups, 3) if lookups else 0.0}
+    return info
 
 
 def get_cachedir(dir_name='fpn_cache', user_dirs=False):
@@ -214,6 +261,23 @@ def get_runtimedir(user_dirs=False):
     return run_path
 
 
+def get_state_runner(scr=None):
+    """
+    Get the resident state runner for `scr`, creating it on first use
+    (any runner for a different script is closed, eg, after a role
+    change).
+    :param scr: runner script name (default is the node_runner setting)
+    :return: <StateRunner> object
+    """
+    if not scr:
+        scr = NODE_SETTINGS['node_runner']
+
+    if scr not in state_runners:
+        close_state_runners()
+        state_runners[scr] = StateRunner(scr)
+    return state_runners[scr]
+
+
 def get_token(zt_home=None):
     """Get ZeroTier authentication token (requires root or user acl)."""
     import os
@@ -236,10 +300,14 @@ def json_dump_file(endpoint, data, dirname=None):
     if dirname:
         dir_fd = os.open(dirname, os.O_RDONLY)
     else:
-        opener = None
+        dir_fd = opener = None
 
-    with open(endpoint + '.json', 'w', opener=opener) as fp:
-        json.dump(data, fp, sort_keys=False)
+    try:
+        with open(endpoint + '.json', 'w', opener=opener) as fp:
+            json.dump(data, fp, sort_keys=False)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
     logger.debug('{} data in {}.json'.format(endpoint, endpoint))
 
 
@@ -253,10 +321,14 @@ def json_load_file(endpoint, dirname=None):
     if dirname:
         dir_fd = os.open(dirname, os.O_RDONLY)
     else:
-        opener = None
+        dir_fd = opener = None
 
-    with open(endpoint + '.json', 'r', opener=opener) as fp:
-        data = json.load(fp)
+    try:
+        with open(endpoint + '.json', 'r', opener=opener) as fp:
+            data = json.load(fp)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
     logger.debug('{} data read from {}.json'.format(endpoint, endpoint))
     return data
 
@@ -342,6 +414,68 @@ def network_cruft_cleaner():
         net_q.clear()
 
 
+@functools.lru_cache(maxsize=ADDR_CACHE_SIZE)
+def parse_ipv4_iface(addr_string):
+    """
+    Parse (and memoise) an IPv4 interface address string.
+    :param addr_string: IPv4 address in CIDR format, eg, 192.168.1.10/24
+    :return: bare IPv4 address string or None if not valid
+    """
+    import ipaddress
+    try:
+        return str(ipaddress.IPv4Interface(addr_string).ip)
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=ADDR_CACHE_SIZE)
+def parse_ipv4_int(addr_string):
+    """
+    Parse (and memoise) a bare IPv4 address string as an integer.
+    :param addr_string: IPv4 address without mask, eg, 172.16.0.241
+    :return: <int> 32-bit address or None if not valid
+    """
+    import ipaddress
+    try:
+        return int(ipaddress.IPv4Address(addr_string))
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=ADDR_CACHE_SIZE)
+def parse_ipv4_net(addr_string):
+    """
+    Parse (and memoise) the IPv4 network for an interface address string.
+    :param addr_string: IPv4 address in CIDR format, eg, 172.16.0.241/30
+    :return: <IPv4Network> object or None if not valid
+    """
+    import ipaddress
+    try:
+        return ipaddress.IPv4Interface(addr_string).network
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=ADDR_CACHE_SIZE)
+def parse_path_addr(path_addr):
+    """
+    Parse (and memoise) a ZT path/endpoint address string.
+    :param path_addr: address string with port, eg, 192.168.1.10/9993
+    :return: tuple of (address, port) strings or None if not IPv4
+    """
+    import ipaddress
+
+    addr = path_addr.split('/', maxsplit=1)
+    try:
+        addr_obj = ipaddress.ip_address(addr[0])
+    except ValueError as exc:
+        logger.error('ipaddress exception: {}'.format(exc))
+        return None
+    if addr_obj.version != 4 or len(addr) < 2:
+        return None
+    return addr[0], addr[1]
+
+
 def put_state_msg(msg, state_file=None, clean=True):
     """
     Put a status msg in the state file so the indicator can read it.
@@ -428,7 +562,7 @@ def send_cfg_handler():
     """
     from node_tools import state_data as st
 
-    nsState = AttrDict.from_nested_dict(st.fpnState)
+    nsState = AttrView(st.fpnState)
     addr = nsState.moon_addr
 
     if NODE_SETTINGS['use_localhost'] or not addr:
@@ -476,7 +610,7 @@ def startup_handlers():
     from node_tools import state_data as st
 
     addr = None
-    nsState = AttrDict.from_nested_dict(st.fpnState)
+    nsState = AttrView(st.fpnState)
 
     if nsState.moon_id0 in NODE_SETTINGS['moon_list']:
         addr = nsState.moon_addr
@@ -499,7 +633,10 @@ def update_state(scr=None):
     node_scr = here.joinpath(scr)
 
     try:
-        exec_full(node_scr)
+        if NODE_SETTINGS['resident_runner']:
+            get_state_runner(scr).run_cycle()
+        else:
+            exec_full(node_scr)
         return 'OK'
     except Exception as exc:
         logger.warning('{} exception: {}'.format(scr, exc))
@@ -511,7 +648,7 @@ def validate_role():
     Validate and set initial role with state data from the cache.
     """
     from node_tools import state_data as st
-    nodeState = AttrDict.from_nested_dict(st.fpnState)
+    nodeState = AttrView(st.fpnState)
 
     if NODE_SETTINGS['mode'] == 'peer':
         if nodeState.fpn_id in NODE_SETTINGS['moon_list']:
@@ -577,3 +714,121 @@ class AttrDict(dict):
         else:
             return AttrDict({key: AttrDict.from_nested_dict(data[key])
                              for key in data})
+
+
+class AttrView(dict):
+    """ Lazy attribute-access view of a (nested) dictionary.  Only the
+        top level is copied; nested dicts are wrapped (once) when they
+        are accessed as attributes, instead of being copied up front
+        like ``AttrDict.from_nested_dict``.  Pickles as a plain dict
+        subclass (no instance state).
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            value = self[name]
+        except KeyError:
+            raise AttributeError(name)
+        if isinstance(value, dict) and not isinstance(value, AttrView):
+            value = AttrView(value)
+            dict.__setitem__(self, name, value)
+        return value
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class StateRunner(object):
+    """
+    Resident state runner.  Imports the runner module (eg, netstate.py)
+    once and keeps its cache/queue handles, the event loop and the API
+    client (using the shared API session) across update cycles; each
+    cycle just awaits the module's ``run_state_cycle``.  The client and
+    session are dropped after a failed cycle, so the next one reconnects
+    (and re-reads the token).
+    :param scr: runner script name
+    :param client: ZeroTier client to use (default is a new one)
+    """
+    def __init__(self, scr, client=None):
+        import asyncio
+        import importlib
+        import pathlib
+        import time
+
+        start = time.perf_counter()
+        self.scr = scr
+        self.module = importlib.import_module('node_tools.{}'.format(pathlib.Path(scr).stem))
+        self.handles = self.module.get_state_handles()
+        self.loop = asyncio.new_event_loop()
+        self.client = client
+        self.own_client = client is None
+        self.setup_time = time.perf_counter() - start
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.cycles = 0
+        self.errors = 0
+        self.last_time = 0.0
+        self.min_time = None
+        self.max_time = 0.0
+        self.total_time = 0.0
+
+    async def close_client(self):
+        from node_tools.async_funcs import close_api_session
+
+        if self.own_client:
+            self.client = None
+            await close_api_session()
+
+    async def run_state_cycle(self):
+        from node_tools.async_funcs import get_api_client
+
+        if self.client is None:
+            self.client = await get_api_client()
+        await self.module.run_state_cycle(self.client, self.handles)
+
+    def run_cycle(self):
+        """
+        Run one state cycle (exceptions are counted and re-raised).
+        """
+        import time
+
+        start = time.perf_counter()
+        try:
+            self.loop.run_until_complete(self.run_state_cycle())
+        except Exception:
+            self.errors += 1
+            self.loop.run_until_complete(self.close_client())
+            raise
+        finally:
+            runtime = time.perf_counter() - start
+            self.cycles += 1
+            self.last_time = runtime
+            self.total_time += runtime
+            self.max_time = max(self.max_time, runtime)
+            if self.min_time is None or runtime < self.min_time:
+                self.min_time = runtime
+            logger.debug('{} cycle {} took {:.4f} sec'.format(self.scr, self.cycles, runtime))
+
+    def close(self):
+        if not self.loop.is_closed():
+            self.loop.run_until_complete(self.close_client())
+            self.loop.close()
+
+    def snapshot(self):
+        mean = self.total_time / self.cycles if self.cycles else 0.0
+        return {'runner': self.scr,
+                'cycles': self.cycles,
+                'errors': self.errors,
+                'setup_sec': round(self.setup_time, 6),
+                'cycle_sec': {'last': round(self.last_time, 6),
+                              'min': round(self.min_time or 0.0, 6),
+                              'mean': round(mean, 6),
+                              'max': round(self.max_time, 6)}}
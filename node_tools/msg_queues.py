@@ -90,11 +90,14 @@ def lookup_node_id(key_str, deque):
     :param deque: target queue to search
     :return: queue item <dict> or None
     """
+    from node_tools.cache_funcs import cache_metrics
 
     for item in list(deque):
         if isinstance(item, dict):
             if key_str in item:
+                cache_metrics.count_queue_read(deque, True)
                 return item
+    cache_metrics.count_queue_read(deque, False)
     return None
 
 
@@ -263,6 +266,8 @@ def wait_for_cfg_msg(cfg_q, hold_q, reg_q, msg):
     """
     import json
 
+    from node_tools.cache_funcs import cache_metrics
+
     result = None
 
     if len(cfg_q) == 0:
@@ -277,10 +282,12 @@ def wait_for_cfg_msg(cfg_q, hold_q, reg_q, msg):
                 if msg in list(hold_q):
                     with hold_q.transact():
                         clean_from_queue(msg, hold_q)
+                cache_metrics.count_queue_read(cfg_q, True)
                 return result
             else:
                 process_hold_queue(msg, hold_q, reg_q, max_hold=3)
 
     if not result:
+        cache_metrics.count_queue_read(cfg_q, False)
         logger.debug('Node ID {} not found'.format(msg))
     return result
@@ -2,32 +2,36 @@
 
 """Get data from local ZeroTier node using async client session."""
 import asyncio
-import aiohttp
 import logging
 
 import diskcache as dc
 
-from ztcli_api import ZeroTier
 from ztcli_api import ZeroTierConnectionError
 
 from node_tools import ctlr_data as ct
 from node_tools import state_data as st
 
-from node_tools.async_funcs import bootstrap_mbr_node
+from node_tools.async_funcs import bootstrap_mbr_nodes
+from node_tools.async_funcs import call_api
 from node_tools.async_funcs import cleanup_orphans
 from node_tools.async_funcs import close_mbr_net
+from node_tools.async_funcs import get_api_client
 from node_tools.async_funcs import offline_mbr_node
 from node_tools.async_funcs import unwrap_mbr_net
 from node_tools.async_funcs import update_state_tries
+from node_tools.cache_funcs import get_cycle_cache
 from node_tools.cache_funcs import handle_node_status
-from node_tools.ctlr_funcs import is_exit_node
+from node_tools.ctlr_funcs import get_net_pool
+from node_tools.exceptions import ServiceUnavailableError
 from node_tools.helper_funcs import AttrDict
 from node_tools.helper_funcs import NODE_SETTINGS
 from node_tools.helper_funcs import get_cachedir
-from node_tools.helper_funcs import get_token
 from node_tools.msg_queues import handle_node_queues
 from node_tools.msg_queues import handle_wedged_nodes
 from node_tools.network_funcs import publish_cfg_msg
+from node_tools.trie_funcs import begin_id_trie_cycle
+from node_tools.trie_funcs import checkpoint_state_tries
+from node_tools.trie_funcs import end_id_trie_cycle
 from node_tools.trie_funcs import get_active_nodes
 from node_tools.trie_funcs import get_bootstrap_list
 
@@ -35,88 +39,121 @@ from node_tools.trie_funcs import get_bootstrap_list
 logger = logging.getLogger('netstate')
 
 
-async def main():
-    """State cache updater to retrieve data from a local ZeroTier node."""
-    async with aiohttp.ClientSession() as session:
-        ZT_API = get_token()
-        client = ZeroTier(ZT_API, loop, session)
-
-        try:
-            # handle offline/wedged nodes
-            handle_wedged_nodes(ct.net_trie, wdg_q, off_q)
-            pre_off = list(off_q)
-            logger.debug('{} nodes in offline queue: {}'.format(len(pre_off), pre_off))
-            for node_id in pre_off:
-                await offline_mbr_node(client, node_id)
-            for node_id in [x for x in off_q if x in pre_off]:
-                off_q.remove(node_id)
-            logger.debug('{} nodes in offline queue: {}'.format(len(off_q), list(off_q)))
-
-            # get ID and status details of ctlr node
-            await client.get_data('status')
-            ctlr_id = handle_node_status(client.data, cache)
-
-            # update ctlr state tries
-            await update_state_tries(client, ct.net_trie, ct.id_trie)
-            logger.debug('net_trie has keys: {}'.format(list(ct.net_trie)))
-            # for key in list(ct.net_trie):
-            #     logger.debug('net key {} has paylod: {}'.format(key, ct.net_trie[key]))
-            # for key in list(ct.id_trie):
-            #     logger.debug('id key {} has payload: {}'.format(key, ct.id_trie[key]))
-            logger.debug('id_trie has keys: {}'.format(list(ct.id_trie)))
-
-            # handle node queues and publish messages
+def get_state_handles():
+    """
+    Open the cache, queue and subnet pool handles used by the state cycle.
+    :return: AttrDict of handles
+    """
+    return AttrDict(cache=dc.Index(get_cachedir()),
+                    off_q=dc.Deque(directory=get_cachedir('off_queue')),
+                    node_q=dc.Deque(directory=get_cachedir('node_queue')),
+                    net_pool=get_net_pool(),
+                    staging_q=dc.Deque(directory=get_cachedir('staging_queue')),
+                    wdg_q=dc.Deque(directory=get_cachedir('wedge_queue')))
+
+
+async def run_state_cycle(client, handles):
+    """
+    Run one ctlr state cycle.
+    :param client: ZeroTier client (with an open session)
+    :param handles: AttrDict from get_state_handles()
+    """
+    cache = get_cycle_cache(handles.cache)
+    off_q = handles.off_q
+    node_q = handles.node_q
+    net_pool = handles.net_pool
+    staging_q = handles.staging_q
+    wdg_q = handles.wdg_q
+    id_trie = begin_id_trie_cycle()
+
+    try:
+        # handle offline/wedged nodes
+        handle_wedged_nodes(ct.net_trie, wdg_q, off_q)
+        pre_off = list(off_q)
+        logger.debug('{} nodes in offline queue: {}'.format(len(pre_off), pre_off))
+        for node_id in pre_off:
+            await offline_mbr_node(client, node_id)
+        for node_id in [x for x in off_q if x in pre_off]:
+            off_q.remove(node_id)
+        logger.debug('{} nodes in offline queue: {}'.format(len(off_q), list(off_q)))
+
+        # get ID and status details of ctlr node
+        await call_api(client, 'get_data', 'status')
+        ctlr_id = handle_node_status(client.data, cache)
+
+        # update ctlr state tries
+        await update_state_tries(client, ct.net_trie, id_trie)
+        logger.debug('net_trie has keys: {}'.format(list(ct.net_trie)))
+        # for key in list(ct.net_trie):
+        #     logger.debug('net key {} has paylod: {}'.format(key, ct.net_trie[key]))
+        # for key in list(id_trie):
+        #     logger.debug('id key {} has payload: {}'.format(key, id_trie[key]))
+        logger.debug('id_trie has keys: {}'.format(list(id_trie)))
+
+        # handle node queues and publish messages
+        logger.debug('{} nodes in node queue: {}'.format(len(node_q),
+                                                         list(node_q)))
+        if len(node_q) > 0:
+            handle_node_queues(node_q, staging_q)
             logger.debug('{} nodes in node queue: {}'.format(len(node_q),
                                                              list(node_q)))
-            if len(node_q) > 0:
-                handle_node_queues(node_q, staging_q)
-                logger.debug('{} nodes in node queue: {}'.format(len(node_q),
-                                                                 list(node_q)))
-            logger.debug('{} nodes in staging queue: {}'.format(len(staging_q),
-                                                                list(staging_q)))
-
-            for mbr_id in [x for x in staging_q if x not in list(ct.id_trie)]:
-                if is_exit_node(mbr_id):
-                    await bootstrap_mbr_node(client, ctlr_id, mbr_id, netobj_q, ex=True)
-                else:
-                    await bootstrap_mbr_node(client, ctlr_id, mbr_id, netobj_q)
+        logger.debug('{} nodes in staging queue: {}'.format(len(staging_q),
+                                                            list(staging_q)))
+
+        new_mbrs = [x for x in staging_q if x not in id_trie]
+        if len(new_mbrs) > 0:
+            res = await bootstrap_mbr_nodes(client, ctlr_id, new_mbrs, net_pool)
+            logger.debug('bootstrap results: {}'.format(res))
+            for mbr_id in [x for x in new_mbrs if res[x]]:
                 st.wait_cache.set(mbr_id, True, 90)
-                publish_cfg_msg(ct.id_trie, mbr_id, addr='127.0.0.1')
-
-            for mbr_id in [x for x in staging_q if x in list(ct.id_trie)]:
-                publish_cfg_msg(ct.id_trie, mbr_id, addr='127.0.0.1')
-                staging_q.remove(mbr_id)
-            logger.debug('{} nodes in staging queue: {}'.format(len(staging_q),
-                                                                list(staging_q)))
-
-            # refresh ctlr state tries again
-            await update_state_tries(client, ct.net_trie, ct.id_trie)
-
-            node_list = get_active_nodes(ct.id_trie)
-            logger.debug('{} nodes in node_list: {}'.format(len(node_list), node_list))
-            if len(node_list) > 0:
-                boot_list = get_bootstrap_list(ct.net_trie, ct.id_trie)
-                logger.debug('{} nodes in boot_list: {}'.format(len(boot_list), boot_list))
-
-                if len(boot_list) != 0:
-                    await close_mbr_net(client, node_list, boot_list, min_nodes=3)
-                else:
-                    await unwrap_mbr_net(client, node_list, boot_list, min_nodes=3)
-
-        except Exception as exc:
-            logger.error('netstate exception was: {}'.format(exc))
+                publish_cfg_msg(id_trie, mbr_id, addr='127.0.0.1')
+
+        for mbr_id in [x for x in staging_q if x in list(id_trie)]:
+            publish_cfg_msg(id_trie, mbr_id, addr='127.0.0.1')
+            staging_q.remove(mbr_id)
+        logger.debug('{} nodes in staging queue: {}'.format(len(staging_q),
+                                                            list(staging_q)))
+
+        # refresh ctlr state tries again
+        await update_state_tries(client, ct.net_trie, id_trie)
+
+        node_list = get_active_nodes(id_trie)
+        logger.debug('{} nodes in node_list: {}'.format(len(node_list), node_list))
+        if len(node_list) > 0:
+            boot_list = get_bootstrap_list(ct.net_trie, id_trie)
+            logger.debug('{} nodes in boot_list: {}'.format(len(boot_list), boot_list))
+
+            if len(boot_list) != 0:
+                await close_mbr_net(client, node_list, boot_list, min_nodes=3)
+            else:
+                await unwrap_mbr_net(client, node_list, boot_list, min_nodes=3)
+
+    except Exception as exc:
+        logger.error('netstate exception was: {}'.format(exc))
+        # publish the working copy with the net trie changes; the API calls
+        # and cfg msgs of the failed cycle can't be rolled back, so both
+        # tries keep them and the cleanup sees a consistent state
+        end_id_trie_cycle()
+        if not isinstance(exc, ServiceUnavailableError):
             await cleanup_orphans(client)
-            if list(ct.net_trie) == [] and list(ct.id_trie) != []:
-                ct.id_trie.clear()
-            raise exc
+        if list(ct.net_trie) == [] and list(ct.id_trie) != []:
+            for key in list(ct.id_trie):
+                del ct.id_trie[key]
+        raise exc
+    else:
+        # publish the new ID trie snapshot
+        end_id_trie_cycle()
+
+    # save ctlr state tries for warm start
+    checkpoint_state_tries(ct.net_trie, ct.id_trie)
 
 
-cache = dc.Index(get_cachedir())
-off_q = dc.Deque(directory=get_cachedir('off_queue'))
-node_q = dc.Deque(directory=get_cachedir('node_queue'))
-netobj_q = dc.Deque(directory=get_cachedir('netobj_queue'))
-staging_q = dc.Deque(directory=get_cachedir('staging_queue'))
-wdg_q = dc.Deque(directory=get_cachedir('wedge_queue'))
+async def main():
+    """State cache updater to retrieve data from a local ZeroTier node."""
+    client = await get_api_client()
+    await run_state_cycle(client, get_state_handles())
+
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(main())
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -435,10 +435,10 @@ def send_wedged_msg(addr=None):
     Send a special msg type if my routing is stuffed.
     :param addr: moon address if known
     """
-    from node_tools.helper_funcs import AttrDict
+    from node_tools.helper_funcs import AttrView
     from node_tools import state_data as st
 
-    state = AttrDict.from_nested_dict(st.fpnState)
+    state = AttrView(st.fpnState)
     node_id = state.fpn_id
     reply = []
 
@@ -91,7 +91,7 @@ def do_cleanup(path=None, addr=None):
     :param path: path to scripts dir
     :param addr: moon address if known
     """
-    from node_tools.helper_funcs import AttrDict
+    from node_tools.helper_funcs import AttrView
     from node_tools.network_funcs import do_net_cmd
     from node_tools.network_funcs import get_net_cmds
     from node_tools.helper_funcs import put_state_msg
@@ -109,7 +109,7 @@ def do_cleanup(path=None, addr=None):
             logger.info('CLEANUP: shutting down {}'.format(script))
 
     else:
-        state = AttrDict.from_nested_dict(st.fpnState)
+        state = AttrView(st.fpnState)
         moon_addr = addr
         moon_id = state.moon_id0
         node_id = state.fpn_id
@@ -173,7 +173,7 @@ def do_startup(nwid):
     """
     import time
 
-    from node_tools.helper_funcs import AttrDict
+    from node_tools.helper_funcs import AttrView
     from node_tools.network_funcs import do_net_cmd
     from node_tools.network_funcs import get_net_cmds
 
@@ -182,7 +182,7 @@ def do_startup(nwid):
     run_ztcli_cmd(action='join', extra=nwid)
     # time.sleep(1)
 
-    state = AttrDict.from_nested_dict(st.fpnState)
+    state = AttrView(st.fpnState)
     fpn_home = NODE_SETTINGS['home_dir']
     nets = ['fpn_id0', 'fpn_id1']
     ifaces = ['fpn0', 'fpn1']
@@ -252,10 +252,10 @@ def node_state_check(deorbit=False):
     :return: None or cmd result
     """
     from node_tools import state_data as st
-    from node_tools.helper_funcs import AttrDict
+    from node_tools.helper_funcs import AttrView
 
     result = None
-    state = AttrDict.from_nested_dict(st.fpnState)
+    state = AttrView(st.fpnState)
 
     if deorbit:
         if state.moon_id0 and state.msg_ref:
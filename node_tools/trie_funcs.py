@@ -2,6 +2,7 @@
 
 """trie-specific helper functions."""
 
+import string
 import logging
 
 import datrie
@@ -9,6 +10,27 @@ import datrie
 
 logger = logging.getLogger(__name__)
 
+TRIE_FILES = ('net_trie.dat', 'id_trie.dat')  # checkpoint file names (in the cache dir)
+
+NET_FIELDS = ('id', 'nwid', 'revision', 'routes')  # net trie network payload
+MBR_FIELDS = ('id', 'nwid', 'revision', 'authorized', 'ipAssignments')  # net trie member payload
+
+
+def copy_id_trie(trie):
+    """
+    Copy an ID state trie (keys and payloads).
+    :notes: the copy is a new trie with the items inserted (datrie
+            segfaults on clear() for unpickled tries); the payloads are
+            shared, since ID trie payloads are always replaced (see
+            update_id_trie) and never changed in place
+    :param trie: ID state trie
+    :return: new ID state trie
+    """
+    new_trie = datrie.Trie(string.hexdigits)
+    for key, value in trie.items():
+        new_trie[key] = value
+    return new_trie
+
 
 def create_state_trie(prefix='trie', ext='.dat'):
     """
@@ -39,6 +61,100 @@ def save_state_trie(trie, fname):
     trie.save(fname)
 
 
+def checkpoint_state_tries(net_trie, id_trie, dirname=None):
+    """
+    Save both ctlr state tries to checkpoint files (the files are
+    replaced atomically, so a failed save keeps the last checkpoint).
+    :param net_trie: net state trie object
+    :param id_trie: ID state trie object
+    :param dirname: checkpoint directory (default is the cache dir)
+    """
+    import os
+
+    try:
+        for trie, fname in zip([net_trie, id_trie], get_trie_files(dirname)):
+            save_state_trie(trie, fname + '.tmp')
+            os.replace(fname + '.tmp', fname)
+    except OSError as exc:
+        logger.error('TRIE: checkpoint save failed: {}'.format(exc))
+        return
+    logger.debug('TRIE: saved checkpoint with {} net keys'.format(len(net_trie)))
+
+
+def restore_state_tries(net_trie, id_trie, dirname=None, max_age=3600):
+    """
+    Warm start the (empty) ctlr state tries from the checkpoint files,
+    if both exist and are not older than ``max_age``.
+    :param net_trie: net state trie object
+    :param id_trie: ID state trie object
+    :param dirname: checkpoint directory (default is the cache dir)
+    :param max_age: max checkpoint age in seconds
+    :return: number of restored net trie keys
+    """
+    import os
+    import time
+
+    files = get_trie_files(dirname)
+    if not all(os.path.isfile(fname) for fname in files):
+        return 0
+    age = time.time() - min(os.path.getmtime(fname) for fname in files)
+    if age > max_age:
+        logger.warning('TRIE: checkpoint is too old ({:.0f} sec)'.format(age))
+        return 0
+
+    try:
+        tries = [load_state_trie(fname) for fname in files]
+    except Exception as exc:
+        logger.error('TRIE: checkpoint load failed: {}'.format(exc))
+        return 0
+    for trie, saved in zip([net_trie, id_trie], tries):
+        for key, value in saved.items():
+            trie[key] = value
+    logger.info('TRIE: restored {} net keys from checkpoint'.format(len(net_trie)))
+    return len(net_trie)
+
+
+def get_trie_files(dirname=None):
+    """
+    Get the checkpoint file paths for the net and ID tries.
+    :param dirname: checkpoint directory (default is the cache dir)
+    """
+    import os
+    from node_tools.helper_funcs import get_cachedir
+
+    if not dirname:
+        dirname = os.path.dirname(get_cachedir())
+    return [os.path.join(dirname, fname) for fname in TRIE_FILES]
+
+
+def begin_id_trie_cycle():
+    """
+    Start a netstate cycle with a private working copy of the published
+    ID trie; all ID trie updates for the cycle go to the copy, which is
+    swapped in by end_id_trie_cycle().
+    :return: the working (draft) ID trie
+    """
+    from node_tools import ctlr_data as ct
+
+    if ct.id_draft is None:
+        ct.id_draft = copy_id_trie(ct.id_trie)
+    return ct.id_draft
+
+
+def check_hop_nets(node_id, net_list):
+    """
+    Check the number of networks attached to a node in the chain (ie,
+    one for the exit node, otherwise two).
+    :param node_id: node ID
+    :param net_list: network IDs for the node
+    :raises: AssertionError
+    """
+    from node_tools.ctlr_funcs import is_exit_node
+
+    if len(net_list) != 2 and (len(net_list) == 1 and not is_exit_node(node_id)):
+        raise AssertionError('Node {} keys {} are invalid!'.format(node_id, net_list))
+
+
 def check_trie_params(nw_id, node_id, needs):
     """Check load/update trie params for correctness"""
 
@@ -66,11 +182,15 @@ def cleanup_state_tries(net_trie, id_trie, nw_id, node_id, mbr_only=False):
     :param node_id: mbr node ID str
     :param mbr_only: if True, delete only the member node keys
     """
+    from node_tools.ctlr_funcs import release_net_subnet
+
     if mbr_only:
         mbr_key = nw_id + node_id
         del net_trie[mbr_key]
         del id_trie[node_id]
     else:
+        if nw_id in net_trie:
+            release_net_subnet(net_trie[nw_id])
         for key in net_trie.keys(nw_id):
             del net_trie[key]
         del id_trie[nw_id]
@@ -79,6 +199,24 @@ def cleanup_state_tries(net_trie, id_trie, nw_id, node_id, mbr_only=False):
                 del id_trie[node_id]
 
 
+def end_id_trie_cycle(commit=True):
+    """
+    End the netstate cycle; if ``commit`` is True, the working copy is
+    swapped in as the new published ID trie, otherwise it is dropped.
+    :notes: readers should always use `ctlr_data.id_trie` and never hold
+            on to the draft
+    :param commit: publish the working copy
+    :return: the published ID trie
+    """
+    from node_tools import ctlr_data as ct
+
+    if ct.id_draft is not None:
+        if commit:
+            ct.id_trie = ct.id_draft
+        ct.id_draft = None
+    return ct.id_trie
+
+
 def find_dangling_nets(trie):
     """
     Find networks with needs that are `True` (search the ID trie).
@@ -90,9 +228,9 @@ def find_dangling_nets(trie):
     """
     net_list = []
 
-    for net in [x for x in list(trie) if len(x) == 16]:
-        if trie[net][1] == [False, True]:
-            net_list = [net, trie[net][0][0]]
+    for net, payload in trie.items():
+        if len(net) == 16 and payload[1] == [False, True]:
+            net_list = [net, payload[0][0]]
     return net_list
 
 
@@ -104,9 +242,9 @@ def find_exit_net(trie):
     """
     net_list = []
 
-    for node in [x for x in list(trie) if len(x) == 10]:
-        if trie[node][1] == [False, False] and len(trie[node][0]) == 1:
-            net_list = trie[node][0]
+    for node, payload in trie.items():
+        if len(node) == 10 and payload[1] == [False, False] and len(payload[0]) == 1:
+            net_list = payload[0]
     return net_list
 
 
@@ -117,6 +255,8 @@ def find_orphans(net_trie, id_trie):
     * an empty net ID
     * a node ID with a single net ID (except the exit node)
     * a node ID without any networks
+    :notes: Makes one pass over each trie (net trie keys are counted by
+            network and indexed by member node).
     :param net_trie: datrie trie object
     :param id_trie: datrie trie object
     :return: tuple of lists (orphan net list, orphan node list)
@@ -125,25 +265,32 @@ def find_orphans(net_trie, id_trie):
 
     orphan_nets = []
     orphan_nodes = []
-
-    for net_id in [x for x in list(id_trie) if len(x) == 16]:
-        mbr_list = net_trie.suffixes(net_id)[1:]
-        if mbr_list == []:
-            orphan_nets.append(net_id)
-            logger.warning('CLEANUP: found empty net: {}'.format(net_id))
-    for node_id in [x for x in list(id_trie) if len(x) == 10 and not is_exit_node(x)]:
-        net_list = []
-        for key in list(net_trie):
-            if node_id in key:
-                net_list.append((key[0:16], node_id))
-        if len(net_list) == 1:
-            orphan_nets.append(net_list[0])
-            logger.warning('CLEANUP: found orphan net {}'.format(net_list))
-        elif len(net_list) == 0:
-            orphan_nodes.append(node_id)
-            logger.warning('CLEANUP: found orphan node {}'.format(node_id))
-
-    return orphan_nets, orphan_nodes
+    single_nets = []
+    key_count = {}
+    node_nets = {}
+
+    for key in net_trie:
+        net_id = key[0:16]
+        key_count[net_id] = key_count.get(net_id, 0) + 1
+        if len(key) == 26:
+            node_nets.setdefault(key[16:], []).append(net_id)
+
+    for key in id_trie:
+        if len(key) == 16:
+            # same as an empty `net_trie.suffixes(net_id)[1:]`
+            if key_count.get(key, 0) < 2:
+                orphan_nets.append(key)
+                logger.warning('CLEANUP: found empty net: {}'.format(key))
+        elif len(key) == 10 and not is_exit_node(key):
+            net_list = [(net_id, key) for net_id in node_nets.get(key, [])]
+            if len(net_list) == 1:
+                single_nets.append(net_list[0])
+                logger.warning('CLEANUP: found orphan net {}'.format(net_list))
+            elif len(net_list) == 0:
+                orphan_nodes.append(key)
+                logger.warning('CLEANUP: found orphan node {}'.format(key))
+
+    return orphan_nets + single_nets, orphan_nodes
 
 
 def get_active_nodes(id_trie):
@@ -168,27 +315,38 @@ def get_bootstrap_list(net_trie, id_trie):
     """
     Find all the nodes in the bootstrap chain (search the net trie).
     :notes: We start counting from the last node in the bootstrap
-    chain.
+    chain and follow the exit nodes in the chain topology.
     :param trie: net data trie
     :param trie: ID state trie
     :return: list of node IDs (empty list if None)
     """
     from node_tools.ctlr_funcs import get_exit_node_id
 
-    node_list = []
-    next_node = None
     exit_node = get_exit_node_id()
     dangle_list = find_dangling_nets(id_trie)
     last_node = dangle_list[1]
-    prev_node = last_node
 
-    if last_node != exit_node:
-        while next_node != exit_node:
-            node_list.append(prev_node)
-            _, _, _, next_node = get_neighbor_ids(net_trie, prev_node)
-            prev_node = next_node
+    return get_chain_topology(net_trie).walk(last_node, exit_node)
 
-    return node_list
+
+def get_chain_topology(trie):
+    """
+    Get the chain topology for the net trie, (re)building it only if the
+    trie has changed since the last build.
+    :notes: topology is only cached for a ``NetTrie``, other tries get
+            a fresh build
+    :param trie: net data trie
+    :return: <ChainTopology> object
+    """
+    topo = getattr(trie, 'topology', None)
+    version = getattr(trie, 'version', None)
+
+    if topo is None or version is None or topo.version != version:
+        topo = ChainTopology(trie)
+        if version is not None:
+            trie.topology = topo
+            logger.debug('TRIE: built chain topology with {} nodes'.format(len(topo.hops)))
+    return topo
 
 
 def get_dangling_net_data(trie, net_id):
@@ -217,6 +375,52 @@ def get_dangling_net_data(trie, net_id):
     return netcfg
 
 
+def get_hop_ids(trie, node_id, net_list):
+    """
+    Given the node ID and its attached networks, get the payloads from
+    the net trie and return the source/exit network and neighbor IDs.
+    :param trie: net data trie
+    :param node_id: node ID to lookup
+    :param net_list: network IDs for the node
+    :return: tuple of net and node IDs
+    """
+    from node_tools.ctlr_funcs import int_get_ipv4
+    from node_tools.ctlr_funcs import netcfg_get_netbase
+
+    src_net = None
+    exit_net = None
+    src_node = None
+    exit_node = None
+
+    for key in net_list:
+        node_ip = trie[key + node_id]['ipAssignments'][0]
+        gw_ip = int_get_ipv4(netcfg_get_netbase(node_ip) + 1)
+        if node_ip == gw_ip:
+            src_net = key
+            for node in trie.suffixes(src_net)[1:]:
+                if node_id != node:
+                    src_node = node
+        else:
+            exit_net = key
+            for node in trie.suffixes(exit_net)[1:]:
+                if node_id != node:
+                    exit_node = node
+    return src_net, exit_net, src_node, exit_node
+
+
+def get_id_draft():
+    """
+    Get the ID trie to update, ie, the working copy if a netstate cycle
+    is open, otherwise the published ID trie.
+    :return: ID state trie
+    """
+    from node_tools import ctlr_data as ct
+
+    if ct.id_draft is not None:
+        return ct.id_draft
+    return ct.id_trie
+
+
 def get_invalid_net_id(trie, node_id):
     """
     Get the network ID from the node_id when invalid keys are found;
@@ -226,9 +430,9 @@ def get_invalid_net_id(trie, node_id):
     :param node_id: node ID to lookup
     :return: bogus network ID
     """
-    for key in trie:
-        if node_id in key:
-            return key[0:16]
+    net_list = get_node_nets(trie, node_id)
+    if net_list:
+        return net_list[0]
 
 
 def get_neighbor_ids(trie, node_id):
@@ -239,42 +443,25 @@ def get_neighbor_ids(trie, node_id):
     :param node_id: node ID to lookup
     :return: tuple of net and node IDs
     """
-    from node_tools.ctlr_funcs import ipnet_get_netcfg
-    from node_tools.ctlr_funcs import is_exit_node
-    from node_tools.ctlr_funcs import netcfg_get_ipnet
-    from node_tools.helper_funcs import find_ipv4_iface
+    if isinstance(trie, NetTrie):
+        return get_chain_topology(trie).neighbors(node_id)
 
-    node_list = []
-    key_list = []
-    src_net = None
-    exit_net = None
-    src_node = None
-    exit_node = None
+    key_list = get_node_nets(trie, node_id)
+    check_hop_nets(node_id, key_list)
+    return get_hop_ids(trie, node_id, key_list)
 
-    for key in trie:
-        if node_id in key:
-            key_list.append(key[0:16])
-            node_list.append(trie[key])
 
-    if len(key_list) != 2 and (len(key_list) == 1 and not is_exit_node(node_id)):
-        raise AssertionError('Node {} keys {} are invalid!'.format(node_id, key_list))
-    else:
-        for key, data in zip(key_list, node_list):
-            node_ip = data['ipAssignments'][0]
-            ipnet = netcfg_get_ipnet(node_ip)
-            netcfg = ipnet_get_netcfg(ipnet)
-            gw_ip = find_ipv4_iface(netcfg.gateway[0])
-            if node_ip == gw_ip:
-                src_net = key
-                for node in trie.suffixes(src_net)[1:]:
-                    if node_id != node:
-                        src_node = node
-            else:
-                exit_net = key
-                for node in trie.suffixes(exit_net)[1:]:
-                    if node_id != node:
-                        exit_node = node
-    return src_net, exit_net, src_node, exit_node
+def get_node_nets(trie, node_id):
+    """
+    Get the network IDs for a member node ID from the net trie (uses the
+    reverse index if `trie` is a NetTrie).
+    :param trie: net data trie
+    :param node_id: node ID to lookup
+    :return: list of network IDs (in trie key order)
+    """
+    if isinstance(trie, NetTrie):
+        return trie.get_nets(node_id)
+    return [key[0:16] for key in trie if node_id in key]
 
 
 def get_target_node_id(node_lst, boot_lst):
@@ -290,7 +477,8 @@ def get_target_node_id(node_lst, boot_lst):
     import random
     from node_tools.ctlr_funcs import is_exit_node
 
-    return random.choice([x for x in node_lst if x not in boot_lst and not is_exit_node(x)])
+    boot_set = set(boot_lst)
+    return random.choice([x for x in node_lst if x not in boot_set and not is_exit_node(x)])
 
 
 def get_wedged_node_id(trie, node_id):
@@ -346,11 +534,8 @@ def load_id_trie(net_trie, id_trie, nw_id, node_id, needs=[], nw=False):
         key_id = net_id
         id_list = mbr_list
     else:
-        net_list = []
         mbr_id = node_id[0]
-        for key in list(net_trie):
-            if mbr_id in key:
-                net_list.append(key[0:16])
+        net_list = get_node_nets(net_trie, mbr_id)
         if len(net_list) == 2:
             needs = [False, False]
         elif len(net_list) == 1:
@@ -366,6 +551,17 @@ def load_id_trie(net_trie, id_trie, nw_id, node_id, needs=[], nw=False):
     id_trie[key_id] = payload
 
 
+def slim_trie_payload(data):
+    """
+    Project a ZT network or member object onto the (compact) net trie
+    payload, ie, only the fields used by the ctlr chain logic.
+    :param data: ZT network/member object from the `controller` endpoint
+    :return: payload dict
+    """
+    fields = MBR_FIELDS if data.get('objtype') == 'member' else NET_FIELDS
+    return {field: data[field] for field in fields if field in data}
+
+
 def trie_is_empty(trie):
     """
     Check shared state Trie is fresh and empty (mainly on startup).
@@ -403,3 +599,109 @@ def update_id_trie(trie, nw_id, node_id, needs=[], nw=False):
         key_id = node_id[0]
 
     trie[key_id] = payload
+
+
+class ChainTopology(object):
+    """
+    Bootstrap chain topology derived from the net trie in one pass; maps
+    each member node ID to its (src_net, exit_net, src_node, exit_node)
+    hop so chain walks only need one lookup per node.  Nodes with a bad
+    member payload (eg, no ipAssignments) are logged and left out.
+    """
+    def __init__(self, trie):
+        self.version = getattr(trie, 'version', None)
+        self.node_nets = {}
+        self.hops = {}
+
+        if isinstance(trie, NetTrie):
+            node_nets = {node: trie.get_nets(node) for node in trie.node_nets}
+        else:
+            node_nets = {}
+            for key in [x for x in list(trie) if len(x) == 26]:
+                node_nets.setdefault(key[16:], []).append(key[0:16])
+        for node_id, net_list in node_nets.items():
+            self.node_nets[node_id] = net_list
+            try:
+                self.hops[node_id] = get_hop_ids(trie, node_id, net_list)
+            except (IndexError, KeyError, TypeError, ValueError) as exc:
+                logger.error('TRIE: skipping node {} with bad payload: {}'.format(node_id, repr(exc)))
+
+    def neighbors(self, node_id):
+        """
+        Return the (src_net, exit_net, src_node, exit_node) hop for
+        ``node_id`` (same contract as ``get_neighbor_ids``).
+        """
+        check_hop_nets(node_id, self.node_nets.get(node_id, []))
+        return self.hops.get(node_id, (None, None, None, None))
+
+    def walk(self, start_node, stop_node):
+        """
+        Follow the exit nodes from ``start_node`` until ``stop_node``.
+        :return: list of node IDs (not including ``stop_node``)
+        :raises: AssertionError if the chain is broken
+        """
+        node_list = []
+        seen = set()
+        node_id = start_node
+
+        while node_id != stop_node:
+            if node_id is None or node_id in seen:
+                raise AssertionError('Chain from {} is broken at {}'.format(start_node, node_id))
+            node_list.append(node_id)
+            seen.add(node_id)
+            _, _, _, node_id = self.neighbors(node_id)
+        return node_list
+
+
+class NetTrie(datrie.Trie):
+    """
+    Net state trie with a reverse index of member node IDs; maps each
+    10-digit node ID to the 16-digit network IDs from its net/mbr keys.
+    The index is updated whenever a net/mbr key is set or deleted, and
+    ``version`` is bumped on every change.
+    """
+    def __init__(self, alpha_set=string.hexdigits, **kwargs):
+        super(NetTrie, self).__init__(alpha_set, **kwargs)
+        self.node_nets = {}
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        super(NetTrie, self).__setitem__(key, value)
+        self.version += 1
+        if len(key) == 26:
+            self.node_nets.setdefault(key[16:], set()).add(key[0:16])
+
+    def __delitem__(self, key):
+        super(NetTrie, self).__delitem__(key)
+        self._discard(key)
+
+    def _discard(self, key):
+        self.version += 1
+        if len(key) == 26:
+            nets = self.node_nets.get(key[16:], set())
+            nets.discard(key[0:16])
+            if not nets:
+                self.node_nets.pop(key[16:], None)
+
+    def clear(self):
+        super(NetTrie, self).clear()
+        self.node_nets.clear()
+        self.version += 1
+
+    def get_nets(self, node_id):
+        """Return sorted list of network IDs for ``node_id``."""
+        return sorted(self.node_nets.get(node_id, ()))
+
+    def pop(self, key, *args):
+        value = super(NetTrie, self).pop(key, *args)
+        self._discard(key)
+        return value
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
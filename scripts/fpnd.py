@@ -13,13 +13,16 @@ import functools
 import diskcache as dc
 from daemon import Daemon
 
+from node_tools import ctlr_data as ct
 from node_tools import MemberNodeError
 from node_tools import __version__ as fpnd_version
 
-from node_tools.ctlr_funcs import gen_netobj_queue
+from node_tools.async_funcs import close_api_pool
+from node_tools.ctlr_funcs import get_net_pool
 from node_tools.cache_funcs import delete_cache_entry
 from node_tools.data_funcs import update_runner
 from node_tools.helper_funcs import NODE_SETTINGS
+from node_tools.helper_funcs import close_state_runners
 from node_tools.helper_funcs import do_setup
 from node_tools.helper_funcs import get_cachedir
 from node_tools.helper_funcs import network_cruft_cleaner
@@ -34,6 +37,7 @@ from node_tools.node_funcs import do_cleanup
 from node_tools.node_funcs import do_startup
 from node_tools.node_funcs import handle_moon_data
 from node_tools.node_funcs import wait_for_moon
+from node_tools.trie_funcs import restore_state_tries
 
 try:
     from datetime import timezone
@@ -127,8 +131,8 @@ def do_scheduling():
 
         else:
             if node_role == 'controller':
-                netobj_q = dc.Deque(directory=get_cachedir('netobj_queue'))
-                gen_netobj_queue(netobj_q)
+                restore_state_tries(ct.net_trie, ct.id_trie)
+                get_net_pool(ct.net_trie)
                 cache = dc.Index(get_cachedir())
                 for key_str in ['peer', 'moon', 'mstate']:
                     delete_cache_entry(cache, key_str)
@@ -163,6 +167,8 @@ def do_scheduling():
 class fpnDaemon(Daemon):
     def cleanup(self):
 
+        close_state_runners()
+        close_api_pool()
         do_cleanup()
 
     # implement run method
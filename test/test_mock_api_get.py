@@ -15,15 +15,26 @@ import nanomsg
 
 from diskcache import Index, Deque
 
+from node_tools.cache_funcs import GEN_KEY
+from node_tools.cache_funcs import begin_cache_cycle
 from node_tools.cache_funcs import delete_cache_entry
+from node_tools.cache_funcs import end_cache_cycle
+from node_tools.cache_funcs import expire_cache_entries
 from node_tools.cache_funcs import find_keys
+from node_tools.cache_funcs import get_cache_metrics
 from node_tools.cache_funcs import load_cache_by_type
 from node_tools.cache_funcs import get_endpoint_data
+from node_tools.cache_funcs import get_cycle_cache
+from node_tools.cache_funcs import get_key_index
+from node_tools.cache_funcs import get_meta_cache
+from node_tools.cache_funcs import iter_endpoint_data
 from node_tools.cache_funcs import get_net_status
 from node_tools.cache_funcs import get_node_status
 from node_tools.cache_funcs import get_peer_status
 from node_tools.cache_funcs import get_state
 from node_tools.cache_funcs import handle_node_status
+from node_tools.cache_funcs import reset_key_index
+from node_tools.cache_funcs import update_cache_entry
 from node_tools.ctlr_funcs import get_network_id
 from node_tools.data_funcs import get_state_values
 from node_tools.data_funcs import update_runner
@@ -239,6 +250,7 @@ def test_cache_loading():
 
     def test_cache_is_empty():
         cache.clear()
+        reset_key_index(cache)
         assert list(cache) == []
         res = update_runner()
         assert res is ENODATA
@@ -321,6 +333,234 @@ def test_cache_loading():
     test_handle_node_status()
 
 
+def test_upsert_cache_entries():
+    bulk_cache = Index(get_cachedir(dir_name='fpn_test_bulk', user_dirs=True))
+    bulk_cache.clear()
+    reset_key_index(bulk_cache)
+
+    _, peer_data = client.get_data('peer')
+    res = load_cache_by_type(bulk_cache, peer_data, 'peer', bulk=True)
+    assert res == {'inserted': 6, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    keys = find_keys(bulk_cache, 'peer')
+
+    res = load_cache_by_type(bulk_cache, peer_data, 'peer', bulk=True)
+    assert res == {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 6}
+    assert find_keys(bulk_cache, 'peer') == keys
+
+    peer_data[1]['latency'] = 42
+    peer_data[2]['role'] = 'LEAF'
+    del peer_data[0]
+    res = load_cache_by_type(bulk_cache, peer_data, 'peer', bulk=True)
+    assert res == {'inserted': 0, 'updated': 1, 'deleted': 1, 'unchanged': 4}
+    assert find_keys(bulk_cache, 'peer') == keys[1:]
+    assert bulk_cache[keys[2]].role == 'LEAF'
+
+    _, node_data = client.get_data('status')
+    res = load_cache_by_type(bulk_cache, node_data, 'node', bulk=True)
+    assert res['inserted'] == 1
+    assert len(bulk_cache) == 6
+    bulk_cache.clear()
+
+
+def test_expire_cache_entries():
+    from node_tools.cache_funcs import key_index
+
+    ttl_cache = Index(get_cachedir(dir_name='fpn_test_ttl', user_dirs=True))
+    ttl_cache.clear()
+    reset_key_index(ttl_cache)
+    node, peers, nets, _ = load_data()
+
+    load_cache_by_type(ttl_cache, node, 'node')
+    load_cache_by_type(ttl_cache, peers, 'peer', bulk=True)
+    load_cache_by_type(ttl_cache, nets, 'net', bulk=True)
+    assert expire_cache_entries(ttl_cache, ['node', 'peer', 'net']) == []
+
+    # backdate two peers and the nets, only those are evicted
+    index = get_key_index(ttl_cache)
+    peer_keys = find_keys(ttl_cache, 'peer')
+    for key_type, keys in [('peer', peer_keys[:2]), ('net', find_keys(ttl_cache, 'net'))]:
+        for key in keys:
+            index.stamps[key_type][key] -= max_age + 1
+    assert expire_cache_entries(ttl_cache, ['peer']) == peer_keys[:2]
+    assert len(get_net_status(ttl_cache)) == 0
+    assert len(find_keys(ttl_cache, 'peer')) == 4
+    assert find_keys(ttl_cache, 'node')
+
+    # refreshed entries are kept, re-added entries are new
+    res = load_cache_by_type(ttl_cache, peers, 'peer', bulk=True)
+    assert res == {'inserted': 2, 'updated': 0, 'deleted': 0, 'unchanged': 4}
+
+    # write times are kept on rebuild, saved at the end of the cycle
+    stamps = dict(get_key_index(ttl_cache).stamps['peer'])
+    get_meta_cache(ttl_cache).incr(GEN_KEY)
+    assert get_key_index(ttl_cache).stamps['peer'] == stamps
+    end_cache_cycle(ttl_cache)
+    key_index.clear()
+    assert get_key_index(ttl_cache).stamps['peer'] == stamps
+
+    # peer table is not capped by default
+    assert NODE_SETTINGS['max_peer_entries'] is None
+    assert expire_cache_entries(ttl_cache, ['peer']) == []
+
+    # capped peer table, least recently written first
+    NODE_SETTINGS['max_peer_entries'] = 3
+    peer_keys = find_keys(ttl_cache, 'peer')
+    res = load_cache_by_type(ttl_cache, peers[:5], 'peer', bulk=True)
+    assert res == {'inserted': 0, 'updated': 0, 'deleted': 3, 'unchanged': 5}
+    assert find_keys(ttl_cache, 'peer') == peer_keys[:3]
+    NODE_SETTINGS['max_peer_entries'] = None
+    ttl_cache.clear()
+
+
+def test_cache_metrics(tmp_path):
+    from node_tools.cache_funcs import cache_metrics
+    from node_tools.cache_funcs import write_cache_metrics
+
+    m_cache = Index(get_cachedir(dir_name='fpn_test_metrics', user_dirs=True))
+    m_cache.clear()
+    reset_key_index(m_cache)
+    _, peers, _, _ = load_data()
+
+    cache_metrics.begin_cycle()
+    load_cache_by_type(m_cache, peers, 'peer', bulk=True)
+    assert len(get_peer_status(m_cache)) == 5
+    assert get_net_status(m_cache) == []
+
+    metrics = get_cache_metrics(m_cache, queues=['net_queue'])
+    assert metrics['writes']['cycle'] == 6
+    assert metrics['hits']['peer'] >= 1
+    assert metrics['misses']['net'] >= 1
+    assert metrics['transactions']['count'] >= 3
+    assert metrics['cache']['types']['peer'] == 6
+    assert metrics['cache']['bytes'] > 0
+    assert set(metrics['queues']) <= {'net_queue'}
+
+    # queue stats are read without opening the Deque
+    test_q = Deque(directory=get_cachedir('fpn_test_queue'))
+    test_q.clear()
+    test_q.extend([{'beef9f73c6': '134.47.250.137'}, 'deadd738e6'])
+    assert lookup_node_id('beef9f73c6', test_q)
+    assert lookup_node_id('beefea68e6', test_q) is None
+    metrics = get_cache_metrics(m_cache, queues=['fpn_test_queue'])
+    q_metrics = metrics['queues']['fpn_test_queue']
+    assert q_metrics['entries'] == 2
+    assert q_metrics['bytes'] == test_q.cache.volume()
+    assert (q_metrics['hits'], q_metrics['misses']) == (1, 1)
+    test_q.clear()
+
+    cache_metrics.begin_cycle()
+    metrics = write_cache_metrics(m_cache, dirname=str(tmp_path))
+    assert metrics['writes']['cycle'] == 0
+    assert json_load_file('fpnd_metrics', str(tmp_path)) == metrics
+
+    # the metrics file is written every cycle, no leaked file descriptors
+    num_fds = len(os.listdir('/proc/self/fd'))
+    for _ in range(5):
+        write_cache_metrics(m_cache, dirname=str(tmp_path))
+        json_load_file('fpnd_metrics', str(tmp_path))
+    assert len(os.listdir('/proc/self/fd')) == num_fds
+    m_cache.clear()
+
+
+def test_cache_record_migration(monkeypatch):
+    from node_tools import cache_funcs
+    from node_tools.cache_funcs import CACHE_VERSION
+    from node_tools.cache_funcs import NodeRecord
+    from node_tools.cache_funcs import PeerRecord
+    from node_tools.cache_funcs import load_cache_record
+
+    old_cache = Index(get_cachedir(dir_name='fpn_test_old', user_dirs=True))
+    old_cache.clear()
+    reset_key_index(old_cache)
+
+    _, peer_data = client.get_data('peer')
+    for peer in peer_data:
+        old_cache.push(AttrDict.from_nested_dict(peer), prefix='peer')
+    key_list = list(old_cache)
+
+    peers = get_peer_status(old_cache)
+    assert len(peers) == 5
+    for key in key_list:
+        assert isinstance(old_cache[key], PeerRecord)
+    assert get_peer_status(old_cache) == peers
+
+    # records written with another version (or fields) load as dicts
+    record = old_cache[key_list[0]]
+    fields = dict(record._asdict(), latency=42)
+    assert load_cache_record('PeerRecord', CACHE_VERSION, fields) == fields
+    assert load_cache_record('PeerRecord', CACHE_VERSION, record._asdict()) == record
+    monkeypatch.setattr(cache_funcs, 'CACHE_VERSION', CACHE_VERSION + 1)
+    old_cache[key_list[0]] = record
+    monkeypatch.undo()
+    assert isinstance(old_cache[key_list[0]], dict)
+    assert get_peer_status(old_cache) == peers
+    assert old_cache[key_list[0]] == record
+
+    # the migration is kept if the iterator is closed early
+    _, node_data = client.get_data('status')
+    key = old_cache.push(AttrDict.from_nested_dict(node_data), prefix='node')
+    assert get_node_status(old_cache)['identity'] == node_data['address']
+    assert isinstance(old_cache[key], NodeRecord)
+    old_cache.clear()
+
+
+def test_cache_cycle_write_back():
+    disk_cache = Index(get_cachedir(dir_name='fpn_test_cycle', user_dirs=True))
+    disk_cache.clear()
+    reset_key_index(disk_cache)
+    node, peers, nets, _ = load_data()
+
+    assert begin_cache_cycle(disk_cache) is disk_cache
+    wb_cache = begin_cache_cycle(disk_cache, mode='write-back')
+    assert get_cycle_cache(disk_cache) is wb_cache
+    assert begin_cache_cycle(disk_cache, mode='write-back') is wb_cache
+
+    load_cache_by_type(wb_cache, node, 'node')
+    load_cache_by_type(wb_cache, peers, 'peer', bulk=True)
+    load_cache_by_type(wb_cache, nets, 'net')
+    assert len(disk_cache) == 0
+    assert len(wb_cache) == 10
+    wb_keys = list(wb_cache)
+    peer_list = get_peer_status(wb_cache)
+
+    assert end_cache_cycle(disk_cache) == 10
+    assert end_cache_cycle(disk_cache) == 0
+    assert get_cycle_cache(disk_cache) is disk_cache
+    assert list(disk_cache) == wb_keys
+    assert get_peer_status(disk_cache) == peer_list
+
+    wb_cache = begin_cache_cycle(disk_cache, mode='write-back')
+    del wb_cache[wb_keys[1]]
+    wb_cache.update([('utc-time', utc_stamp)])
+    key = wb_cache.push(node, prefix='node')
+    assert key == 'node-500000000000001'
+    assert wb_keys[1] in disk_cache
+    end_cache_cycle(disk_cache)
+    assert wb_keys[1] not in disk_cache
+    assert disk_cache['utc-time'] == utc_stamp
+    assert len(disk_cache) == 11
+
+    wb_cache = begin_cache_cycle(disk_cache, mode='write-back')
+    wb_cache.clear()
+    assert len(disk_cache) == 11
+    end_cache_cycle(disk_cache)
+    assert len(disk_cache) == 0
+
+
+def test_cache_cycle_write_through():
+    disk_cache = Index(get_cachedir(dir_name='fpn_test_cycle', user_dirs=True))
+    disk_cache.clear()
+    reset_key_index(disk_cache)
+    _, peers, _, _ = load_data()
+
+    wt_cache = begin_cache_cycle(disk_cache, mode='write-through')
+    load_cache_by_type(wt_cache, peers, 'peer')
+    assert list(disk_cache) == list(wt_cache)
+    assert end_cache_cycle(disk_cache) == 0
+    assert len(get_peer_status(disk_cache)) == 5
+    disk_cache.clear()
+
+
 def test_get_node_status():
     Node = get_node_status(cache)
     assert isinstance(Node, dict)
@@ -467,6 +707,51 @@ def test_find_state_keys():
     assert 'istate' in s
 
 
+def test_key_index():
+    from node_tools.cache_funcs import key_index
+
+    for key_str in ['node', 'peer', 'net', 'state']:
+        key_list = [key for key in list(cache) if key_str in key]
+        assert find_keys(cache, key_str) == key_list
+    assert len(get_key_index(cache)) == len(cache)
+
+    key_index.clear()
+    data = find_keys(cache, 'state')
+    assert data == [key for key in list(cache) if 'state' in key]
+    assert cache.directory in key_index
+
+    # the bookkeeping is kept out of the cache, own writes keep the index
+    index = get_key_index(cache)
+    assert GEN_KEY not in cache
+    gen = index.gen
+    key = find_keys(cache, 'peer')[-1]
+    update_cache_entry(cache, cache[key], key)
+    assert get_meta_cache(cache)[GEN_KEY] == gen + 1
+    assert get_key_index(cache) is index
+
+    # replace an entry the way another process would (same item count)
+    key = find_keys(cache, 'peer')[-1]
+    value = cache.pop(key)
+    new_key = cache.push(value, prefix='peer')
+    get_meta_cache(cache).incr(GEN_KEY)
+    assert find_keys(cache, 'peer')[-1] == new_key
+    assert get_key_index(cache) is not index
+
+
+def test_iter_endpoint_data():
+    import types
+
+    res = iter_endpoint_data(cache, 'peer')
+    assert isinstance(res, types.GeneratorType)
+    key_list, values = get_endpoint_data(cache, 'peer')
+    assert [key for key, _ in res] == key_list
+    for key, data in iter_endpoint_data(cache, 'state'):
+        assert 'state' in key
+        assert hasattr(data, 'identity')
+    assert list(iter_endpoint_data(cache, 'mbr')) == []
+    assert list(iter_endpoint_data(cache, 'tuna')) == []
+
+
 def test_get_state():
     from node_tools import state_data as stest
 
@@ -483,6 +768,53 @@ def test_get_state():
     assert nodeState['fpn_id1'] == 'b6079f73ca8129ad'
 
 
+def test_get_state_journal():
+    from node_tools import state_data as stest
+
+    state_cache = Index(get_cachedir(dir_name='fpn_test_state', user_dirs=True))
+    state_cache.clear()
+    reset_key_index(state_cache)
+    node, _, nets, _ = load_data()
+    saved_state = dict(stest.fpnState)
+    stest.fpnState.update(fpn_id=None, fallback=True)
+
+    handle_node_status(node, state_cache)
+    index = get_key_index(state_cache)
+    assert index.states is None
+    get_state(state_cache)
+    assert stest.fpnState['fpn_id'] == 'beefea68e6'
+    assert not stest.fpnState['fallback']
+    assert not index.journal
+    key = find_keys(state_cache, 'nstate')[0]
+    assert index.states[key] == state_cache[key]
+
+    nstate = dict(state_cache[key]._asdict(), tcpFallback=True)
+    load_cache_by_type(state_cache, nstate, 'nstate')
+    assert index.journal == {key}
+    get_state(state_cache)
+    assert not index.journal
+    assert stest.fpnState['fallback']
+
+    load_cache_by_type(state_cache, nstate, 'nstate', bulk=True)
+    assert not index.journal
+    delete_cache_entry(state_cache, 'nstate')
+    assert index.journal == {key}
+    get_state(state_cache)
+    assert key not in index.states
+    assert stest.fpnState['fallback']
+
+    # an OK network without a route is not up
+    istate = {'identity': 'b6079f73ca8129ad', 'status': 'OK', 'mac': 'b6:79:6a:54:8b:f3',
+              'ztdevice': 'ztyqb6mebi'}
+    load_cache_by_type(state_cache, [istate], 'istate')
+    get_state(state_cache)
+    assert stest.fpnState['fpn1'] is None
+    assert stest.fpnState['fpn0'] is None
+
+    stest.fpnState.update(saved_state)
+    state_cache.clear()
+
+
 def test_get_ztnwid():
     from node_tools import state_data as stest
 
@@ -556,6 +888,10 @@ def test_get_state_values():
     assert isinstance(stest.changes, tuple)
     assert len(stest.changes) == 4
     assert len(stest.changes[0]) == 2
+
+    # fields are matched by name, not by position
+    get_state_values({'fpn0': True, 'online': True}, {'online': False, 'fpn0': True})
+    assert stest.changes == (('online', False),)
     # reset shared state vars
     stest.changes = []
 
@@ -580,6 +916,8 @@ def test_run_event_handler():
     from node_tools.data_funcs import get_state_values
 
     home, pid_file, log_file, debug, msg, mode, role = do_setup()
+    assert NODE_SETTINGS['cache_ttls'] == {}
+    assert NODE_SETTINGS['max_peer_entries'] is None
 
     nets = ['b6079f73c63cea29', 'b6079f73ca8129ad']
     net_q.clear()
@@ -6,6 +6,7 @@ import time
 import shutil
 import datetime
 import logging
+import asyncio
 import ipaddress
 import string
 import tempfile
@@ -22,26 +23,58 @@ from diskcache import Index
 
 import node_tools.timing_funcs as tf
 
-from node_tools.ctlr_funcs import gen_netobj_queue
+from node_tools.async_funcs import api_breaker
+from node_tools.async_funcs import api_metrics
+from node_tools.async_funcs import api_pool
+from node_tools.async_funcs import bootstrap_mbr_node
+from node_tools.async_funcs import bootstrap_mbr_nodes
+from node_tools.async_funcs import call_api
+from node_tools.async_funcs import close_api_pool
+from node_tools.async_funcs import close_api_session
+from node_tools.async_funcs import fetch_network_object_data
+from node_tools.async_funcs import fetch_network_object_ids
+from node_tools.async_funcs import gather_with_limit
+from node_tools.async_funcs import get_api_metrics
+from node_tools.async_funcs import get_api_session
+from node_tools.async_funcs import get_full_object_data
+from node_tools.async_funcs import update_state_tries
+from node_tools.cache_funcs import get_cache_metrics
+from node_tools.ctlr_funcs import SubnetPool
+from node_tools.ctlr_funcs import get_net_pool
+from node_tools.ctlr_funcs import get_route_netbase
 from node_tools.ctlr_funcs import handle_net_cfg
 from node_tools.ctlr_funcs import ipnet_get_netcfg
 from node_tools.ctlr_funcs import is_exit_node
 from node_tools.ctlr_funcs import name_generator
+from node_tools.ctlr_funcs import netbase_get_netcfg
+from node_tools.ctlr_funcs import netbase_get_netcfgs
 from node_tools.ctlr_funcs import netcfg_get_ipnet
+from node_tools.ctlr_funcs import netcfg_get_netbase
+from node_tools.ctlr_funcs import release_net_subnet
+from node_tools.ctlr_funcs import reserve_net_subnet
 from node_tools.ctlr_funcs import set_network_cfg
 from node_tools.ctlr_funcs import unset_network_cfg
 from node_tools.exceptions import MemberNodeError
+from node_tools.exceptions import ServiceUnavailableError
 from node_tools.helper_funcs import AttrDict
+from node_tools.helper_funcs import AttrView
 from node_tools.helper_funcs import ENODATA
 from node_tools.helper_funcs import NODE_SETTINGS
+from node_tools.helper_funcs import StateRunner
+from node_tools.helper_funcs import close_state_runners
 from node_tools.helper_funcs import find_ipv4_iface
+from node_tools.helper_funcs import get_addr_cache_info
+from node_tools.helper_funcs import get_cachedir
 from node_tools.helper_funcs import get_filepath
 from node_tools.helper_funcs import get_runtimedir
+from node_tools.helper_funcs import get_state_runner
 from node_tools.helper_funcs import json_load_file
+from node_tools.helper_funcs import parse_path_addr
 from node_tools.helper_funcs import put_state_msg
 from node_tools.helper_funcs import send_cfg_handler
 from node_tools.helper_funcs import set_initial_role
 from node_tools.helper_funcs import startup_handlers
+from node_tools.helper_funcs import update_state
 from node_tools.helper_funcs import validate_role
 from node_tools.helper_funcs import xform_state_diff
 from node_tools.logger_config import setup_logging
@@ -58,21 +91,35 @@ from node_tools.node_funcs import handle_moon_data
 from node_tools.node_funcs import parse_moon_data
 from node_tools.sched_funcs import catch_exceptions
 from node_tools.sched_funcs import check_return_status
+from node_tools.trie_funcs import MBR_FIELDS
+from node_tools.trie_funcs import NET_FIELDS
+from node_tools.trie_funcs import ChainTopology
+from node_tools.trie_funcs import NetTrie
+from node_tools.trie_funcs import begin_id_trie_cycle
+from node_tools.trie_funcs import checkpoint_state_tries
 from node_tools.trie_funcs import cleanup_state_tries
 from node_tools.trie_funcs import create_state_trie
+from node_tools.trie_funcs import end_id_trie_cycle
+from node_tools.trie_funcs import find_dangling_nets
 from node_tools.trie_funcs import find_exit_net
 from node_tools.trie_funcs import find_orphans
 from node_tools.trie_funcs import get_active_nodes
 from node_tools.trie_funcs import get_bootstrap_list
+from node_tools.trie_funcs import get_chain_topology
 from node_tools.trie_funcs import get_dangling_net_data
+from node_tools.trie_funcs import get_id_draft
 from node_tools.trie_funcs import get_invalid_net_id
 from node_tools.trie_funcs import get_neighbor_ids
+from node_tools.trie_funcs import get_node_nets
 from node_tools.trie_funcs import get_target_node_id
 from node_tools.trie_funcs import get_wedged_node_id
 from node_tools.trie_funcs import load_id_trie
 from node_tools.trie_funcs import load_state_trie
+from node_tools.trie_funcs import restore_state_tries
 from node_tools.trie_funcs import save_state_trie
+from node_tools.trie_funcs import slim_trie_payload
 from node_tools.trie_funcs import trie_is_empty
+from node_tools.trie_funcs import update_id_trie
 
 
 try:
@@ -260,6 +307,18 @@ class IPv4InterfaceTest(unittest.TestCase):
         bogus_addr = find_ipv4_iface('192.168.1.300/24', False)
         self.assertFalse(bogus_addr)
 
+    def test_parse_path_addr(self):
+        """Return (addr, port) for IPv4 path addr and count cache hits"""
+        parse_path_addr.cache_clear()
+        self.assertEqual(parse_path_addr('192.168.1.1/9993'), ('192.168.1.1', '9993'))
+        self.assertIsNone(parse_path_addr('fd80:56c2:e21c:0:199:93ed:d2a:ef3/9993'))
+        self.assertIsNone(parse_path_addr('192.168.1.300/9993'))
+        self.assertEqual(parse_path_addr('192.168.1.1/9993'), ('192.168.1.1', '9993'))
+        info = get_addr_cache_info()['parse_path_addr']
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['misses'], 3)
+        self.assertEqual(info['hit_rate'], 0.25)
+
 
 class IPv4NetObjectTest(unittest.TestCase):
     """
@@ -289,6 +348,27 @@ class IPv4NetObjectTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             res = ipnet_get_netcfg('172.16.0.0/30')
 
+    def test_netbase_get_netcfg(self):
+        """Integer netcfg matches the ipaddress version"""
+        for cidr in ['172.16.0.0/30', '172.31.255.252/30', '10.1.2.0/24', '192.168.0.4/31']:
+            netobj = ipaddress.ip_network(cidr)
+            hosts = list(netobj.hosts())
+            pfx = '/' + str(netobj.prefixlen)
+            res = ipnet_get_netcfg(netobj)
+            self.assertEqual(res.gateway, [str(hosts[0]) + pfx])
+            self.assertEqual(res.host, [str(hosts[1]) + pfx])
+            self.assertEqual(res.net_routes, [{'target': cidr},
+                                              {'target': '0.0.0.0/0', 'via': str(hosts[0])}])
+        bases = [int(net.network_address) for net in ipaddress.ip_network('172.16.0.0/28').subnets(new_prefix=30)]
+        res = netbase_get_netcfgs(bases)
+        self.assertEqual([x.host[0] for x in res],
+                         ['172.16.0.2/30', '172.16.0.6/30', '172.16.0.10/30', '172.16.0.14/30'])
+        self.assertEqual(netcfg_get_netbase('172.16.0.241'), int(ipaddress.ip_address('172.16.0.240')))
+        with self.assertRaises(ipaddress.AddressValueError):
+            netcfg_get_netbase('172.16.0.261')
+        with self.assertRaises(ValueError):
+            netbase_get_netcfg(bases[0] + 1)
+
 
 class NetCmdTest(unittest.TestCase):
     """
@@ -647,6 +727,79 @@ def load_net_trie_data(trie):
                 trie[net_id + mbr_id] = mbr
 
 
+class mock_ctlr_api_client(object):
+    """
+    Async client API to serve ctlr network/member endpoints (and count
+    the requests); set `fail` to an ID to make set_value calls on its
+    endpoints fail.
+    """
+    def __init__(self, delay=0):
+        self.nets, self.mbrs = load_ctlr_data()
+        self.calls = []
+        self.delay = delay
+        self.active = {'now': 0, 'max': 0}
+        self.fail = None
+
+    async def get_data(self, endpoint):
+        import copy
+
+        self.calls.append(endpoint)
+        self.active['now'] += 1
+        self.active['max'] = max(self.active['max'], self.active['now'])
+        await asyncio.sleep(self.delay)
+        self.active['now'] -= 1
+        path = endpoint.split('/')
+        if len(path) == 2:
+            data = [net['id'] for net in self.nets]
+        elif len(path) == 3:
+            data = [net for net in self.nets if net['id'] == path[2]][0]
+        elif len(path) == 4:
+            data = {mbr['id']: mbr['revision'] for mbr in self.mbrs if mbr['nwid'] == path[2]}
+        else:
+            data = [mbr for mbr in self.mbrs if mbr['nwid'] == path[2] and mbr['id'] == path[4]][0]
+        self.data = copy.deepcopy(data)
+
+    async def set_value(self, cfg_dict, endpoint):
+        import copy
+
+        self.calls.append(endpoint)
+        new_id = '{:06x}'.format(len(self.calls))
+        await asyncio.sleep(self.delay)
+        if self.fail and self.fail in endpoint:
+            raise ValueError('set_value failed for {}'.format(endpoint))
+        path = endpoint.split('/')
+        if path[2].endswith('______'):
+            net_id = path[2][:10] + new_id
+            data = {'id': net_id, 'nwid': net_id, 'objtype': 'network',
+                    'revision': 1, 'routes': []}
+            self.nets.append(data)
+        elif len(path) == 3:
+            data = [net for net in self.nets if net['id'] == path[2]][0]
+        else:
+            data = [mbr for mbr in self.mbrs if mbr['nwid'] == path[2] and mbr['id'] == path[4]]
+            if data:
+                data = data[0]
+            else:
+                data = {'id': path[4], 'nwid': path[2], 'objtype': 'member',
+                        'revision': 0, 'authorized': False, 'ipAssignments': []}
+                self.mbrs.append(data)
+        data.update({k: v for k, v in cfg_dict.items() if k})
+        if 'routes' in cfg_dict:
+            data['routes'] = [dict({'via': None}, **x) for x in cfg_dict['routes']]
+        data['revision'] += 1
+        self.data = copy.deepcopy(data)
+
+    async def delete_thing(self, endpoint):
+        self.calls.append(endpoint)
+        path = endpoint.split('/')
+        if len(path) == 3:
+            self.nets[:] = [net for net in self.nets if net['id'] != path[2]]
+            self.mbrs[:] = [mbr for mbr in self.mbrs if mbr['nwid'] != path[2]]
+        else:
+            self.mbrs[:] = [mbr for mbr in self.mbrs
+                           if (mbr['nwid'], mbr['id']) != (path[2], path[4])]
+
+
 def get_state_icon(state):
     """
     Match the state msg and return the icon name.
@@ -955,6 +1108,457 @@ def test_get_invalid_net_id():
     assert res == 'beafde52b4296ea5'
 
 
+def test_net_trie_node_index():
+    from node_tools import ctlr_data as ct
+
+    trie = NetTrie()
+    load_net_trie_data(trie)
+    assert list(trie) == list(ct.net_trie)
+    for node_id in ['beefea68e6', 'ee2eedb2e1', 'ff2ffdb2e1']:
+        assert get_node_nets(trie, node_id) == [key[0:16] for key in trie if node_id in key]
+        assert trie.get_nets(node_id) == get_node_nets(ct.net_trie, node_id)
+    assert get_node_nets(trie, 'ee2eedb2e1') == ['beafde52b4296ea5', 'beafde52b4a5f7ba']
+
+    del trie['beafde52b4296ea5' + 'ee2eedb2e1']
+    assert trie.get_nets('ee2eedb2e1') == ['beafde52b4a5f7ba']
+    trie.pop('beafde52b4a5f7ba' + 'ee2eedb2e1')
+    assert 'ee2eedb2e1' not in trie.node_nets
+    trie.clear()
+    assert trie.node_nets == {}
+
+
+def test_update_state_tries():
+    from node_tools import ctlr_data as ct
+
+    loop = asyncio.get_event_loop()
+    ctlr = mock_ctlr_api_client()
+    net_trie = NetTrie()
+    id_trie = datrie.Trie(string.hexdigits)
+    ct.synced_nets.clear()
+    ct.unauth_mbrs.clear()
+    ct.sync_cycles = 0
+
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(list(net_trie)) == 8
+    assert len(list(id_trie)) == 6
+    assert len(ctlr.calls) == 12
+    assert set(net_trie['beafde52b4296ea5']) == set(NET_FIELDS)
+    assert set(net_trie['beafde52b4296ea5ee2eedb2e1']) == set(MBR_FIELDS)
+    full_data = loop.run_until_complete(get_full_object_data(ctlr, 'beafde52b4296ea5ee2eedb2e1'))
+    assert full_data['identity'].startswith('ee2eedb2e1')
+    assert slim_trie_payload(full_data) == net_trie['beafde52b4296ea5ee2eedb2e1']
+
+    # unchanged networks and members are not fetched again
+    ctlr.calls = []
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(ctlr.calls) == 4
+    ctlr.mbrs[1]['revision'] += 1
+    ctlr.mbrs[1]['ipAssignments'] = ['172.16.1.141']
+    ctlr.calls = []
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(ctlr.calls) == 5
+    assert net_trie['beafde52b4296ea5ee2eedb2e1']['ipAssignments'] == ['172.16.1.141']
+    ct.synced_nets.discard('beafde52b4296ea5')
+    ctlr.calls = []
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(ctlr.calls) == 5
+
+    # deauthorized members and deleted networks are pruned
+    mbr = [x for x in ctlr.mbrs if x['id'] == 'ff2ffdb2e1'][0]
+    mbr_key = mbr['nwid'] + mbr['id']
+    mbr['revision'] += 1
+    mbr['authorized'] = False
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert mbr_key not in net_trie
+    assert ct.unauth_mbrs == {mbr_key: mbr['revision']}
+    assert mbr['nwid'] not in id_trie['ff2ffdb2e1'][0]
+    ctlr.calls = []
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(ctlr.calls) == 4
+
+    # all networks are refreshed every `net_sync_cycles` updates
+    NODE_SETTINGS['net_sync_cycles'] = 2
+    ct.sync_cycles = 0
+    ctlr.calls = []
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(ctlr.calls) == 4
+    ctlr.calls = []
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(ctlr.calls) == 7
+    assert ct.sync_cycles == 0
+    NODE_SETTINGS['net_sync_cycles'] = 30
+
+    # removed members are dropped from the unauthorized members
+    ctlr.mbrs.remove(mbr)
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert ct.unauth_mbrs == {}
+
+    net_id = 'beafde52b4296ea5'
+    ctlr.nets = [x for x in ctlr.nets if x['id'] != net_id]
+    ctlr.mbrs = [x for x in ctlr.mbrs if x['nwid'] != net_id]
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert net_trie.keys(net_id) == []
+    assert net_id not in id_trie
+    assert net_id not in ct.synced_nets
+    assert net_id not in id_trie['ee2eedb2e1'][0]
+    ct.synced_nets.clear()
+    ct.unauth_mbrs.clear()
+
+
+def test_id_trie_cycle():
+    from node_tools import ctlr_data as ct
+
+    saved = ct.id_trie
+    ct.id_trie = datrie.Trie(string.hexdigits)
+    ct.id_trie['beefea68e6'] = (['beafde52b4296ea5'], [False, False])
+    published = ct.id_trie
+    assert get_id_draft() is published
+
+    draft = begin_id_trie_cycle()
+    assert begin_id_trie_cycle() is draft
+    assert get_id_draft() is draft
+    update_id_trie(draft, ['beafde52b4a5f7ba'], ['ee2eedb2e1'], needs=[False, True])
+    del draft['beefea68e6']
+    # readers still see the published (unchanged) snapshot
+    assert ct.id_trie is published
+    assert list(ct.id_trie) == ['beefea68e6']
+    assert end_id_trie_cycle() is draft
+    assert ct.id_trie is draft
+    assert ct.id_draft is None
+    assert list(ct.id_trie) == ['ee2eedb2e1']
+    assert list(published) == ['beefea68e6']
+
+    draft = begin_id_trie_cycle()
+    del draft['ee2eedb2e1']
+    assert end_id_trie_cycle(commit=False) is ct.id_trie
+    assert list(ct.id_trie) == ['ee2eedb2e1']
+
+    # the working copy is a plain trie (safe to clear)
+    draft = begin_id_trie_cycle()
+    draft.clear()
+    assert end_id_trie_cycle() is draft
+    assert list(ct.id_trie) == []
+    ct.id_trie = saved
+
+
+def test_gather_with_limit():
+    from node_tools import ctlr_data as ct
+
+    loop = asyncio.get_event_loop()
+    ctlr = mock_ctlr_api_client(delay=0.01)
+    net_ids = [net['id'] for net in ctlr.nets]
+
+    res = loop.run_until_complete(gather_with_limit([fetch_network_object_ids(ctlr, x) for x in net_ids], limit=2))
+    assert ctlr.active['max'] == 2
+    assert [sorted(x) for x in res] == [sorted(mbr['id'] for mbr in ctlr.mbrs if mbr['nwid'] == x)
+                                        for x in net_ids]
+    res = loop.run_until_complete(gather_with_limit([fetch_network_object_data(ctlr, x) for x in net_ids]))
+    assert ctlr.active['max'] == 3
+    assert [x['id'] for x in res] == net_ids
+    assert loop.run_until_complete(fetch_network_object_ids(ctlr)) == net_ids
+
+    # a cold update fetches all the nets/members concurrently
+    net_trie = NetTrie()
+    id_trie = datrie.Trie(string.hexdigits)
+    ct.synced_nets.clear()
+    ct.unauth_mbrs.clear()
+    ctlr = mock_ctlr_api_client(delay=0.01)
+    loop.run_until_complete(update_state_tries(ctlr, net_trie, id_trie))
+    assert len(ctlr.calls) == 12
+    assert ctlr.active['max'] == 6
+    assert len(list(net_trie)) == 8
+    ct.synced_nets.clear()
+    ct.unauth_mbrs.clear()
+
+
+def test_bootstrap_mbr_nodes(tmp_path):
+    from node_tools import ctlr_data as ct
+
+    loop = asyncio.get_event_loop()
+    saved = ct.net_trie, ct.id_trie
+    ct.net_trie = NetTrie()
+    ct.id_trie = datrie.Trie(string.hexdigits)
+    ctlr = mock_ctlr_api_client()
+    loop.run_until_complete(update_state_tries(ctlr, ct.net_trie, ct.id_trie))
+    pool = SubnetPool(str(tmp_path / 'pool.dat'), ipnet='172.16.2.0/28')
+    ctlr_id = 'edf70dc89a'
+    old_net = 'beafde52b4a5e8ab'
+    assert find_dangling_nets(ct.id_trie) == [old_net, 'ff2ffdb2e1']
+
+    try:
+        # a failed node breaks the chain for the nodes after it
+        ctlr.fail = 'dddddddd02'
+        node_list = ['dddddddd01', 'dddddddd02', 'dddddddd03']
+        res = loop.run_until_complete(bootstrap_mbr_nodes(ctlr, ctlr_id, node_list, pool))
+        assert res == {'dddddddd01': True, 'dddddddd02': False, 'dddddddd03': False}
+        assert pool.used == 1
+        assert len(ctlr.nets) == 4
+        assert [x for x in ctlr.mbrs if x['id'] in node_list[1:]] == []
+        net_01 = ct.id_trie['dddddddd01'][0][0]
+        assert ct.id_trie['dddddddd01'] == ([net_01, old_net], [False, False])
+        assert ct.id_trie[old_net] == (['dddddddd01', 'ff2ffdb2e1'], [False, False])
+        assert find_dangling_nets(ct.id_trie) == [net_01, 'dddddddd01']
+        assert ct.net_trie[net_01 + 'dddddddd01']['ipAssignments'] == ['172.16.2.1/30']
+        mbr = [x for x in ctlr.mbrs if x['nwid'] == old_net and x['id'] == 'dddddddd01'][0]
+        assert mbr['ipAssignments'] == ['172.16.1.150/30']
+
+        ctlr.fail = None
+        res = loop.run_until_complete(bootstrap_mbr_nodes(ctlr, ctlr_id, node_list[1:], pool))
+        assert res == {'dddddddd02': True, 'dddddddd03': True}
+        net_02 = ct.id_trie['dddddddd02'][0][0]
+        net_03 = ct.id_trie['dddddddd03'][0][0]
+        assert ct.id_trie['dddddddd02'] == ([net_02, net_01], [False, False])
+        assert ct.id_trie['dddddddd03'] == ([net_03, net_02], [False, False])
+        assert ct.id_trie[net_02] == (['dddddddd03', 'dddddddd02'], [False, False])
+        assert find_dangling_nets(ct.id_trie) == [net_03, 'dddddddd03']
+        assert pool.used == 3
+
+        # single node wrapper (the pool has no free subnets after this)
+        assert loop.run_until_complete(bootstrap_mbr_node(ctlr, ctlr_id, 'dddddddd04', pool)) is True
+        ctlr.calls = []
+        assert loop.run_until_complete(bootstrap_mbr_node(ctlr, ctlr_id, 'dddddddd05', pool)) is False
+        assert ctlr.calls == []
+        assert 'dddddddd05' not in ct.id_trie
+    finally:
+        ct.net_trie, ct.id_trie = saved
+        ct.synced_nets.clear()
+        ct.unauth_mbrs.clear()
+        pool.close()
+
+
+def test_call_api():
+    import aiohttp
+
+    class client(object):
+        def __init__(self, fails=0, exc=aiohttp.ClientConnectionError, delay=0):
+            self.calls = 0
+            self.fails = fails
+            self.exc = exc
+            self.delay = delay
+
+        async def get_data(self, endpoint):
+            self.calls += 1
+            await asyncio.sleep(self.delay)
+            if self.calls <= self.fails:
+                raise self.exc(endpoint)
+            self.data = endpoint
+
+        async def set_value(self, cfg_dict, endpoint):
+            await self.get_data(endpoint)
+
+    loop = asyncio.get_event_loop()
+    saved = dict(NODE_SETTINGS)
+    NODE_SETTINGS.update(api_backoff=0.001, api_breaker_max=3, api_breaker_reset=0.05)
+    api_breaker.reset()
+    api_metrics.reset()
+    try:
+        # GETs are retried (with backoff) on transient errors
+        ztc = client(fails=2)
+        loop.run_until_complete(call_api(ztc, 'get_data', 'status'))
+        assert ztc.calls == 3
+        assert ztc.data == 'status'
+        calls = get_api_metrics()['calls']['get_data']
+        assert (calls['ok'], calls['error'], calls['retries']) == (1, 2, 2)
+        assert api_breaker.failures == 0
+
+        # other calls are not, and neither are non-transient errors
+        ztc = client(fails=1)
+        with pytest.raises(aiohttp.ClientConnectionError):
+            loop.run_until_complete(call_api(ztc, 'set_value', {}, 'controller/network'))
+        assert ztc.calls == 1
+        ztc = client(fails=1, exc=ValueError)
+        with pytest.raises(ValueError):
+            loop.run_until_complete(call_api(ztc, 'get_data', 'status'))
+        assert ztc.calls == 1
+        assert api_breaker.failures == 0
+
+        # a hung call is cut off at the deadline
+        NODE_SETTINGS.update(api_timeout=0.02, api_retries=0)
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(call_api(client(delay=1), 'get_data', 'status'))
+        assert api_metrics.snapshot()['calls']['get_data']['timeout'] == 1
+
+        # the breaker opens, rejects calls, then lets a trial call through
+        for _ in range(2):
+            with pytest.raises(asyncio.TimeoutError):
+                loop.run_until_complete(call_api(client(delay=1), 'get_data', 'status'))
+        assert api_breaker.state == 'open'
+        ztc = client()
+        with pytest.raises(ServiceUnavailableError):
+            loop.run_until_complete(call_api(ztc, 'get_data', 'status'))
+        assert ztc.calls == 0
+        time.sleep(0.06)
+        loop.run_until_complete(call_api(ztc, 'get_data', 'status'))
+        assert ztc.calls == 1
+        metrics = get_api_metrics()
+        assert metrics['breaker'] == {'state': 'closed', 'failures': 0, 'trips': 1}
+        assert metrics['calls']['get_data']['rejected'] == 1
+        assert json.loads(json.dumps(metrics)) == metrics
+    finally:
+        NODE_SETTINGS.update(saved)
+        api_breaker.reset()
+        api_metrics.reset()
+
+
+def test_api_session_pool():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    async def handler(request):
+        return web.json_response({'address': 'beefea68e6'})
+
+    async def slow_handler(request):
+        await asyncio.sleep(1)
+        return web.json_response({})
+
+    async def run_requests():
+        app = web.Application()
+        app.router.add_get('/status', handler)
+        app.router.add_get('/slow', slow_handler)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            session = await get_api_session()
+            assert await get_api_session() is session
+            for _ in range(3):
+                async with session.get(server.make_url('/status')) as resp:
+                    assert (await resp.json())['address'] == 'beefea68e6'
+            with pytest.raises(asyncio.TimeoutError):
+                await session.get(server.make_url('/slow'))
+        finally:
+            await close_api_session()
+            await server.close()
+        assert session.closed
+
+    timeout = NODE_SETTINGS['api_timeout']
+    NODE_SETTINGS['api_timeout'] = 0.2
+    api_pool.reset()
+    try:
+        asyncio.get_event_loop().run_until_complete(run_requests())
+    finally:
+        NODE_SETTINGS['api_timeout'] = timeout
+    stats = api_pool.snapshot()
+    assert stats['sessions'] == 1
+    assert stats['requests'] == 4
+    assert stats['errors'] == 1
+    assert stats['connections'] == {'created': 1, 'reused': 3}
+    assert stats['latency_sec']['max'] >= 0.2
+    assert api_pool.session is None
+
+    async def open_and_close():
+        session = await get_api_session()
+        assert api_pool.loop is asyncio.get_event_loop()
+        await close_api_session()
+        return session
+
+    # each loop gets its own session
+    loops = [asyncio.new_event_loop() for _ in range(2)]
+    sessions = [x.run_until_complete(open_and_close()) for x in loops]
+    assert sessions[0] is not sessions[1]
+    assert api_pool.snapshot()['sessions'] == 3
+    for x in loops:
+        x.close()
+
+    # the session left open at exit is closed on its loop
+    loop = asyncio.new_event_loop()
+    session = loop.run_until_complete(get_api_session())
+    close_api_pool()
+    assert session.closed
+    assert api_pool.session is None
+    loop.close()
+    api_pool.reset()
+
+
+def test_state_runner():
+    import types
+
+    # stand-in runner module (handles are opened once per runner)
+    mod = types.ModuleType('node_tools.mockstate')
+    mod.opened = []
+
+    def get_state_handles():
+        mod.opened.append(True)
+        return AttrDict(seen=[])
+
+    async def run_state_cycle(client, handles):
+        await client.get_data('status')
+        handles.seen.append(client.data)
+        if handles.seen[-1] == 'fail':
+            raise ValueError('bad cycle')
+
+    class client(object):
+        data = None
+        reply = None
+
+        async def get_data(self, endpoint):
+            self.data = self.reply or endpoint
+
+    mod.get_state_handles = get_state_handles
+    mod.run_state_cycle = run_state_cycle
+    sys.modules['node_tools.mockstate'] = mod
+    try:
+        runner = StateRunner('mockstate.py', client=client())
+        for _ in range(3):
+            runner.run_cycle()
+        assert mod.opened == [True]
+        assert runner.handles.seen == ['status'] * 3
+        stats = runner.snapshot()
+        assert stats['runner'] == 'mockstate.py'
+        assert stats['cycles'] == 3
+        assert stats['errors'] == 0
+        assert 0 <= stats['cycle_sec']['min'] <= stats['cycle_sec']['mean'] <= stats['cycle_sec']['max']
+
+        runner.client.reply = 'fail'
+        with pytest.raises(ValueError):
+            runner.run_cycle()
+        assert runner.snapshot()['errors'] == 1
+        assert runner.snapshot()['cycles'] == 4
+        runner.close()
+        assert runner.loop.is_closed()
+
+        # one runner per script, closed on a role change
+        first = get_state_runner('mockstate.py')
+        assert get_state_runner('mockstate.py') is first
+        metrics = get_cache_metrics(Index(get_cachedir(dir_name='fpn_test', user_dirs=True)),
+                                    queues=[])
+        assert metrics['runners'] == {'mockstate.py': first.snapshot()}
+        close_state_runners(keep='mockstate.py')
+        assert get_state_runner('mockstate.py') is first
+        close_state_runners()
+        assert first.loop.is_closed()
+    finally:
+        del sys.modules['node_tools.mockstate']
+
+    # no client/token here, so the resident runner returns ENODATA
+    NODE_SETTINGS['resident_runner'] = True
+    try:
+        assert update_state() is ENODATA
+    finally:
+        NODE_SETTINGS['resident_runner'] = False
+        close_state_runners()
+
+
+def test_checkpoint_state_tries(tmp_path):
+    net_trie = NetTrie()
+    id_trie = datrie.Trie(string.hexdigits)
+    load_net_trie_data(net_trie)
+    for node_id in ['beefea68e6', 'ee2eedb2e1', 'ff2ffdb2e1']:
+        load_id_trie(net_trie, id_trie, [], [node_id])
+
+    checkpoint_state_tries(net_trie, id_trie, str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path))) == ['id_trie.dat', 'net_trie.dat']
+
+    new_net_trie = NetTrie()
+    new_id_trie = datrie.Trie(string.hexdigits)
+    assert restore_state_tries(new_net_trie, new_id_trie, str(tmp_path), max_age=-1) == 0
+    assert list(new_net_trie) == []
+    assert restore_state_tries(new_net_trie, new_id_trie, str(tmp_path)) == 8
+    assert new_net_trie.items() == net_trie.items()
+    assert new_net_trie.node_nets == net_trie.node_nets
+    assert new_id_trie.items() == id_trie.items()
+    assert restore_state_tries(NetTrie(), new_id_trie, str(tmp_path / 'nope')) == 0
+
+
 def test_get_neighbor_ids():
     from node_tools import ctlr_data as ct
 
@@ -995,6 +1599,46 @@ def test_get_bootstrap_list():
     NODE_SETTINGS['use_exitnode'].clear()
 
 
+def test_get_chain_topology():
+    from node_tools import ctlr_data as ct
+
+    node_id = 'ee2eedb2e1'
+    exit_id = 'beefea68e6'
+    tail_id = 'ff2ffdb2e1'
+    NODE_SETTINGS['use_exitnode'].append(exit_id)
+
+    topo = get_chain_topology(ct.net_trie)
+    assert isinstance(topo, ChainTopology)
+    assert get_chain_topology(ct.net_trie) is topo
+    assert topo.neighbors(node_id) == get_neighbor_ids(ct.net_trie, node_id)
+    assert topo.walk(tail_id, exit_id) == [tail_id, node_id]
+    with pytest.raises(AssertionError):
+        topo.walk(tail_id, 'deadbeef01')
+
+    # a plain trie gets a fresh (uncached) build with the same hops
+    plain_trie = datrie.Trie(string.hexdigits)
+    for key, value in ct.net_trie.items():
+        plain_trie[key] = value
+    assert ChainTopology(plain_trie).hops == topo.hops
+
+    # a member with a bad payload is skipped, the other hops still build
+    plain_trie['deadbeef00000001' + 'deadbeef01'] = {'ipAssignments': []}
+    bad_topo = ChainTopology(plain_trie)
+    assert 'deadbeef01' not in bad_topo.hops
+    assert bad_topo.walk(tail_id, exit_id) == [tail_id, node_id]
+
+    # a looped chain is broken
+    src_net, exit_net, src_node, _ = bad_topo.hops[node_id]
+    bad_topo.hops[node_id] = (src_net, exit_net, src_node, tail_id)
+    with pytest.raises(AssertionError):
+        bad_topo.walk(tail_id, exit_id)
+
+    net_key = [x for x in ct.net_trie.keys() if len(x) == 16][0]
+    ct.net_trie[net_key] = ct.net_trie[net_key]
+    assert get_chain_topology(ct.net_trie) is not topo
+    NODE_SETTINGS['use_exitnode'].clear()
+
+
 def test_get_target_node_id():
     from node_tools import ctlr_data as ct
 
@@ -1127,6 +1771,35 @@ def test_get_dangling_net_data():
     assert res.host == ['172.16.1.150/30']
 
 
+def test_attr_view():
+    import pickle
+
+    data = {'id': 'b6079f73ca8129ad',
+            'routes': [{'target': '10.147.18.0/24', 'via': None}],
+            'v4AssignMode': {'zt': False}}
+    view = AttrView(data)
+    assert isinstance(view, dict)
+    assert view.id == 'b6079f73ca8129ad'
+    assert view.routes is data['routes']
+    assert type(dict.__getitem__(view, 'v4AssignMode')) is dict
+    assert view.v4AssignMode.zt is False
+    assert isinstance(dict.__getitem__(view, 'v4AssignMode'), AttrView)
+    with pytest.raises(AttributeError):
+        view.name
+
+    view.name = 'test2'
+    assert 'name' not in data
+    assert view == AttrDict.from_nested_dict(dict(data, name='test2'))
+
+    new_view = pickle.loads(pickle.dumps(view))
+    assert isinstance(new_view, AttrView)
+    assert new_view == view
+    assert new_view.v4AssignMode.zt is False
+
+    old_entry = pickle.loads(pickle.dumps(AttrDict.from_nested_dict(data)))
+    assert AttrView(old_entry).v4AssignMode.zt is False
+
+
 def test_set_network_cfg():
     host_cfg = ['172.16.0.126/30']
     res = set_network_cfg(host_cfg)
@@ -1183,39 +1856,104 @@ def test_aging_not_available_warning_msg():
         warnings.warn("Cache aging not available", UserWarning)
 
 
-def test_gen_netobj_queue():
-    import diskcache as dc
-
-    netobj_q = dc.Deque(directory='/tmp/test-oq')
-    netobj_q.clear()
-
-    gen_netobj_queue(netobj_q, ipnet='192.168.0.0/24')
-    assert len(netobj_q) == 64
-    net = netobj_q.popleft()
-    assert isinstance(net, ipaddress.IPv4Network)
-    assert len(list(net)) == 4
-    assert len(list(net.hosts())) == 2
-    gen_netobj_queue(netobj_q)
-    assert len(netobj_q) == 63
-
-
-def test_handle_net_cfg():
-    import diskcache as dc
-
-    netobj_q = dc.Deque(directory='/tmp/test-oq')
+def test_subnet_pool(tmp_path):
+    fname = str(tmp_path / 'pool.dat')
+    pool = SubnetPool(fname, ipnet='192.168.0.0/24')
+    assert pool.size == 64
+    assert pool.used == 0
+    assert os.path.getsize(fname) == 8
+
+    base = pool.allocate()
+    assert ipaddress.ip_address(base) == ipaddress.ip_address('192.168.0.0')
+    assert pool.allocate() == base + 4
+    assert pool.is_used(base)
+    assert pool.release(base) is True
+    assert pool.release(base) is False
+    assert not pool.is_used(base)
+    assert pool.reserve(base + 8) is True
+    assert pool.reserve(base + 8) is False
+    assert pool.allocate() == base
+    assert pool.allocate() == base + 12
+    assert pool.used == 4
+    with pytest.raises(ValueError):
+        pool.reserve(base + 1)
+    with pytest.raises(ValueError):
+        pool.release(base + 256)
+    assert pool.is_pool_net(base + 252)
+    assert not pool.is_pool_net(base + 256)
+    pool.close()
+
+    # state is persistent
+    pool = SubnetPool(fname, ipnet='192.168.0.0/24')
+    assert pool.used == 4
+    assert pool.is_used(base + 8)
+    assert pool.release(base + 4) is True
+    allocated = [pool.allocate() for _ in range(61)]
+    assert base + 4 in allocated
+    assert pool.used == 64
+    with pytest.raises(IndexError):
+        pool.allocate()
+    pool.close()
+
+    # pool smaller than one byte of the bitmap
+    pool = SubnetPool(str(tmp_path / 'small.dat'), ipnet='192.168.1.0/28')
+    assert pool.size == 4
+    small = [pool.allocate() for _ in range(4)]
+    with pytest.raises(IndexError):
+        pool.allocate()
+    assert pool.release(small[1]) is True
+    assert pool.allocate() == small[1]
+    pool.clear()
+    assert pool.used == 0
+    assert pool.allocate() == small[0]
+    pool.close()
+
+
+def test_get_net_pool(tmp_path):
+    from node_tools import ctlr_data as ct
 
-    net1, mbr1, gw1 = handle_net_cfg(netobj_q)
+    saved = ct.net_pool
+    ct.net_pool = None
+    trie = NetTrie()
+    load_net_trie_data(trie)
+    pool = get_net_pool(trie, dirname=str(tmp_path))
+    assert get_net_pool() is pool
+    assert os.listdir(str(tmp_path)) == ['subnet_pool.dat']
+    nets = [x for x in trie.keys() if len(x) == 16]
+    assert pool.used == len(nets)
+    base = get_route_netbase(trie[nets[0]])
+    assert pool.is_used(base)
+    assert release_net_subnet(trie[nets[0]]) is True
+    assert reserve_net_subnet(trie[nets[0]]) is True
+    assert reserve_net_subnet({'routes': []}) is False
+    assert get_route_netbase({'id': nets[0]}) is None
+
+    # the pool is rebuilt from the trie, stale subnets are released
+    stale = pool.allocate()
+    assert get_net_pool(trie) is pool
+    assert not pool.is_used(stale)
+    assert pool.is_used(base)
+    assert pool.used == len(nets)
+    pool.close()
+    ct.net_pool = saved
+
+
+def test_handle_net_cfg(tmp_path):
+    pool = SubnetPool(str(tmp_path / 'pool.dat'), ipnet='192.168.0.0/24')
+
+    net1, mbr1, gw1 = handle_net_cfg(pool)
     for fragment in [net1, mbr1, gw1]:
         assert isinstance(fragment, AttrDict)
 
-    net2, mbr2, gw2 = handle_net_cfg(netobj_q)
+    net2, mbr2, gw2 = handle_net_cfg(pool)
     for fragment in [net2, mbr2, gw2]:
         assert isinstance(fragment, AttrDict)
 
     assert mbr1 != mbr2
-    assert mbr1.ipAssignments == ['192.168.0.6/30']
+    assert mbr2.ipAssignments == ['192.168.0.6/30']
     assert mbr1.authorized is True
-    res = handle_net_cfg(netobj_q)
-    assert len(res) is 3
-    # print(res)
-    netobj_q.clear()
+    assert net2.ipAssignmentPools == [{'ipRangeStart': '192.168.0.5', 'ipRangeEnd': '192.168.0.6'}]
+    res = handle_net_cfg(pool)
+    assert len(res) == 3
+    assert pool.used == 3
+    pool.close()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Target:   Python 3.6
+
+"""
+Scalability benchmarks for the ctlr state trie functions, using synthetic
+controller data for a bootstrap chain of N member nodes (plus the exit
+node) at 100, 1k and 10k members by default.
+
+Each function is timed (best of --repeat runs) and compared against the
+stored baseline file; the script exits non-zero if any timing is slower
+than the baseline by more than --tolerance (ratio) and --slack (seconds).
+Baselines are machine-specific, so re-save them with --save when moving
+to a new machine (or after an intentional change).
+
+usage: bench_ctlr_tries.py [num_members ...] [--save] [--repeat N]
+                           [--tolerance X] [--slack S] [--baseline FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import string
+import argparse
+import ipaddress
+
+import datrie
+
+from node_tools.ctlr_funcs import netbase_get_netcfgs
+from node_tools.helper_funcs import NODE_SETTINGS
+from node_tools.trie_funcs import NetTrie
+from node_tools.trie_funcs import cleanup_state_tries
+from node_tools.trie_funcs import find_dangling_nets
+from node_tools.trie_funcs import find_orphans
+from node_tools.trie_funcs import get_bootstrap_list
+from node_tools.trie_funcs import get_neighbor_ids
+from node_tools.trie_funcs import load_id_trie
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_ctlr_baseline.json')
+EXIT_ID = 'beefea68e6'
+
+
+def timerfunc(func):
+    """
+    A timer decorator (returns best time of `repeat` runs and the value)
+    """
+    def function_timer(*args, repeat=1, **kwargs):
+        """
+        A nested function for timing other functions
+        """
+        runtime = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            value = func(*args, **kwargs)
+            end = time.perf_counter()
+            if runtime is None or end - start < runtime:
+                runtime = end - start
+        msg = "{func} took {time:.4f} seconds to complete"
+        print(msg.format(func=func.__name__,
+                         time=runtime))
+        return runtime, value
+    return function_timer
+
+
+def gen_ctlr_data(num_mbrs, ipnet='172.16.0.0/12'):
+    """
+    Generate (slim) ctlr network and member payloads for a bootstrap
+    chain; the exit node is the gateway on the first net, member N is
+    the host on net N-1 and the gateway on net N, and the last net is
+    dangling (gateway only).
+    :return: tuple of (nets, mbrs) lists
+    """
+    nets = []
+    mbrs = []
+    base = int(ipaddress.ip_network(ipnet).network_address)
+    node_ids = [EXIT_ID] + ['{:010x}'.format(0xa000000000 + i) for i in range(num_mbrs)]
+    netcfgs = netbase_get_netcfgs(base + 4 * i for i in range(len(node_ids)))
+
+    for i, node_id in enumerate(node_ids):
+        net_id = '{:016x}'.format(0xbeafde52b4000000 + i)
+        netcfg = netcfgs[i]
+        nets.append({'id': net_id, 'nwid': net_id, 'revision': 1,
+                     'routes': netcfg.net_routes})
+        addrs = [(node_id, netcfg.gateway[0])]
+        if i < num_mbrs:
+            addrs.append((node_ids[i + 1], netcfg.host[0]))
+        for mbr_id, addr in addrs:
+            mbrs.append({'id': mbr_id, 'nwid': net_id, 'revision': 1, 'authorized': True,
+                         'ipAssignments': [addr.split('/')[0]]})
+    return nets, mbrs
+
+
+def load_net_trie(nets, mbrs):
+    """Load the generated payloads into a new net trie."""
+    net_trie = NetTrie()
+    for net in nets:
+        net_trie[net['id']] = net
+    for mbr in mbrs:
+        net_trie[mbr['nwid'] + mbr['id']] = mbr
+    return net_trie
+
+
+@timerfunc
+def bench_load_id_trie(net_trie, nets, mbrs):
+    id_trie = datrie.Trie(string.hexdigits)
+    for mbr in mbrs:
+        load_id_trie(net_trie, id_trie, [], [mbr['id']])
+    for net in nets:
+        load_id_trie(net_trie, id_trie, [net['id']], [], nw=True)
+    return id_trie
+
+
+@timerfunc
+def bench_find_orphans(net_trie, id_trie):
+    return find_orphans(net_trie, id_trie)
+
+
+@timerfunc
+def bench_get_bootstrap_list(net_trie, id_trie):
+    net_trie.topology = None
+    return get_bootstrap_list(net_trie, id_trie)
+
+
+@timerfunc
+def bench_get_neighbor_ids(net_trie, node_ids):
+    net_trie.topology = None
+    return [get_neighbor_ids(net_trie, node_id) for node_id in node_ids]
+
+
+@timerfunc
+def bench_find_dangling_nets(id_trie):
+    return find_dangling_nets(id_trie)
+
+
+def bench_cleanup_state_tries(id_trie, nets, mbrs, count=100, repeat=1):
+    """
+    Remove the last `count` nets (and their gateway nodes) from copies
+    of the tries (only the cleanup calls are timed).
+    """
+    runtime = None
+    gw_ids = {}
+    for mbr in mbrs:
+        gw_ids.setdefault(mbr['nwid'], mbr['id'])
+    for _ in range(repeat):
+        net_copy = load_net_trie(nets, mbrs)
+        id_copy = datrie.Trie(string.hexdigits)
+        for key, value in id_trie.items():
+            id_copy[key] = value
+        start = time.perf_counter()
+        for net in nets[-count:]:
+            cleanup_state_tries(net_copy, id_copy, net['id'], gw_ids[net['id']])
+        end = time.perf_counter()
+        if runtime is None or end - start < runtime:
+            runtime = end - start
+    print('bench_cleanup_state_tries took {:.4f} seconds to complete'.format(runtime))
+    return runtime
+
+
+def run_benchmarks(num_mbrs, repeat=3):
+    """
+    Run each benchmark on a chain of `num_mbrs` members.
+    :return: dict of function names and (best) runtimes
+    """
+    results = {}
+    print('{} members:'.format(num_mbrs))
+    nets, mbrs = gen_ctlr_data(num_mbrs)
+    net_trie = load_net_trie(nets, mbrs)
+    node_ids = sorted(set(x['id'] for x in mbrs if x['id'] != EXIT_ID))
+
+    results['load_id_trie'], id_trie = bench_load_id_trie(net_trie, nets, mbrs, repeat=repeat)
+    results['find_orphans'], res = bench_find_orphans(net_trie, id_trie, repeat=repeat)
+    assert res == ([], [])
+    results['get_bootstrap_list'], res = bench_get_bootstrap_list(net_trie, id_trie, repeat=repeat)
+    assert len(res) == num_mbrs
+    results['get_neighbor_ids'], res = bench_get_neighbor_ids(net_trie, node_ids, repeat=repeat)
+    assert len(res) == num_mbrs
+    results['find_dangling_nets'], res = bench_find_dangling_nets(id_trie, repeat=repeat)
+    assert res == [nets[-1]['id'], mbrs[-1]['id']]
+    results['cleanup_state_tries'] = bench_cleanup_state_tries(id_trie, nets, mbrs, repeat=repeat)
+
+    return results
+
+
+def check_results(results, baseline, tolerance, slack):
+    """
+    Compare results with the baseline.
+    :return: list of regression msgs
+    """
+    errors = []
+    for size, timings in results.items():
+        for name, runtime in timings.items():
+            base = baseline.get(size, {}).get(name)
+            if base is not None and runtime > base * tolerance + slack:
+                errors.append('{} at {} members: {:.4f}s vs baseline {:.4f}s'.format(name, size, runtime, base))
+    return errors
+
+
+parser = argparse.ArgumentParser(description='Benchmark ctlr trie functions.')
+parser.add_argument('sizes', nargs='*', type=int, default=[100, 1000, 10000])
+parser.add_argument('--save', action='store_true', help='save results as the new baseline')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--tolerance', type=float, default=1.5)
+parser.add_argument('--slack', type=float, default=0.005)
+parser.add_argument('--baseline', default=BASELINE)
+args = parser.parse_args()
+
+NODE_SETTINGS['use_exitnode'] = [EXIT_ID]
+results = {str(size): run_benchmarks(size, args.repeat) for size in args.sizes}
+
+if args.save:
+    with open(args.baseline, 'w') as fp:
+        json.dump({size: {name: round(runtime, 6) for name, runtime in timings.items()}
+                   for size, timings in results.items()}, fp, indent=2, sort_keys=True)
+    print('Saved baseline to {}'.format(args.baseline))
+elif os.path.exists(args.baseline):
+    with open(args.baseline) as fp:
+        errors = check_results(results, json.load(fp), args.tolerance, args.slack)
+    for msg in errors:
+        print('REGRESSION: {}'.format(msg))
+    if errors:
+        sys.exit(1)
+    print('No regressions found')
+else:
+    print('No baseline found ({})'.format(args.baseline))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Target:   Python 3.6
+
+"""
+Compare find_orphans() against the old nested-loop version using a
+synthetic bootstrap chain (default is 10k member nodes).
+
+The nested-loop version is O(nodes * net keys) so by default it is only
+timed for a sample of nodes (and scaled up); use --full to run it all.
+
+usage: bench_find_orphans.py [num_members] [--full]
+"""
+
+import sys
+import time
+import string
+
+import datrie
+
+from node_tools.ctlr_funcs import is_exit_node
+from node_tools.trie_funcs import find_orphans
+from node_tools.trie_funcs import NetTrie
+
+
+def timerfunc(func):
+    """
+    A timer decorator
+    """
+    def function_timer(*args, **kwargs):
+        """
+        A nested function for timing other functions
+        """
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        end = time.perf_counter()
+        runtime = end - start
+        msg = "{func} took {time:.4f} seconds to complete"
+        print(msg.format(func=func.__name__,
+                         time=runtime))
+        return value
+    return function_timer
+
+
+def gen_chain_tries(num_mbrs, net_trie):
+    """
+    Chain of `num_mbrs` nodes where net N links node N and node N+1,
+    plus one empty net, one single-net node and one netless node.
+    """
+    id_trie = datrie.Trie(string.hexdigits)
+    node_ids = ['{:010x}'.format(0xa000000000 + i) for i in range(num_mbrs + 1)]
+    net_ids = ['{:016x}'.format(0xbeafde52b4000000 + i) for i in range(num_mbrs)]
+
+    for i, net_id in enumerate(net_ids):
+        net_trie[net_id] = {'id': net_id}
+        for node_id in node_ids[i:i + 2]:
+            net_trie[net_id + node_id] = {'id': node_id, 'nwid': net_id}
+        id_trie[net_id] = (node_ids[i:i + 2], [False, False])
+    for i, node_id in enumerate(node_ids):
+        id_trie[node_id] = (net_ids[max(i - 1, 0):i + 1], [False, False])
+    id_trie['{:016x}'.format(0xbeafde52b4ffffff)] = ([], [False, True])
+    id_trie['dead99dead'] = ([], [False, True])
+
+    return net_trie, id_trie
+
+
+@timerfunc
+def find_orphans_nested(net_trie, id_trie):
+    """The nested-loop version (one net trie scan per node)."""
+    orphan_nets = []
+    orphan_nodes = []
+
+    for net_id in [x for x in list(id_trie) if len(x) == 16]:
+        mbr_list = net_trie.suffixes(net_id)[1:]
+        if mbr_list == []:
+            orphan_nets.append(net_id)
+    for node_id in [x for x in list(id_trie) if len(x) == 10 and not is_exit_node(x)]:
+        net_list = []
+        for key in list(net_trie):
+            if node_id in key:
+                net_list.append((key[0:16], node_id))
+        if len(net_list) == 1:
+            orphan_nets.append(net_list[0])
+        elif len(net_list) == 0:
+            orphan_nodes.append(node_id)
+
+    return orphan_nets, orphan_nodes
+
+
+@timerfunc
+def find_orphans_one_pass(net_trie, id_trie):
+    """The current version."""
+    return find_orphans(net_trie, id_trie)
+
+
+def estimate_nested(net_trie, id_trie, sample=100):
+    """Time the nested net trie scan for `sample` nodes and scale it."""
+    node_list = [x for x in list(id_trie) if len(x) == 10]
+    start = time.perf_counter()
+    for node_id in node_list[:sample]:
+        [key for key in list(net_trie) if node_id in key]
+    runtime = (time.perf_counter() - start) * len(node_list) / sample
+    print('find_orphans_nested would take ~{:.1f} seconds to complete'.format(runtime))
+    return runtime
+
+
+args = [x for x in sys.argv[1:] if x != '--full']
+num_mbrs = int(args[0]) if args else 10000
+net_trie, id_trie = gen_chain_tries(num_mbrs, NetTrie())
+print('{} net keys, {} ID keys'.format(len(list(net_trie)), len(list(id_trie))))
+
+start = time.perf_counter()
+res = find_orphans_one_pass(net_trie, id_trie)
+runtime = time.perf_counter() - start
+print('Orphans: {}'.format(res))
+if '--full' in sys.argv:
+    assert find_orphans_nested(net_trie, id_trie) == res
+else:
+    nested = estimate_nested(net_trie, id_trie)
+    print('Speedup: ~{:.0f}x'.format(nested / runtime))